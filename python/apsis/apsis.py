@@ -12,9 +12,11 @@ from   .actions import Action
 from   .cond.base import PolledCondition, RunStoreCondition, NonmonotonicRunStoreCondition
 from   .host_group import config_host_groups
 from   .jobs import Jobs, load_jobs_dir, diff_jobs_dirs
-from   .lib.api import run_to_summary_jso
-from   .lib.asyn import TaskGroup, Publisher, KeyPublisher
+from   .lib.api import run_to_summary_json
+from   .lib.asyn import TaskGroup, KeyPublisher, SequencedPublisher
 from   .lib.cmpr import compress_async
+from   .lib.py import get_cfg
+from   .lib.rope import flatten
 from   .lib.sys import to_signal
 from   .output import OutputStore
 from   .program.base import _InternalProgram
@@ -71,8 +73,9 @@ class Apsis:
         config_host_groups(cfg)
         self.__db = db
 
-        # Publisher for summary updates.
-        self.summary_publisher = Publisher()
+        # Publisher for summary updates.  Clients may resume from a sequence
+        # number.
+        self.summary_publisher = SequencedPublisher()
         # Publisher for per-run updates.
         self.run_update_publisher = KeyPublisher()
         # Publisher for output data updates.
@@ -92,6 +95,8 @@ class Apsis:
         else:
             min_timestamp = now() - lookback
         self.run_store = RunStore(db, min_timestamp=min_timestamp)
+        # Cache ad hoc jobs of runs in memory, so looking them up won't block.
+        self.jobs.preload(self.run_store.get_job_ids())
 
         self.scheduled = ScheduledRuns(db.clock_db, self._wait)
         self.outputs = OutputStore(db.output_db)
@@ -184,6 +189,15 @@ class Apsis:
         # Start a task to retire old runs.
         self.__tasks.add("retire_loop", _retire_loop(self))
 
+        # Start a task to persist run changes periodically.
+        self.__tasks.add("flush_loop", _flush_loop(self))
+
+        # Start a task to checkpoint runs periodically.
+        self.__tasks.add("checkpoint_loop", _checkpoint_loop(self))
+
+        # Start a task to bind runs that are due soon.
+        self.__tasks.add("bind_loop", _bind_loop(self))
+
         # We're running now.
         self.running_flag.set()
 
@@ -192,6 +206,10 @@ class Apsis:
         """
         Starts waiting for `run`.
         """
+        # Bind the run now, if this wasn't done when it was scheduled.
+        if not self.__bind_run(run):
+            return
+
         if len(run.conds) == 0:
             # No conditions to wait for.  Start immediately.
             self._start(run)
@@ -251,37 +269,81 @@ class Apsis:
         """
         Prepares a run for schedule or restore, using its job.
 
-        The run must already be in the run DB.
+        The run must already be in the run DB.  Doesn't bind the run's program
+        and conditions, which is deferred until the run is due.
+
+        On failure, transitions the run to error and returns false.
+        """
+        try:
+            job = self._validate_run(run)
+        except Exception as exc:
+            self._run_exc(run, message=str(exc))
+            return False
+
+        # Attach job labels to the run.
+        if run.meta.get("labels") is None:
+            run.meta["labels"] = job.meta.get("labels", [])
+
+        return True
+
+
+    def __bind_run(self, run):
+        """
+        Binds the program and conditions of `run` from its job, if not already
+        bound.
 
         On failure, transitions the run to error and returns false.
         """
+        if run.program is not None and run.conds is not None:
+            return True
+
         try:
             job = self._validate_run(run)
         except Exception as exc:
             self._run_exc(run, message=str(exc))
             return False
 
-        if run.program is None:
+        program = run.program
+        if program is None:
             try:
-                run.program = job.program.bind(get_bind_args(run))
+                program = job.program.bind(get_bind_args(run))
             except Exception as exc:
                 self._run_exc(run, message=f"invalid program: {exc}")
                 return False
 
-        if run.conds is None:
+        conds = run.conds
+        if conds is None:
             try:
-                run.conds = [ c.bind(run, self.jobs) for c in job.conds ]
+                conds = [ c.bind(run, self.jobs) for c in job.conds ]
             except Exception as exc:
                 self._run_exc(run, message=f"invalid condition: {exc}")
                 return False
 
-        # Attach job labels to the run.
-        if run.meta.get("labels") is None:
-            run.meta["labels"] = job.meta.get("labels", [])
-
+        run._update(program=program, conds=conds)
         return True
 
 
+    def _bind_due_runs(self, time):
+        """
+        Binds scheduled runs with schedule time before `time`.
+        """
+        _, runs = self.run_store.query(state=State.scheduled)
+        runs = [
+            r for r in runs
+            if r.times["schedule"] < time
+            and (r.program is None or r.conds is None)
+        ]
+        for run in runs:
+            if self.__bind_run(run):
+                self.run_store.update(run, now())
+            else:
+                # The run is now in error, but still on the schedule; take it
+                # off so the scheduled loop doesn't try to start it.
+                self.scheduled.unschedule(run)
+        if len(runs) > 0:
+            log.debug(f"bound {len(runs)} scheduled runs")
+
+
     def __start_actions(self, run):
         """
         Starts configured actions on `run` as tasks.
@@ -321,12 +383,13 @@ class Apsis:
             run to error if an action fails.
             """
             try:
-                await action(self, snapshot)
+                await action(self, await snapshot)
             except Exception:
                 self.run_log.exc(run, "action")
 
         # The actions run in tasks and the run may transition again soon, so
-        # hand the actions a snapshot instead.
+        # hand the actions a snapshot instead.  The snapshot captures the run
+        # now, but loads outputs from the database in the background.
         snapshot = snapshot_run(self, run)
 
         for action in actions:
@@ -355,7 +418,12 @@ class Apsis:
             )
             # FIXME: For now, use the name "output" as this is the only one
             # the UIs render.  In the future, change to "traceback".
-            self._update_output_data(run, {"output": output}, persist=True)
+            if run.state in {State.starting, State.running}:
+                self._update_output_data(run, {"output": output}, persist=True)
+            else:
+                # The run hasn't started, for instance if it failed to bind,
+                # so nobody is following its output yet.
+                self.outputs.write_through(run.run_id, "output", output)
 
         self._transition(
             run, State.error,
@@ -416,7 +484,7 @@ class Apsis:
 
         # A run is no longer expected once it is no longer scheduled.
         if run.expected and state not in {State.new, State.scheduled}:
-            self.__db.run_log_db.flush(run.run_id)
+            self.__db.run_log_db.persist(run.run_id)
             run.expected = False
 
         # Update metadata.  Don't persist; will persist with the run.
@@ -430,7 +498,7 @@ class Apsis:
 
         # Publish to run update subscribers.
         if run_id in self.run_update_publisher:
-            msg = {"run": run_to_summary_jso(run)}
+            msg = {"run": run_to_summary_json(run)}
             self.run_update_publisher.publish(run_id, msg)
         # Publish to summary subscribers.
         self.summary_publisher.publish(messages.make_run_transition(run))
@@ -495,6 +563,10 @@ class Apsis:
             self._wait(run)
             return run
         else:
+            # Bind the run now, if it's due soon.
+            bind_lead = get_cfg(self.cfg, "schedule.bind_lead", 0)
+            if time < now() + bind_lead and not self.__bind_run(run):
+                return run
             self.run_log.record(run, f"scheduled: {time}")
             self._transition(run, State.scheduled, times={"schedule": time})
             await self.scheduled.schedule(time, run)
@@ -561,13 +633,13 @@ class Apsis:
             self.run_log.info(run, f"marked as {state.name}")
 
 
-    def get_run_log(self, run_id):
+    async def get_run_log(self, run_id):
         """
         Returns the run log for a run.
         """
         # Make sure the run ID is valid.
         self.run_store.get(run_id)
-        return self.__db.run_log_db.query(run_id=run_id)
+        return await self.__db.run_log_db.query(run_id=run_id)
 
 
     async def rerun(self, run, *, time=None):
@@ -612,6 +684,12 @@ class Apsis:
         await self.__wait_tasks.cancel_all()
         await self.__run_tasks.cancel_all()
         await self.__tasks.cancel_all()
+        await self.run_store.flush()
+        await self.run_log.flush()
+        try:
+            await self.run_store.checkpoint()
+        except Exception:
+            log.error("checkpoint failed", exc_info=True)
         log.info("Apsis shut down")
 
 
@@ -649,6 +727,9 @@ class Apsis:
             "len_runlogdb_cache"    : len(self.__db.run_log_db._RunLogDB__cache),
             "scheduled"             : self.scheduled.get_stats(),
             "run_store"             : self.run_store.get_stats(),
+            "run_db"                : self.__db.run_db.get_stats(),
+            "job_db"                : self.__db.job_db.get_stats(),
+            "run_log_db"            : self.__db.run_log_db.get_stats(),
             "outputs"               : self.outputs.get_stats(),
             "summary_publisher"     : self.summary_publisher.get_stats(),
         }
@@ -769,7 +850,8 @@ async def _maybe_compress(outputs, *, compression="br", min_size=16384):
         if output.compression is None and output.metadata.length >= min_size:
             # Compress the output.
             try:
-                compressed = await compress_async(output.data, compression)
+                compressed = await compress_async(
+                    flatten(output.data), compression)
             except RuntimeError as exc:
                 log.error(f"{exc}; not compressiong")
                 return output
@@ -790,6 +872,10 @@ async def _process_updates(apsis, run, updates):
 
     try:
         if run.state == State.starting:
+            # The starting state must be persisted before the program starts:
+            # on restore, a starting run is assumed to possibly have started.
+            # The program doesn't start until we request the first update.
+            await apsis.run_store.flush()
             update = await anext(updates)
             match update:
                 case ProgramRunning() as running:
@@ -961,7 +1047,7 @@ async def reload_jobs(apsis, *, dry_run=False):
 
         # Use the new jobs, including for scheduling.
         apsis.jobs = Jobs(jobs1, job_db)
-        apsis.scheduler.set_jobs(apsis.jobs)
+        apsis.scheduler.set_jobs(apsis.jobs, rem_ids | add_ids | chg_ids)
 
         # Reschedule runs.
         for job_id in add_ids:
@@ -983,6 +1069,57 @@ async def reload_jobs(apsis, *, dry_run=False):
     return rem_ids, add_ids, chg_ids
 
 
+async def _flush_loop(apsis):
+    """
+    Periodically persists pending run changes and run log records.
+    """
+    interval = get_cfg(apsis.cfg, "runs.flush_interval", 0.1)
+    log.info(f"starting flush loop; interval {interval} s")
+
+    while True:
+        try:
+            await apsis.run_store.flush()
+            await apsis.run_log.flush()
+        except Exception:
+            # Pending runs and records are requeued; we'll try again.
+            log.error("flush failed", exc_info=True)
+
+        await asyncio.sleep(interval)
+
+
+async def _checkpoint_loop(apsis):
+    """
+    Periodically writes a checkpoint of runs, for faster restarts.
+    """
+    interval = get_cfg(apsis.cfg, "runs.checkpoint_interval", 600)
+    log.info(f"starting checkpoint loop; interval {interval} s")
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await apsis.run_store.checkpoint()
+        except Exception:
+            log.error("checkpoint failed", exc_info=True)
+
+
+async def _bind_loop(apsis):
+    """
+    Periodically binds scheduled runs due within `schedule.bind_lead`.
+    """
+    bind_lead = get_cfg(apsis.cfg, "schedule.bind_lead", 0)
+    if not bind_lead > 0:
+        log.info("no schedule.bind_lead in config; no bind loop")
+        return
+    log.info(f"starting bind loop; lead {bind_lead} s")
+
+    while True:
+        try:
+            apsis._bind_due_runs(now() + bind_lead)
+        except Exception:
+            log.error("bind failed", exc_info=True)
+        await asyncio.sleep(60)
+
+
 async def _retire_loop(apsis):
     """
     Periodically retires runs older than `runs.lookback`.
@@ -183,7 +183,12 @@ def print_run(run, con, *, verbosity=0, run_log=None, similar_runs=None):
     elapsed = "" if elapsed is None else format_duration(elapsed)
 
     header("Program")
-    con.print(format_program(run["program"], verbosity=verbosity))
+    program = run["program"]
+    if program is None:
+        # Not bound yet, until the run is due.
+        con.print("not yet bound")
+    else:
+        con.print(format_program(program, verbosity=verbosity))
 
     # Format conds.
     header("Conditions")
@@ -105,9 +105,8 @@ class Dependency(RunStoreCondition):
 
     async def wait(self, run_store):
         # Wait for a matching run to transition into a matching state.
-        with run_store.publisher.subscription(predicate=lambda m:
-                m.job_id == self.job_id
-                and m.args == self.args
+        with run_store.publisher.subscription(
+                topic=Instance(self.job_id, self.args)
         ) as sub:
             while True:
                 # Look for matching runs.
@@ -107,28 +107,27 @@ class BoundMaxRunning(NonmonotonicRunStoreCondition):
         )
 
 
+    STATES = (State.starting, State.running)
+
     def check(self, run_store):
         # Count running jobs.
-        _, running = run_store.query(
-            job_id  =self.__job_id,
-            args    =self.__args,
-            state   =(State.starting, State.running),
-        )
-        count = len(list(running))
+        inst = Instance(self.__job_id, self.__args)
+        count = run_store.count(inst, self.STATES)
         log.debug(f"found {count} running")
         return count < self.__count
 
 
     async def wait(self, run_store):
-        # Set up a subscription to run transitions matching the job ID and args.
-        with run_store.publisher.subscription(predicate=lambda m:
-                m.job_id == self.__job_id
-                and m.args == self.__args
-        ) as sub:
-            while (result := self.check(run_store)) is False:
-                # Wait until a relevant run transitions, then check again.
-                await anext(sub)
-        return result
+        inst = Instance(self.__job_id, self.__args)
+        retry = False
+        while True:
+            # Wait in line until a slot is free, then check again.  If the
+            # slot was taken, wait again at the front of the line.
+            await run_store.wait_slot(
+                inst, self.STATES, self.__count, retry=retry)
+            if (result := self.check(run_store)) is not False:
+                return result
+            retry = True
 
 
 
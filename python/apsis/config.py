@@ -46,6 +46,35 @@ def check(cfg, base_path: Path):
     _check_duration("procstar.agent.run.update_interval")
     _check_duration("procstar.agent.run.output_interval")
 
+    def _check_interval(path, default):
+        # Falls back to the default if missing, null, or not positive.
+        *parents, name = path.split(".")
+        section = cfg
+        for parent in parents:
+            section = section.setdefault(parent, {})
+        interval = nparse_duration(section.get(name))
+        if interval is not None and interval <= 0:
+            log.error(f"non-positive {path}: {interval}; using {default}")
+            interval = None
+        section[name] = default if interval is None else interval
+
+    _check_interval("runs.flush_interval", 0.1)
+    _check_interval("runs.checkpoint_interval", 600)
+
+    schedule = cfg.setdefault("schedule", {})
+    horizon = nparse_duration(schedule.get("horizon", 86400))
+    lead = schedule["lead"] = nparse_duration(schedule.get("lead"))
+    if lead is not None and not 0 < lead <= horizon:
+        log.error(f"invalid schedule.lead: {lead}; using horizon {horizon}")
+        schedule["lead"] = None
+    bind_lead = schedule["bind_lead"] = nparse_duration(
+        schedule.get("bind_lead"))
+    if bind_lead is None:
+        schedule["bind_lead"] = 0
+    elif bind_lead < 0:
+        log.error(f"negative schedule.bind_lead: {bind_lead}; using 0")
+        schedule["bind_lead"] = 0
+
     # runs_lookback → runs.lookback
     try:
         lookback = cfg["runs_lookback"]
@@ -92,6 +92,30 @@ def main():
         "state_path", metavar="PATH",
         help="state file")
 
+    #-------------------------------------------------------------
+    # command: migrate-db
+
+    def cmd_migrate_db(args):
+        def progress(step, done, total):
+            con.print(f"{step}: {done} / {total} ({100 * done / total:.0f}%)")
+
+        old_version = SqliteDB.migrate(args.db, progress=progress)
+        if old_version == apsis.sqlite.SCHEMA_VERSION:
+            con.print(f"already at schema version {old_version}")
+        else:
+            con.print(
+                f"migrated from schema version {old_version} "
+                f"to {apsis.sqlite.SCHEMA_VERSION}"
+            )
+
+
+    cmd = parser.add_command(
+        "migrate-db", cmd_migrate_db,
+        description="Migrates a DB or archive file to the current schema.")
+    cmd.add_argument(
+        "db", metavar="DBPATH", type=Path,
+        help="path to Apsis database or archive file")
+
     #-------------------------------------------------------------
     # command: reload_jobs
 
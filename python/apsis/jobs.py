@@ -1,4 +1,5 @@
 from   contextlib import suppress
+import itertools
 import logging
 import ora
 import os
@@ -12,6 +13,7 @@ from   .actions.schedule import successor_from_jso
 from   .cond import Condition
 from   .lib.json import to_array, check_schema
 from   .lib.py import tupleize, format_ctor
+from   .lib.string import WordPrefixIndex
 from   .program import Program, NoOpProgram
 from   .schedule import Schedule
 from   apsis.lib.exc import SchemaError
@@ -345,30 +347,70 @@ class Jobs:
     Combines a job dir and a job DB.
     """
 
+    # Source of generation numbers.
+    __generations = itertools.count(1)
+
     def __init__(self, jobs_dir, job_db):
         self.__jobs_dir = jobs_dir
         self.__job_db = job_db
+        # Distinguishes this set of jobs from those before and after a reload.
+        self.generation = next(self.__generations)
+        # Index of job IDs in the jobs dir, for fuzzy matching.
+        self.__job_id_index = WordPrefixIndex(
+            j.job_id for j in jobs_dir.get_jobs(ad_hoc=False))
 
 
     def get_job(self, job_id) -> Job:
+        """
+        Returns the job with `job_id`.
+
+        Blocks on the job DB for an ad hoc job that isn't cached.
+        """
         with suppress(LookupError):
             return self.__jobs_dir.get_job(job_id)
         return self.__job_db.get(job_id)
 
 
+    async def fetch_job(self, job_id) -> Job:
+        """
+        Returns the job with `job_id`, without blocking the event loop.
+        """
+        with suppress(LookupError):
+            return self.__jobs_dir.get_job(job_id)
+        return await self.__job_db.fetch(job_id)
+
+
+    def preload(self, job_ids):
+        """
+        Holds the ad hoc jobs among `job_ids`, blocking on the job DB.
+        """
+        self.__job_db.preload(
+            set(job_ids) - { j.job_id for j in self.__jobs_dir.get_jobs() })
+
+
     __getitem__ = get_job
 
 
+    def match_job_ids(self, target):
+        """
+        Returns IDs of non ad hoc jobs matching `target` by word prefixes.
+
+        See `WordPrefixIndex.match()`.
+        """
+        return self.__job_id_index.match(target)
+
+
     def get_jobs(self, *, ad_hoc=None):
         """
         :param ad_hoc:
           If true, return ad hoc jobs only; if false, return normal jobs only;
-          if none, return all jobs.
+          if none, return all jobs.  Ad hoc jobs are read from the job DB,
+          blocking; normal jobs are all in the jobs dir.
         """
         if ad_hoc is None or not ad_hoc:
             yield from self.__jobs_dir.get_jobs()
-        # FIXME: Yield only job ids we haven't seen.
-        yield from self.__job_db.query(ad_hoc=ad_hoc)
+        if ad_hoc is None or ad_hoc:
+            yield from self.__job_db.query(ad_hoc=True)
 
 
     def __get_job_id(self):
@@ -379,11 +421,31 @@ class Jobs:
         )
 
 
-    def add(self, job):
+    async def add(self, job):
+        """
+        Adds an ad hoc job, and assigns its job ID.
+
+        If an identical job exists already, reuses its job ID instead.  Either
+        way, the job ID is pinned, so that archiving doesn't remove the job
+        before its runs are in the run store; call `release()` once they are.
+        """
         assert job.job_id is None
+        job_id = await self.__job_db.find(job)
+        if job_id is not None:
+            job.job_id = job_id
+            # Hold it, so looking up the job for its runs won't block.
+            await self.__job_db.fetch(job_id, hold=True)
+            return
+
         job.job_id = self.__get_job_id()
+        self.__job_db.insert(job, pin=True)
 
-        self.__job_db.insert(job)
+
+    def release(self, job_id):
+        """
+        Releases the pin on an ad hoc job ID from `add()`.
+        """
+        self.__job_db.unpin(job_id)
 
 
 
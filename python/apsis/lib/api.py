@@ -1,17 +1,59 @@
+import asyncio
 import brotli
 import gzip
 import logging
 import sanic
+import ujson
 import zlib
 
+from   .cmpr import StreamCompressor
+from   .itr import chunks
+
 log = logging.getLogger(__name__)
 
 #-------------------------------------------------------------------------------
 
-def response_json(jso, status=200):
+class Json(str):
+    """
+    Encoded JSON text, which `dumps()` splices into its output as is.
+    """
+
+
+
+def dumps(jso) -> str:
+    """
+    Encodes `jso` as JSON, splicing in `Json` values without encoding them.
+
+    Dicts and lists are traversed in Python, so use this for the outer
+    structure of a response assembled from `Json` fragments.
+    """
+    if isinstance(jso, Json):
+        return jso
+    elif isinstance(jso, dict):
+        return "{" + ",".join(
+            ujson.dumps(str(k), escape_forward_slashes=False) + ":" + dumps(v)
+            for k, v in jso.items()
+        ) + "}"
+    elif isinstance(jso, (list, tuple)):
+        return "[" + ",".join( dumps(v) for v in jso ) + "]"
+    else:
+        return ujson.dumps(jso, escape_forward_slashes=False)
+
+
+def response_json(jso, status=200, headers=None):
     return sanic.response.json(
         jso,
-        status=status, indent=0, escape_forward_slashes=False,
+        status=status, headers=headers, indent=0, escape_forward_slashes=False,
+    )
+
+
+def response_spliced_json(jso, status=200, headers=None):
+    """
+    Like `response_json()`, but splices in `Json` values in `jso`.
+    """
+    return sanic.response.text(
+        dumps(jso),
+        status=status, headers=headers, content_type="application/json",
     )
 
 
@@ -19,6 +61,32 @@ def error(message, status=400, **kw_args):
     return response_json({"error": str(message), **kw_args}, status=status)
 
 
+def make_etag(*parts) -> str:
+    """
+    Returns a strong ETag composed of `parts`.
+    """
+    return '"' + "-".join( str(p) for p in parts ) + '"'
+
+
+def check_etag(request, etag):
+    """
+    Checks a conditional request against `etag`.
+
+    :return:
+      A 304 Not Modified response if the request's `If-None-Match` matches
+      `etag`, else none.
+    """
+    match = request.headers.get("If-None-Match")
+    if match is None:
+        return None
+    # Weak comparison, as for GET.
+    tags = { t.strip().removeprefix("W/") for t in match.split(",") }
+    if "*" in tags or etag in tags:
+        return sanic.response.empty(status=304, headers={"ETag": etag})
+    else:
+        return None
+
+
 def time_to_jso(time):
     return format(time, "%.3i")
 
@@ -79,6 +147,59 @@ def encode_response(headers, data, compression):
     return {"Content-Encoding": encoding}, data
 
 
+def select_encoding(headers, encodings):
+    """
+    Selects a content encoding for a response.
+
+    :param headers:
+      Request headers.
+    :param encodings:
+      Supported encodings, in order of preference.
+    :return:
+      The first of `encodings` the request accepts, or none for identity.
+    """
+    accept = set()
+    refused = set()
+    for part in headers.get("Accept-Encoding", "").split(","):
+        name, _, params = part.partition(";")
+        params = params.replace(" ", "")
+        try:
+            quality = float(params[2 :]) if params.startswith("q=") else 1
+        except ValueError:
+            quality = 1
+        # Zero quality means not acceptable, even if "*" is accepted.
+        (accept if quality > 0 else refused).add(name.strip())
+
+    for encoding in encodings:
+        if encoding not in refused and (encoding in accept or "*" in accept):
+            return encoding
+    return None
+
+
+async def response_stream(
+        request, parts, *,
+        content_type="application/json", encodings=("br", "gzip"),
+):
+    """
+    Streams a response from `parts` of text, compressed if accepted.
+
+    Parts are compressed in a worker thread.  The event loop may run other
+    tasks between parts, so each part should be modest in size.
+    """
+    encoding = select_encoding(request.headers, encodings)
+    headers = {} if encoding is None else {"Content-Encoding": encoding}
+    response = await request.respond(headers=headers, content_type=content_type)
+    with StreamCompressor(encoding) as compressor:
+        for part in parts:
+            data = await compressor.compress(part.encode())
+            if len(data) > 0:
+                await response.send(data)
+            # Let other tasks run between parts.
+            await asyncio.sleep(0)
+        await response.send(await compressor.finish())
+    await response.eof()
+
+
 #-------------------------------------------------------------------------------
 
 def _to_jso(obj):
@@ -117,7 +238,7 @@ def run_to_summary_jso(run):
         "run_id"        : run.run_id,
         "state"         : run.state.name,
         "times"         : { n: time_to_jso(t) for n, t in run.times.items() },
-        "labels"        : run.meta.get("labels", []),
+        "labels"        : run.labels,
     }
     if run.expected:
         jso["expected"] = run.expected
@@ -126,35 +247,132 @@ def run_to_summary_jso(run):
     return jso
 
 
-def run_to_jso(app, run, summary=False):
+def run_to_summary_json(run) -> Json:
+    """
+    Returns the encoded summary JSO of `run`.
+    """
+    json = run._summary_json_cache
+    if json is None:
+        # Cache the encoded JSO too; invalidated with the JSO.
+        json = run._summary_json_cache = Json(ujson.dumps(
+            run_to_summary_jso(run), escape_forward_slashes=False))
+    return json
+
+
+# Fields of run JSO, which may be selected with `fields`.
+RUN_FIELDS = frozenset((
+    "job_id", "args", "run_id", "state", "times", "labels", "expected",
+    "conds", "meta", "program",
+))
+
+def _run_to_fields_json(run, fields) -> Json:
+    """
+    Returns encoded JSO of `run` with only `fields`.
+    """
+    summary = run_to_summary_jso(run)
+    jso = {}
+    for field in fields:
+        match field:
+            case "conds":
+                jso[field] = _to_jsos(run.conds)
+            case "meta":
+                jso[field] = run.meta
+            case "program":
+                jso[field] = _to_jso(run.program)
+            case _:
+                try:
+                    jso[field] = summary[field]
+                except KeyError:
+                    # Optional summary field, such as "expected".
+                    pass
+    return Json(ujson.dumps(jso, escape_forward_slashes=False))
+
+
+def run_to_json(app, run, summary=False, fields=None) -> Json:
+    """
+    :param fields:
+      If not none, a sequence of field names from `RUN_FIELDS` to include;
+      `summary` is ignored.
+    """
     if run.state is None:
         # This run is being deleted.
         # FIXME: Hack.
-        return {"run_id": run.run_id, "state": None}
+        return Json(ujson.dumps({"run_id": run.run_id, "state": None}))
+
+    if fields is not None:
+        return _run_to_fields_json(run, fields)
 
-    jso = run_to_summary_jso(run)
+    json = run_to_summary_json(run)
 
     if not summary:
-        jso = {
-            **jso,
+        # Splice additional fields into the summary object.
+        rest = ujson.dumps({
             "conds": _to_jsos(run.conds),
             # FIXME: Rename to metadata.
             # FIXME: Actions.
             "meta": run.meta,
             "program": _to_jso(run.program),
-        }
+        }, escape_forward_slashes=False)
+        json = Json(json[: -1] + "," + rest[1 :])
 
-    return jso
+    return json
+
+
+def expected_inst_to_jso(time, inst):
+    """
+    Returns JSO for a virtual expected run of `inst` at schedule `time`.
+
+    The JSO resembles a run summary, but without a run ID.
+    """
+    return {
+        "job_id"        : inst.job_id,
+        "args"          : inst.args,
+        "state"         : "scheduled",
+        "times"         : {"schedule": time_to_jso(time)},
+        "expected"      : True,
+    }
 
 
 # FIXME: Remove when.
-def runs_to_jso(app, when, runs, summary=False):
+def runs_to_jso(app, when, runs, summary=False, fields=None):
+    """
+    Returns JSO for `runs`, with runs as `Json` values.  Encode it with
+    `dumps()`.
+    """
     return {
         "when": time_to_jso(when),
-        "runs": { r.run_id: run_to_jso(app, r, summary) for r in runs },
+        "runs": {
+            r.run_id: run_to_json(app, r, summary, fields)
+            for r in runs
+        },
     }
 
 
+def iter_runs_json(
+        app, when, runs, summary=False, fields=None, *, extra={},
+        chunk_size=1000,
+):
+    """
+    Generates the JSON of `runs_to_jso()` in chunks of text.
+
+    :param extra:
+      Additional top-level fields.
+    :param chunk_size:
+      Number of runs per chunk.
+    """
+    yield '{"when":' + dumps(time_to_jso(when)) + ',"runs":{'
+    sep = ""
+    for chunk in chunks(runs, chunk_size):
+        yield sep + ",".join(
+            dumps(r.run_id) + ":" + run_to_json(app, r, summary, fields)
+            for r in chunk
+        )
+        sep = ","
+    yield "}" + "".join(
+        "," + dumps(k) + ":" + dumps(v) for k, v in extra.items()
+    ) + "}"
+
+
 def run_log_record_to_jso(rec):
     return {
         "timestamp" : time_to_jso(rec["timestamp"]),
@@ -187,12 +405,14 @@ def output_to_http_message(output, *, interval=(0, None)) -> bytes:
     if output.compression is not None:
         raise ValueError("output is compressed")
 
-    return "\r\n".join([
+    header = "\r\n".join([
         f"Content-Type: {output.metadata.content_type}",
         # f"Content-Encoding: {output.compression}",
         f"Content-Range: bytes={start}-{stop - 1}/{length}",
         f"Content-Length: {str(stop - start)}",
         "", ""
-    ]).encode("ascii") + output.data[start : stop]
+    ]).encode("ascii")
+    # Slicing a rope or memory map doesn't copy the whole output.
+    return b"".join((header, output.data[start : stop]))
 
 
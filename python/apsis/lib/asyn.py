@@ -1,5 +1,8 @@
 import asyncio
+from   collections import deque
 from   contextlib import contextmanager, suppress
+import itertools
+import time
 import weakref
 
 import logging
@@ -181,14 +184,44 @@ async def communicate(proc, timeout=None):
 class Publisher:
     """
     Manages multiple filtered subscriptions to a publication stream.
+
+    A message may be published to a topic.  A subscription to a topic receives
+    only messages published to that topic; topics are dispatched by lookup, so
+    the cost of publishing doesn't depend on the number of subscriptions to
+    other topics.  A subscription without a topic receives all messages.
     """
 
     _CLOSE = object()
 
+    # Received by a subscription in place of messages it has missed.
+    RESYNC = object()
+
     def __init__(self):
-        # Current subscriptions.
+        # Current subscriptions without topics.
         self.__subs = set()
+        # Current subscriptions to topics, by topic.
+        self.__topic_subs = {}
         self.__closed = False
+        # Stats of ended subscriptions.
+        self.__high_water = 0
+        self.__num_resyncs = 0
+
+
+    # Message of a queued cell replaced by a later message.
+    _STALE = object()
+
+    class _Cell:
+        """
+        A queued message that may be dropped for a later one with the same
+        coalescing key.
+        """
+
+        __slots__ = ("key", "msg")
+
+        def __init__(self, key, msg):
+            self.key = key
+            self.msg = msg
+
 
 
     class Subscription:
@@ -196,17 +229,91 @@ class Publisher:
         Async iterable and iterator of events sent to one subscription.
 
         Iteration continues until the publisher closes.
+
+        If the queue is bounded and fills up, because the subscriber isn't
+        keeping up, the queued messages are discarded and the subscriber
+        receives `Publisher.RESYNC` instead.  Further messages are discarded
+        until the subscriber receives it.
         """
 
-        def __init__(self, predicate):
+        def __init__(self, predicate, *, max_len=None, coalesce=None):
+            """
+            :param max_len:
+              Maximum number of queued messages, or none for unbounded.
+            :param coalesce:
+              Function that returns a key for a message, or none.  A queued
+              message is dropped when a later message with the same key is
+              queued, so that the subscriber receives only the later one, in
+              the order it was published.
+            """
             self.__predicate    = predicate
+            self.__max_len      = max_len
+            self.__coalesce     = coalesce
             self.__msgs         = asyncio.Queue()
+            # Queued cells, by coalescing key.
+            self.__cells        = {}
+            # Number of queued cells that have been replaced.
+            self.__num_stale    = 0
+            # True if messages have been discarded, and RESYNC is queued.
+            self.__overflowed   = False
             self.__closed       = False
+            self.high_water     = 0
+            self.num_resyncs    = 0
 
 
         def publish(self, msg):
-            if self.__predicate is None or self.__predicate(msg):
-                self.__msgs.put_nowait(msg)
+            if self.__overflowed:
+                return
+            if not (self.__predicate is None or self.__predicate(msg)):
+                return
+
+            if self.__coalesce is not None:
+                key = self.__coalesce(msg)
+                if key is not None:
+                    cell = self.__cells.pop(key, None)
+                    if cell is not None:
+                        # Drop the queued message.  The new one is queued at
+                        # the end, after messages published in between.
+                        cell.msg = Publisher._STALE
+                        self.__num_stale += 1
+
+            len_queue = self.len_queue
+            if self.__max_len is not None and len_queue >= self.__max_len:
+                self.__overflow()
+                return
+
+            if self.__coalesce is not None and key is not None:
+                msg = self.__cells[key] = Publisher._Cell(key, msg)
+            self.__msgs.put_nowait(msg)
+            self.high_water = max(self.high_water, len_queue + 1)
+
+
+        def __overflow(self):
+            """
+            Discards queued messages, and queues `RESYNC` in their place.
+            """
+            while True:
+                try:
+                    self.__msgs.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+            self.__cells.clear()
+            self.__num_stale = 0
+            self.__msgs.put_nowait(Publisher.RESYNC)
+            self.__overflowed = True
+            self.num_resyncs += 1
+
+
+        def __unwrap(self, msg):
+            if msg is Publisher.RESYNC:
+                self.__overflowed = False
+            elif isinstance(msg, Publisher._Cell):
+                if msg.msg is Publisher._STALE:
+                    self.__num_stale -= 1
+                else:
+                    del self.__cells[msg.key]
+                msg = msg.msg
+            return msg
 
 
         def _close(self):
@@ -220,7 +327,7 @@ class Publisher:
 
         @property
         def len_queue(self):
-            return self.__msgs.qsize()
+            return self.__msgs.qsize() - self.__num_stale
 
 
         def __aiter__(self):
@@ -230,12 +337,13 @@ class Publisher:
         async def __anext__(self):
             if self.__closed:
                 raise StopAsyncIteration()
-            msg = await self.__msgs.get()
-            if msg is Publisher._CLOSE:
-                self.__closed = True
-                raise StopAsyncIteration()
-            else:
-                return msg
+            while True:
+                msg = await self.__msgs.get()
+                if msg is Publisher._CLOSE:
+                    self.__closed = True
+                    raise StopAsyncIteration()
+                elif (msg := self.__unwrap(msg)) is not Publisher._STALE:
+                    return msg
 
 
         def drain(self):
@@ -251,41 +359,71 @@ class Publisher:
                 else:
                     if msg is Publisher._CLOSE:
                         self.__closed = True
-                    else:
+                    elif (msg := self.__unwrap(msg)) is not Publisher._STALE:
                         msgs.append(msg)
             return msgs
 
 
 
     @contextmanager
-    def subscription(self, *, predicate=None):
+    def subscription(
+            self, *, predicate=None, topic=None, max_len=None, coalesce=None
+    ):
         """
         Context manager for a subscription.
 
         :param predicate:
           Predicate function to apply to published messages for inclusion in
           this subscription, or none for all messages.
+        :param topic:
+          Hashable topic to subscribe to, or none for messages to all topics.
+        :param max_len:
+          Maximum queue length; see `Subscription`.
+        :param coalesce:
+          Coalescing key function; see `Subscription`.
         """
         if not (predicate is None or callable(predicate)):
             raise TypeError("predicate must be none or callable")
 
-        subscription = self.Subscription(predicate)
+        subscription = self.Subscription(
+            predicate, max_len=max_len, coalesce=coalesce)
         # Register the subscription.
-        self.__subs.add(subscription)
+        subs = (
+            self.__subs if topic is None
+            else self.__topic_subs.setdefault(topic, set())
+        )
+        subs.add(subscription)
         if self.__closed:
             subscription._close()
         try:
             yield subscription
         finally:
             # Unregister the subscription.
-            self.__subs.remove(subscription)
+            subs.remove(subscription)
+            if topic is not None and len(subs) == 0:
+                del self.__topic_subs[topic]
+            self.__high_water = max(self.__high_water, subscription.high_water)
+            self.__num_resyncs += subscription.num_resyncs
 
 
-    def publish(self, msg):
+    def publish(self, msg, *, topic=None):
+        """
+        Publishes `msg` to subscriptions without topics, and to subscriptions
+        to `topic`, if not none.
+        """
         if self.__closed:
             raise RuntimeError("publisher is closed")
         for sub in self.__subs:
             sub.publish(msg)
+        if topic is not None:
+            for sub in self.__topic_subs.get(topic, ()):
+                sub.publish(msg)
+
+
+    def __all_subs(self):
+        yield from self.__subs
+        for subs in self.__topic_subs.values():
+            yield from subs
 
 
     def close(self):
@@ -295,29 +433,92 @@ class Publisher:
         Ends all subscriber iterations once exhausted.
         """
         if not self.__closed:
-            for sub in self.__subs:
+            for sub in self.__all_subs():
                 sub._close()
             self.__closed = True
 
 
     @property
     def num_subs(self):
-        return len(self.__subs)
+        return len(self.__subs) + sum(
+            len(s) for s in self.__topic_subs.values() )
 
 
     @property
     def len_queues(self):
-        return sum( s.len_queue for s in self.__subs )
+        return sum( s.len_queue for s in self.__all_subs() )
 
 
     def get_stats(self):
+        subs = list(self.__all_subs())
         return {
-            "num_subs"  : self.num_subs,
-            "len_queues": self.len_queues,
+            "num_subs"      : self.num_subs,
+            "num_topics"    : len(self.__topic_subs),
+            "len_queues"    : self.len_queues,
+            "max_len_queue" : max(( s.len_queue for s in subs ), default=0),
+            "high_water"    : max(
+                self.__high_water,
+                max(( s.high_water for s in subs ), default=0),
+            ),
+            "num_resyncs"   : self.__num_resyncs + sum(
+                s.num_resyncs for s in subs ),
         }
 
 
 
+class SequencedPublisher(Publisher):
+    """
+    Publisher that numbers messages and keeps recent messages.
+
+    Messages must be dicts.  Each published message is assigned the next
+    sequence number as its "seq" item.  Sequence numbers start from the current
+    time in µs, so that they increase across restarts.
+
+    A subscriber that has missed messages since a sequence number may retrieve
+    them with `get_since()`, if they're still kept.
+    """
+
+    def __init__(self, *, ring_len=65536):
+        super().__init__()
+        self.__seq = time.time_ns() // 1000
+        # The most recent messages.
+        self.__ring = deque(maxlen=ring_len)
+
+
+    @property
+    def seq(self):
+        """
+        The sequence number of the last published message.
+        """
+        return self.__seq
+
+
+    def publish(self, msg, *, topic=None):
+        self.__seq += 1
+        msg["seq"] = self.__seq
+        self.__ring.append(msg)
+        super().publish(msg, topic=topic)
+
+
+    def get_since(self, seq):
+        """
+        Returns messages published after sequence number `seq`.
+
+        :return:
+          The messages, or none if some are no longer kept, or if `seq` is
+          not a sequence number of this publisher.
+        """
+        if seq > self.__seq:
+            return None
+        ring = self.__ring
+        # Sequence numbers in the ring are consecutive.
+        start = self.__seq - len(ring)
+        if seq < start:
+            return None
+        return list(itertools.islice(ring, seq - start, None))
+
+
+
 async def anext_and_drain(subscription, time):
     """
     Awaits the next message on `subscription`, then sleeps `time`,
@@ -0,0 +1,81 @@
+"""
+Content-addressed storage of blobs in a directory.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+from   pathlib import Path
+
+log = logging.getLogger(__name__)
+
+#-------------------------------------------------------------------------------
+
+class BlobStore:
+    """
+    Stores immutable blobs as files in a directory, keyed by SHA-256 hash of
+    their contents.
+
+    Identical blobs are stored once.  Blobs are never removed.
+    """
+
+    def __init__(self, path):
+        """
+        :param path:
+          Path to the store directory, which is created if necessary.
+        """
+        self.__path = Path(path)
+        self.__path.mkdir(parents=True, exist_ok=True)
+
+
+    def __get_path(self, hash):
+        # Fan out into subdirectories, to keep directories small.
+        return self.__path / hash[: 2] / hash[2 :]
+
+
+    def put(self, data) -> str:
+        """
+        Stores `data`, if it isn't stored already.
+
+        :return:
+          The blob's hash.
+        """
+        hash = hashlib.sha256(data).hexdigest()
+        path = self.__get_path(hash)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            # Write to a temporary file and rename, so that a blob file is
+            # always complete.
+            tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+            with open(tmp_path, "wb") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, path)
+            log.debug(f"stored blob {hash}: {len(data)} bytes")
+        return hash
+
+
+    def get(self, hash):
+        """
+        Returns the data for blob `hash`, memory-mapped read-only.
+
+        :return:
+          A bytes-like object.
+        :raise LookupError:
+          No blob with `hash`.
+        """
+        try:
+            file = open(self.__get_path(hash), "rb")
+        except FileNotFoundError:
+            raise LookupError(f"no blob: {hash}") from None
+        with file:
+            if os.fstat(file.fileno()).st_size == 0:
+                # Can't map an empty file.
+                return b""
+            # The mapping remains valid after the file is closed.
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+
@@ -2,6 +2,7 @@ import asyncio
 import brotli
 from   concurrent.futures import ThreadPoolExecutor
 import logging
+import zlib
 
 from   .timing import Timer
 
@@ -35,3 +36,81 @@ async def compress_async(data, compression) -> bytes:
         raise NotImplementedError(f"compression: {compression}")
 
 
+#-------------------------------------------------------------------------------
+
+def _make_compressor(compression):
+    """
+    Returns functions to compress a chunk and to finish the compressed stream.
+    """
+    match compression:
+        case None | "identity":
+            return (lambda data: data), (lambda: b"")
+        case "br":
+            compressor = brotli.Compressor(quality=3)
+            return compressor.process, compressor.finish
+        case "gzip":
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return compressor.compress, compressor.flush
+        case _:
+            raise NotImplementedError(f"compression: {compression}")
+
+
+class StreamCompressor:
+    """
+    Compresses a stream of chunks incrementally, in a worker thread.
+
+    Use as a context manager, to shut down the worker thread.
+    """
+
+    def __init__(self, compression):
+        self.__compress, self.__finish = _make_compressor(compression)
+        self.__executor = (
+            None if compression in (None, "identity")
+            else ThreadPoolExecutor(1)
+        )
+        self.__length = 0
+        self.__compressed_length = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False)
+
+
+    async def __run(self, fn, *args):
+        if self.__executor is None:
+            result = fn(*args)
+        else:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self.__executor, fn, *args)
+        self.__compressed_length += len(result)
+        return result
+
+
+    async def compress(self, data) -> bytes:
+        """
+        Compresses a chunk of `data`.
+
+        :return:
+          Compressed data, which may be empty if the compressor buffers it.
+        """
+        self.__length += len(data)
+        return await self.__run(self.__compress, data)
+
+
+    async def finish(self) -> bytes:
+        """
+        Finishes the stream.
+
+        :return:
+          The remaining compressed data.
+        """
+        result = await self.__run(self.__finish)
+        log.debug(f"compressed: {self.__length} → {self.__compressed_length}")
+        return result
+
+
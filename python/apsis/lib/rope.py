@@ -0,0 +1,136 @@
+"""
+Append-only byte strings stored as chunks.
+"""
+
+import bisect
+
+#-------------------------------------------------------------------------------
+
+class Rope:
+    """
+    An immutable byte string, stored as a sequence of chunks.
+
+    Appending with `+` returns a new rope, in constant time, that shares chunks
+    with the original.  Slicing doesn't copy, if the slice lies within a single
+    chunk.  Use `bytes()` to join the chunks.
+    """
+
+    def __init__(self, data=b""):
+        # Chunks, and cumulative end offsets of chunks.  These lists may be
+        # shared with ropes that extend this one, and are only appended to.
+        self.__chunks = []
+        self.__ends = []
+        # Number of chunks in this rope.
+        self.__count = 0
+        self.__length = 0
+        # Joined data, once computed.
+        self.__joined = None
+        if len(data) > 0:
+            self.__chunks.append(bytes(data))
+            self.__ends.append(len(data))
+            self.__count = 1
+            self.__length = len(data)
+
+
+    @classmethod
+    def __make(cls, chunks, ends, count):
+        rope = cls()
+        rope.__chunks = chunks
+        rope.__ends = ends
+        rope.__count = count
+        rope.__length = ends[count - 1] if count > 0 else 0
+        return rope
+
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(<{self.__length} bytes>)"
+
+
+    def __len__(self):
+        return self.__length
+
+
+    def __add__(self, data):
+        """
+        Returns a new rope with `data` appended.
+        """
+        if len(data) == 0:
+            return self
+        if isinstance(data, Rope):
+            data = bytes(data)
+
+        chunks, ends, count = self.__chunks, self.__ends, self.__count
+        if len(chunks) > count:
+            # This rope has already been extended; don't share chunks after it.
+            chunks = chunks[: count]
+            ends = ends[: count]
+        chunks.append(bytes(data))
+        ends.append(self.__length + len(data))
+        return self.__make(chunks, ends, count + 1)
+
+
+    def __bytes__(self):
+        if self.__joined is None:
+            count = self.__count
+            self.__joined = (
+                self.__chunks[0] if count == 1
+                else b"".join(self.__chunks[: count])
+            )
+        return self.__joined
+
+
+    def __eq__(self, other):
+        if isinstance(other, Rope):
+            other = bytes(other)
+        return bytes(self) == other
+
+
+    def __getitem__(self, index):
+        """
+        Returns a byte, or a bytes-like slice.
+
+        A slice within a single chunk is a `memoryview` of it.
+        """
+        if not isinstance(index, slice):
+            if index < 0:
+                index += self.__length
+            if not 0 <= index < self.__length:
+                raise IndexError("rope index out of range")
+            i = bisect.bisect_right(self.__ends, index, 0, self.__count)
+            return self.__chunks[i][index - self.__start(i)]
+
+        start, stop, step = index.indices(self.__length)
+        if step != 1:
+            raise ValueError("rope slice step must be 1")
+        if stop <= start:
+            return b""
+
+        # Find the chunks containing the first and last bytes.
+        i0 = bisect.bisect_right(self.__ends, start, 0, self.__count)
+        i1 = bisect.bisect_right(self.__ends, stop - 1, 0, self.__count)
+        if i0 == i1:
+            offset = self.__start(i0)
+            return memoryview(self.__chunks[i0])[start - offset : stop - offset]
+        else:
+            # Join only the parts of the chunks in the slice.
+            chunks = [ memoryview(c) for c in self.__chunks[i0 : i1 + 1] ]
+            chunks[-1] = chunks[-1][: stop - self.__start(i1)]
+            chunks[0] = chunks[0][start - self.__start(i0) :]
+            return b"".join(chunks)
+
+
+    def __start(self, i):
+        """
+        Returns the start offset of chunk `i`.
+        """
+        return 0 if i == 0 else self.__ends[i - 1]
+
+
+
+def flatten(data):
+    """
+    Returns bytes-like `data`, joining it first if it is a rope.
+    """
+    return bytes(data) if isinstance(data, Rope) else data
+
+
@@ -1,3 +1,8 @@
+import bisect
+import re
+
+#-------------------------------------------------------------------------------
+
 def prefix_match(choices, string, *, key=str):
     """
     Returns the element of `choices` of which `string` is an unambiguous prefix.
@@ -17,3 +22,81 @@ def prefix_match(choices, string, *, key=str):
         raise ValueError(f"multiple matches: {' '.join(matches)}")
 
 
+#-------------------------------------------------------------------------------
+
+WORD_SEP_REGEX = re.compile(r"[^A-Za-z0-9]")
+
+def split_words(string):
+    """
+    Returns the set of words in `string`, split on non-alphanumerics.
+    """
+    return set(WORD_SEP_REGEX.split(string))
+
+
+class WordPrefixIndex:
+    """
+    Index of strings by prefixes of their words.
+    """
+
+    def __init__(self, strings):
+        strings = frozenset(strings)
+        self.__strings = strings
+        # Map from word to the strings containing it.
+        by_word = {}
+        for string in strings:
+            for word in split_words(string):
+                by_word.setdefault(word, set()).add(string)
+        # Sorted words, and strings containing each.
+        self.__words = sorted(by_word)
+        self.__strings_by_word = [ by_word[w] for w in self.__words ]
+
+
+    def __len__(self):
+        return len(self.__strings)
+
+
+    def __contains__(self, string):
+        return string in self.__strings
+
+
+    def __get_prefix(self, prefix):
+        """
+        Returns strings containing a word that starts with `prefix`.
+        """
+        words = self.__words
+        i = bisect.bisect_left(words, prefix)
+        j = i
+        while j < len(words) and words[j].startswith(prefix):
+            j += 1
+        if j - i == 1:
+            return self.__strings_by_word[i]
+        else:
+            return set().union(*self.__strings_by_word[i : j])
+
+
+    def match(self, target):
+        """
+        Returns strings matching `target`.
+
+        A string matches if each word in `target` is a prefix of some word in
+        the string.
+        """
+        # Every string has at least one word, which an empty word prefixes.
+        prefixes = { w for w in split_words(target) if w != "" }
+        if len(prefixes) == 0:
+            return set(self.__strings)
+
+        # Intersect matches for each word, smallest first.
+        matches = sorted(
+            ( self.__get_prefix(p) for p in prefixes ),
+            key=len,
+        )
+        result = set(matches[0])
+        for m in matches[1 :]:
+            result &= m
+            if len(result) == 0:
+                break
+        return result
+
+
+
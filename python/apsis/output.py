@@ -1,5 +1,6 @@
 import logging
 
+from   .lib.rope import flatten
 from   .program import Output
 
 log = logging.getLogger(__name__)
@@ -11,6 +12,9 @@ log = logging.getLogger(__name__)
 # program can retrieve the entire output if necessaary.  Once the run
 # terminates, a single call to `write_through()` commits the output to the
 # database.
+#
+# Output data for running runs may be a `Rope`, so that programs may extend it
+# without copying.  We join it only when writing through.
 
 class OutputStore:
     """
@@ -36,11 +40,16 @@ class OutputStore:
             if len(outputs) == 0:
                 del self.__outputs[run_id]
 
-        # Write to the DB.
+        if not isinstance(output.data, bytes):
+            output = Output(
+                output.metadata, flatten(output.data), output.compression)
+
+        # Write to the DB, in the background.  Reads from the DB are queued
+        # behind the write, so they see it.
         self.__output_db.upsert(run_id, output_id, output)
 
 
-    def get_metadata(self, run_id):
+    async def get_metadata(self, run_id):
         try:
             # Check cache first.
             outputs = self.__outputs[run_id]
@@ -48,14 +57,14 @@ class OutputStore:
             return { i: o.metadata for i, o in outputs.items() }
         except KeyError:
             # Not in cache; go to database.
-            return self.__output_db.get_metadata(run_id)
+            return await self.__output_db.get_metadata(run_id)
 
 
-    def get_output(self, run_id, output_id) -> Output:
+    async def get_output(self, run_id, output_id) -> Output:
         try:
             return self.__outputs[run_id][output_id]
         except KeyError:
-            return self.__output_db.get_output(run_id, output_id)
+            return await self.__output_db.get_output(run_id, output_id)
 
 
     def get_stats(self) -> dict:
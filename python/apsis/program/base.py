@@ -1,9 +1,11 @@
 from   dataclasses import dataclass
+import mmap
 
 from   apsis.lib.api import decompress
 from   apsis.lib.json import TypedJso, check_schema
 from   apsis.lib.parse import parse_duration
 from   apsis.lib.py import format_repr
+from   apsis.lib.rope import Rope, flatten
 from   apsis.lib.sys import to_signal
 from   apsis.runs import template_expand
 
@@ -42,11 +44,12 @@ class Output:
         :param metadata:
           Information about the data.
         :param data:
-          The data bytes; these may be compressed.
+          The data bytes; these may be compressed.  May also be a read-only
+          memory map of the data, or a `Rope` of uncompressed data.
         :pamam compression:
           The compresison type, or `None` for uncompressed.
         """
-        if not isinstance(data, bytes):
+        if not isinstance(data, (bytes, mmap.mmap, Rope)):
             raise TypeError("data must be bytes")
 
         self.metadata       = metadata
@@ -58,7 +61,7 @@ class Output:
         """
         Returns the output data, decompressing if necessary.
         """
-        return decompress(self.data, self.compression)
+        return decompress(flatten(self.data), self.compression)
 
 
 
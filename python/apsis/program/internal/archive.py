@@ -3,8 +3,10 @@ import logging
 import ora
 
 from   ..base import _InternalProgram, ProgramRunning, ProgramSuccess
+from   apsis.lib.itr import chunks
 from   apsis.lib.json import check_schema
 from   apsis.lib.parse import parse_duration
+from   apsis.lib.timing import Timer
 from   apsis.runs import template_expand
 
 log = logging.getLogger(__name__)
@@ -16,14 +18,22 @@ class ArchiveProgram(_InternalProgram):
     A program that archives old runs from the Apsis database to an archive
     database.
 
-    This program runs within the Apsis process, and blocks all other activities
-    while it runs.  Avoid archiving too many runs in a single invocation.
+    This program runs within the Apsis process.  It archives runs in batches on
+    the database thread, and frees space with incremental vacuum steps.  Other
+    database access waits while a batch or step runs, but proceeds between
+    them.
 
     A run must be retired before it is archived.  If it cannot be retired, it is
     skipped for archiving.
     """
 
-    def __init__(self, *, age, path, count):
+    # Default number of runs to archive in each batch.
+    BATCH = 100
+
+    # Number of pages to free in each incremental vacuum step.
+    VACUUM_PAGES = 1024
+
+    def __init__(self, *, age, path, count, batch=BATCH):
         """
         If this archive file doesn't exist, it is created automatically on
         first use; the contianing directory must exist.
@@ -35,10 +45,13 @@ class ArchiveProgram(_InternalProgram):
           Apsis database file.
         :param count:
           Maximum number of runs to archive per run of this program.
+        :param batch:
+          Number of runs to archive per batch.
         """
         self.__age = age
         self.__path = path
         self.__count = count
+        self.__batch = batch
 
 
     def __str__(self):
@@ -49,7 +62,8 @@ class ArchiveProgram(_InternalProgram):
         age = parse_duration(template_expand(self.__age, args))
         path = template_expand(self.__path, args)
         count = int(template_expand(self.__count, args))
-        return type(self)(age=age, path=path, count=count)
+        batch = int(template_expand(self.__batch, args))
+        return type(self)(age=age, path=path, count=count, batch=batch)
 
 
     @classmethod
@@ -58,7 +72,8 @@ class ArchiveProgram(_InternalProgram):
             age = pop("age")
             path = pop("path", str)
             count = pop("count", int)
-        return cls(age=age, path=path, count=count)
+            batch = pop("batch", int, cls.BATCH)
+        return cls(age=age, path=path, count=count, batch=batch)
 
 
     def to_jso(self):
@@ -67,6 +82,7 @@ class ArchiveProgram(_InternalProgram):
             "age": self.__age,
             "path": self.__path,
             "count": self.__count,
+            "batch": self.__batch,
         }
 
 
@@ -78,7 +94,13 @@ class ArchiveProgram(_InternalProgram):
         # FIXME: Private attributes.
         db = apsis._Apsis__db
 
-        run_ids = db.get_archive_run_ids(
+        # Write pending run changes, so the DB is current.
+        await apsis.run_store.flush()
+        await apsis.run_log.flush()
+
+        # Database calls run on the DB thread, to keep the event loop free.
+        run_ids = await db.thread.run(
+            db.get_archive_run_ids,
             before  =ora.now() - self.__age,
             count   =self.__count,
         )
@@ -86,19 +108,56 @@ class ArchiveProgram(_InternalProgram):
         # Make sure all runs are retired; else skip them.
         run_ids = [ r for r in run_ids if apsis.run_store.retire(r) ]
 
-        if len(run_ids) > 0:
-            # Archive these runs.
-            row_counts = db.archive(self.__path, run_ids)
-            # Also vacuum to free space.
-            db.vacuum()
-
-        else:
-            row_counts = {}
-
+        # Time spent in archive batches and vacuum steps, during which other
+        # database access waits.
+        pause_time = 0
+        max_pause = 0
+
+        def timed(fn, *args, **kw_args):
+            with Timer() as timer:
+                result = fn(*args, **kw_args)
+            return result, timer.elapsed
+
+        row_counts = {}
+        with Timer() as archive_timer:
+            for batch in chunks(run_ids, self.__batch):
+                # Archive a batch.  Keep ad hoc jobs of runs still in memory.
+                counts, elapsed = await db.thread.run(
+                    timed, db.archive, self.__path, batch,
+                    keep_job_ids=apsis.run_store.get_job_ids(),
+                )
+                pause_time += elapsed
+                max_pause = max(max_pause, elapsed)
+                for table, count in counts.items():
+                    row_counts[table] = row_counts.get(table, 0) + count
+                # Let other database access proceed.
+                await asyncio.sleep(0)
+
+        # Free space, a bit at a time.
+        with Timer() as vacuum_timer:
+            if len(run_ids) > 0:
+                while True:
+                    free, elapsed = await db.thread.run(
+                        timed, db.vacuum, pages=self.VACUUM_PAGES)
+                    pause_time += elapsed
+                    max_pause = max(max_pause, elapsed)
+                    if free == 0:
+                        break
+                    await asyncio.sleep(0)
+
+        rows = sum(row_counts.values())
         return ProgramSuccess(meta={
-            "run count" : len(run_ids),
-            "run_ids"   : run_ids,
-            "row counts": row_counts,
+            "run count"     : len(run_ids),
+            "run_ids"       : run_ids,
+            "row counts"    : row_counts,
+            "rows/s"        : (
+                rows / archive_timer.elapsed if archive_timer.elapsed > 0
+                else None
+            ),
+            "archive time"  : archive_timer.elapsed,
+            "vacuum time"   : vacuum_timer.elapsed,
+            "pause time"    : pause_time,
+            "max pause"     : max_pause,
         })
 
 
@@ -10,6 +10,7 @@ from   apsis.lib import asyn
 from   apsis.lib.json import check_schema
 from   apsis.lib.parse import nparse_duration
 from   apsis.lib.py import or_none, get_cfg
+from   apsis.lib.rope import Rope
 from   apsis.lib.sys import to_signal
 from   apsis.procstar import get_agent_server
 from   apsis.program import base
@@ -64,7 +65,13 @@ def _make_metadata(proc_id, res: dict):
 
 def _combine_fd_data(old, new):
     if old is None:
-        return new
+        # Accumulate data in a rope, so that appending doesn't copy.
+        return FdData(
+            fd      =new.fd,
+            encoding=new.encoding,
+            interval=new.interval,
+            data    =Rope(new.data),
+        )
 
     assert new.fd == old.fd
     assert new.encoding == old.encoding
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from   ora import now
 import sys
@@ -46,6 +47,13 @@ class RunLog:
             self.__publisher.publish(run.run_id, msg)
 
 
+    async def flush(self):
+        """
+        Persists all buffered run log records.
+        """
+        await asyncio.wrap_future(self.__run_log_db.flush())
+
+
     def info(self, run, message, *, timestamp=None):
         return self.record(
             run, message, timestamp=timestamp, level=logging.INFO)
@@ -1,3 +1,4 @@
+import asyncio
 from   collections.abc import Mapping, Sequence
 from   dataclasses import dataclass
 
@@ -31,18 +32,20 @@ class RunSnapshot:
 
 
 def snapshot_run(apsis, run):
+    """
+    Snapshots `run`.
+
+    Captures the run immediately, but loads its outputs in the background.
+
+    :return:
+      A future of the `RunSnapshot`, which completes when outputs are loaded.
+    """
     # Get the job, if available.
     try:
         job = apsis.jobs.get_job(run.inst.job_id)
     except KeyError:
         job = None
 
-    # Load all outputs.
-    outputs = {
-        oi: apsis.outputs.get_output(run.run_id, oi)
-        for oi in apsis.outputs.get_metadata(run.run_id)
-    }
-
     snapshot = RunSnapshot(
         run_id      =run.run_id,
         inst        =run.inst,
@@ -51,11 +54,20 @@ def snapshot_run(apsis, run):
         conds       =run.conds,
         program     =run.program,
         meta        =run.meta.copy(),
-        outputs     =outputs,
+        outputs     =None,
     )
     # FIXME: expected isn't part of the API, but we need it for now so that the
     # run log can log messages from the snapshot.
     snapshot.expected = run.expected
-    return snapshot
+
+    async def load_outputs():
+        outputs = apsis.outputs
+        snapshot.outputs = {
+            oi: await outputs.get_output(run.run_id, oi)
+            for oi in await outputs.get_metadata(run.run_id)
+        }
+        return snapshot
+
+    return asyncio.ensure_future(load_outputs())
 
 
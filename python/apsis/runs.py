@@ -1,9 +1,12 @@
-from   collections import namedtuple
+import asyncio
+import bisect
+from   collections import Counter, deque, namedtuple
 import jinja2
 import logging
 import ora
 from   ora import now, Time
 import shlex
+import ujson
 
 from   .states import State, TRANSITIONS
 from   .lib.asyn import Publisher
@@ -147,12 +150,15 @@ class Run:
         "state",
         "expected",
         "conds",
-        "program",
+        "_program",
         "times",
-        "meta",
+        "_meta",
+        "_labels",
         "message",
-        "run_state",
+        "_run_state",
         "_summary_jso_cache",
+        "_summary_json_cache",
+        "_version",
         "_rowid",
     )
 
@@ -176,13 +182,76 @@ class Run:
         self.times      = {}
         # Additional run metadata.
         self.meta       = {}
+        # Labels from meta, while meta is undecoded JSON.
+        self._labels    = None
         # User message explaining the state.
         self.message    = None
         # State information specific to the program, for a running run.
         self.run_state  = None
 
-        # Cached summary JSO object.
+        # Cached summary JSO object, and its encoded JSON.
         self._summary_jso_cache = None
+        self._summary_json_cache = None
+        # Incremented on each transition or update; used for HTTP ETags.
+        self._version = 0
+
+
+    # A run loaded from the database may hold its program, meta, and run state
+    # as JSON strings, which are decoded on first access.  None of these are
+    # ever strings otherwise.  Most runs loaded are finished, and these are
+    # rarely accessed for them.
+
+    @property
+    def program(self):
+        program = self._program
+        if isinstance(program, str):
+            from .program import Program
+            program = self._program = Program.from_jso(ujson.loads(program))
+        return program
+
+
+    @program.setter
+    def program(self, program):
+        self._program = program
+
+
+    @property
+    def meta(self):
+        meta = self._meta
+        if isinstance(meta, str):
+            meta = self._meta = ujson.loads(meta)
+        return meta
+
+
+    @meta.setter
+    def meta(self, meta):
+        self._meta = meta
+
+
+    @property
+    def labels(self):
+        """
+        The run's labels, from its meta.
+
+        Doesn't decode meta, if a run loaded from the database has not yet.
+        """
+        meta = self._meta
+        if isinstance(meta, str):
+            return self._labels
+        return meta.get("labels", [])
+
+
+    @property
+    def run_state(self):
+        run_state = self._run_state
+        if isinstance(run_state, str):
+            run_state = self._run_state = ujson.loads(run_state)
+        return run_state
+
+
+    @run_state.setter
+    def run_state(self, run_state):
+        self._run_state = run_state
 
 
     def __hash__(self):
@@ -201,9 +270,17 @@ class Run:
         return f"{self.run_id} {self.state.name} {self.inst}"
 
 
-    def _update(self, *, meta=None):
+    def _update(self, *, meta=None, program=None, conds=None):
         if meta is not None:
             self.meta = meta
+            # Discard cached JSO, which includes labels from meta.
+            self._summary_jso_cache = None
+            self._summary_json_cache = None
+        if program is not None:
+            self.program = program
+        if conds is not None:
+            self.conds = conds
+        self._version += 1
 
 
     def _transition(self, timestamp, state, *, meta={}, times={},
@@ -236,8 +313,11 @@ class Run:
         # Transition to the new state.
         self.state = state
 
-        # Discard cached JSO.  Used by run_summary_to_json().
+        # Discard cached JSO and JSON.  Used by run_to_summary_jso() and
+        # run_to_summary_json().
         self._summary_jso_cache = None
+        self._summary_json_cache = None
+        self._version += 1
 
 
 
@@ -300,7 +380,7 @@ class _RunPredicate:
         self.run_ids    = None if run_ids   is None else set(iterize(run_ids))
         self.job_id     = None if job_id    is None else job_id
         self.state      = None if state     is None else set(iterize(state))
-        self.since      = None if state     is None else ora.Time(since)
+        self.since      = None if since     is None else ora.Time(since)
         self.args       = None if args      is None else to_map(args)
         self.with_args  = None if with_args is None else to_map(with_args)
 
@@ -326,9 +406,10 @@ class RunStore:
     """
     Stores runs in memory.
 
-    This is a cache, backed by a write-through persistent run database.  New
+    This is a cache, backed by a write-behind persistent run database.  New
     runs are always added to the cache; use `retire()` to retire older runs from
-    memory.
+    memory.  Changes are persisted in batches; use `flush()` to make sure they
+    are written.
 
     - Stores runs in all states.
     - Satisfyies run queries.
@@ -339,19 +420,50 @@ class RunStore:
     def __init__(self, db, *, min_timestamp):
         self.__run_db = db.run_db
         self.__next_run_id_db = db.next_run_id_db
+        self.__checkpoint_path = db.checkpoint_path
+        # Runs older than this are not loaded into memory.
+        self.__min_timestamp = min_timestamp
+
+        # Populate cache from the checkpoint, if valid, else the database.
+        runs = (
+            None if self.__checkpoint_path is None
+            else self.__run_db.load_checkpoint(
+                self.__checkpoint_path, min_timestamp=min_timestamp)
+        )
+        if runs is None:
+            runs = self.__run_db.query(min_timestamp=min_timestamp)
+        self.__runs = {}
 
-        # Populate cache from database.
-        self.__runs = {
-            r.run_id: r
-            for r in self.__run_db.query(min_timestamp=min_timestamp)
-        }
-        # Also keep a lookup of runs by job ID.
+        # Indexes of runs by job ID, by instance, and by state.
         self.__runs_by_job = {}
-        for run in self.__runs.values():
+        self.__runs_by_inst = {}
+        self.__runs_by_state = { s: set() for s in State }
+        # Sorted `(timestamp, run_id)` keys, for queries by timestamp.
+        self.__times = []
+        # The state and timestamp by which each run is indexed, by run ID.
+        # These are the run's as of its last update.
+        self.__indexed = {}
+        # Counts of runs by state, by instance.
+        self.__counts = {}
+
+        # Waiters for fewer runs of an instance in given states, by instance.
+        # Each is a deque of `(future, states, limit)`, in FIFO order.
+        self.__slot_waiters = {}
+        # Number of waiters released but not yet resumed, by instance.
+        self.__slot_released = Counter()
+
+        for run in runs:
+            self.__runs[run.run_id] = run
             self.__runs_by_job.setdefault(run.inst.job_id, set()).add(run)
+            self.__runs_by_inst.setdefault(run.inst, set()).add(run)
+            self.__runs_by_state[run.state].add(run)
+            self.__indexed[run.run_id] = (run.state, run.timestamp)
+            self.__counts.setdefault(run.inst, Counter())[run.state] += 1
+        self.__times = sorted( (t, i) for i, (_, t) in self.__indexed.items() )
 
         # Publisher for run transitions.  Messages are `Message` objects;
-        # `state` is none if the run is removed.
+        # `state` is none if the run is removed.  Each is published to the
+        # run's instance as topic.
         self.publisher = Publisher()
 
 
@@ -368,9 +480,12 @@ class RunStore:
         log.debug(f"new run: {run}")
         self.__runs[run.run_id] = run
         self.__runs_by_job.setdefault(run.inst.job_id, set()).add(run)
+        self.__runs_by_inst.setdefault(run.inst, set()).add(run)
         self.update(run, timestamp)
         self.publisher.publish(
-            self.Message(run.run_id, run.inst.job_id, run.inst.args, run.state))
+            self.Message(run.run_id, run.inst.job_id, run.inst.args, run.state),
+            topic=run.inst,
+        )
 
 
     # FIXME: Remove timestamp.
@@ -378,18 +493,81 @@ class RunStore:
         """
         Called when `run` is changed.
 
-        Persists the run if necessary.
+        Queues the run to be persisted, if necessary.
         """
         # Make sure we know about this run.
         assert self.__runs[run.run_id] is run
 
+        self.__reindex(run)
+
         # Persist the changes, but not for expected runs.
         if not run.expected:
             self.__run_db.upsert(run)
 
         # FIXME: Separate transition() so we don't send this on updates.
         self.publisher.publish(
-            self.Message(run.run_id, run.inst.job_id, run.inst.args, run.state))
+            self.Message(run.run_id, run.inst.job_id, run.inst.args, run.state),
+            topic=run.inst,
+        )
+
+
+    async def flush(self):
+        """
+        Persists all pending run changes.
+
+        Completes once all changes so far are written.
+        """
+        await asyncio.wrap_future(self.__run_db.flush())
+
+
+    async def checkpoint(self):
+        """
+        Writes a checkpoint of runs, for faster loading on restart.
+        """
+        if self.__checkpoint_path is not None:
+            await self.__run_db.checkpoint(
+                self.__checkpoint_path,
+                lambda: list(self.__runs.values()),
+                min_timestamp=self.__min_timestamp,
+            )
+
+
+    def __unindex(self, run_id):
+        """
+        Removes `run_id` from the state and timestamp indexes.
+        """
+        try:
+            state, timestamp = self.__indexed.pop(run_id)
+        except KeyError:
+            return
+        run = self.__runs[run_id]
+        self.__runs_by_state[state].discard(run)
+        counts = self.__counts[run.inst]
+        counts[state] -= 1
+        if counts[state] == 0:
+            del counts[state]
+            if len(counts) == 0:
+                del self.__counts[run.inst]
+        times = self.__times
+        i = bisect.bisect_left(times, (timestamp, run_id))
+        assert times[i] == (timestamp, run_id)
+        del times[i]
+
+
+    def __reindex(self, run):
+        """
+        Updates the state and timestamp indexes for `run`.
+        """
+        indexed = self.__indexed.get(run.run_id)
+        if indexed == (run.state, run.timestamp):
+            return
+        self.__unindex(run.run_id)
+        self.__runs_by_state[run.state].add(run)
+        bisect.insort(self.__times, (run.timestamp, run.run_id))
+        self.__indexed[run.run_id] = (run.state, run.timestamp)
+        self.__counts.setdefault(run.inst, Counter())[run.state] += 1
+        if indexed is not None and indexed[0] != run.state:
+            self.__release_slots(run.inst)
 
 
     def remove(self, run_id, *, expected=True):
@@ -402,10 +580,18 @@ class RunStore:
         run = self.__runs[run_id]
         assert not expected or run.expected, f"can't remove run {run_id}; not expected"
 
+        self.__unindex(run_id)
         del self.__runs[run_id]
         self.__runs_by_job[run.inst.job_id].remove(run)
+        runs = self.__runs_by_inst[run.inst]
+        runs.remove(run)
+        if len(runs) == 0:
+            del self.__runs_by_inst[run.inst]
+        self.__release_slots(run.inst)
         self.publisher.publish(
-            self.Message(run.run_id, run.inst.job_id, run.inst.args, None))
+            self.Message(run.run_id, run.inst.job_id, run.inst.args, None),
+            topic=run.inst,
+        )
         return run
 
 
@@ -434,42 +620,162 @@ class RunStore:
         Only runs in a finished state are retired.  Runs are not removed from
         the database.
         """
-        old = [
-            r for r in self.__runs.values()
-            if r.timestamp < min_timestamp
-        ]
+        times = self.__times
+        end = bisect.bisect_left(times, (min_timestamp, ))
+        old = [ self.__runs[i] for _, i in times[: end] ]
         count = sum( self.retire(r.run_id) for r in old )
+        if self.__min_timestamp is None or self.__min_timestamp < min_timestamp:
+            self.__min_timestamp = min_timestamp
         log.info(f"retired {count} runs before {min_timestamp}")
 
 
+    def count(self, inst, states):
+        """
+        Returns the number of runs of `inst` in any of `states`.
+        """
+        counts = self.__counts.get(inst)
+        return 0 if counts is None else sum( counts[s] for s in states )
+
+
+    def __release_slots(self, inst):
+        """
+        Releases waiters for `inst` in FIFO order, as many as there are free
+        slots.
+        """
+        waiters = self.__slot_waiters.get(inst)
+        if waiters is None:
+            return
+        # Released waiters that haven't yet resumed may take slots.
+        released = self.__slot_released[inst]
+        while len(waiters) > 0:
+            future, states, limit = waiters[0]
+            if future.done():
+                # Cancelled.
+                waiters.popleft()
+            elif self.count(inst, states) + released < limit:
+                waiters.popleft()
+                future.set_result(None)
+                released += 1
+            else:
+                break
+        self.__slot_released[inst] = released
+        if len(waiters) == 0:
+            del self.__slot_waiters[inst]
+
+
+    def __resume_slot(self, inst):
+        released = self.__slot_released[inst] - 1
+        if released > 0:
+            self.__slot_released[inst] = released
+        else:
+            del self.__slot_released[inst]
+        # The resumed waiter may not take the slot, for instance if its run
+        # then waits for another condition or is skipped.  Once it's had a
+        # chance to, release further waiters if a slot is still free.
+        asyncio.get_running_loop().call_soon(self.__release_slots, inst)
+
+
+    async def wait_slot(self, inst, states, limit, *, retry=False):
+        """
+        Waits until fewer than `limit` runs of `inst` are in any of `states`.
+
+        Waiters are released in FIFO order, only as many as there are free
+        slots, when runs of `inst` transition.  A released waiter should check
+        the count again, as another run may have taken the slot.
+
+        :param retry:
+          If true, the caller was released already but found the slot taken,
+          and waits again at the front of the line.
+        """
+        if inst not in self.__slot_waiters and self.count(inst, states) < limit:
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        waiters = self.__slot_waiters.setdefault(inst, deque())
+        if retry:
+            waiters.appendleft((future, states, limit))
+        else:
+            waiters.append((future, states, limit))
+        self.__release_slots(inst)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                # Still queued; it's skipped when released.
+                raise
+            # Released, but cancelled before resuming.  Pass on the slot.
+            self.__resume_slot(inst)
+            self.__release_slots(inst)
+            raise
+        else:
+            self.__resume_slot(inst)
+
+
     def __contains__(self, run_id):
         return run_id in self.__runs
 
 
+    def get_job_ids(self):
+        """
+        Returns IDs of jobs of runs in the store.
+        """
+        return { i.job_id for i in self.__runs_by_inst }
+
+
     def get(self, run_id):
         run = self.__runs[run_id]
         return now(), run
 
 
-    # FIXME: Merge down.
-    def _query_filter(self, predicate):
+    def __plan(self, predicate):
         """
-        Queries using a `_RunPredicate`.
+        Returns candidate runs for `predicate`, using the most selective
+        index, and the number of candidates.
         """
         if predicate.run_ids is not None:
             # Fast path if the query is by run IDs.
-            runs = (
+            runs = [
                 r
                 for i in predicate.run_ids
                 if (r := self.__runs.get(i)) is not None
-            )
-        elif predicate.job_id is not None:
-            # Fast path if the query is by job ID.
-            runs = iter(self.__runs_by_job.get(predicate.job_id, ()))
-        else:
-            # Slow path: scan.
-            runs = self.__runs.values()
+            ]
+            return runs, len(runs)
+
+        # Full scan.
+        plans = [(self.__runs.values(), len(self.__runs))]
+
+        if predicate.job_id is not None:
+            if predicate.args is not None:
+                inst = Instance(predicate.job_id, predicate.args)
+                runs = self.__runs_by_inst.get(inst, ())
+            else:
+                runs = self.__runs_by_job.get(predicate.job_id, ())
+            plans.append((runs, len(runs)))
+
+        if predicate.state is not None:
+            runs = [ self.__runs_by_state[s] for s in predicate.state ]
+            plans.append((
+                (r for s in runs for r in s),
+                sum( len(s) for s in runs )
+            ))
 
+        if predicate.since is not None:
+            times = self.__times
+            start = bisect.bisect_left(times, (predicate.since, ))
+            plans.append((
+                (self.__runs[times[j][1]] for j in range(start, len(times))),
+                len(times) - start
+            ))
+
+        return min(plans, key=lambda p: p[1])
+
+
+    # FIXME: Merge down.
+    def _query_filter(self, predicate):
+        """
+        Queries using a `_RunPredicate`.
+        """
+        runs, _ = self.__plan(predicate)
         return now(), [ r for r in runs if predicate(r) ]
 
 
@@ -482,6 +788,23 @@ class RunStore:
         return self._query_filter(_RunPredicate(**filter_args))
 
 
+    async def query_page(self, **query_args):
+        """
+        Queries a page of runs from the run database, including runs no longer
+        in memory.
+
+        Runs that are in memory are returned in preference to runs loaded from
+        the database.
+
+        :keywords:
+          See `RunDB.query_page()`.
+        :return:
+          The runs, and the key of the next page, or none if this is the last.
+        """
+        runs, key = await self.__run_db.query_page(**query_args)
+        return [ self.__runs.get(r.run_id, r) for r in runs ], key
+
+
     def get_stats(self):
         return {
             "num_runs"      : len(self.__runs),
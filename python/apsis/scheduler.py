@@ -1,4 +1,5 @@
 import asyncio
+import heapq
 import itertools
 import logging
 from   ora import Time, now
@@ -10,6 +11,39 @@ log = logging.getLogger(__name__)
 
 #-------------------------------------------------------------------------------
 
+def _make_inst(job, sched_time, args):
+    """
+    Builds the instance of `job` for a schedule time and schedule args.
+    """
+    args = {**args, "schedule_time": sched_time}
+    args = {
+        a: str(v)
+        for a, v in args.items()
+        if a in job.params
+    }
+    # FIXME: Check that all params are satisfied by args.  If not...?
+    # FIXME: Store additional args for later expansion.
+    return Instance(job.job_id, args)
+
+
+def _make_run(job, sched_time, args):
+    """
+    Builds an expected run of `job` for a schedule time and schedule args.
+    """
+    # Runs instantiated by the scheduler are only expected; the job schedule
+    # may change before the run is started.
+    return Run(_make_inst(job, sched_time, args), expected=True)
+
+
+def _iter_insts(job, schedule, start, stop):
+    """
+    Generates (time, inst) for `schedule` of `job` between `start` and `stop`.
+    """
+    times = itertools.takewhile(lambda t: t[0] < stop, schedule(start))
+    for sched_time, args in times:
+        yield sched_time, _make_inst(job, sched_time, args)
+
+
 def get_runs_to_schedule(job, start, stop):
     """
     Builds runs to schedule for `job` between `start` and `stop`.
@@ -18,25 +52,27 @@ def get_runs_to_schedule(job, start, stop):
       Iterable of (time, run).
     """
     for schedule in job.schedules:
-        times = itertools.takewhile(lambda t: t[0] < stop, schedule(start))
-
-        for sched_time, args in times:
-            args = {**args, "schedule_time": sched_time}
-            args = {
-                a: str(v)
-                for a, v in args.items()
-                if a in job.params
-            }
-            # FIXME: Check that all params are satisfied by args.  If not...?
-            # FIXME: Store additional args for later expansion.
-            inst = Instance(job.job_id, args)
-
-            if schedule.enabled:
-                # Runs instantiated by the scheduler are only expected; the job
-                # schedule may change before the run is started.
+        if schedule.enabled:
+            for sched_time, inst in _iter_insts(job, schedule, start, stop):
                 yield sched_time, Run(inst, expected=True)
 
 
+class _Cursor:
+    """
+    Position in the schedule times of one schedule of a job.
+    """
+
+    __slots__ = ("job", "times", "generation")
+
+    def __init__(self, job, times, generation):
+        self.job        = job
+        # Iterator of remaining schedule times and args.
+        self.times      = times
+        # The job's generation when this cursor was created.
+        self.generation = generation
+
+
+
 class Scheduler:
     """
     Agent that creates and schedules new runs according to job schedules, up
@@ -57,6 +93,14 @@ class Scheduler:
         horizon = parse_duration(cfg.get("horizon", 86400))
         assert horizon > 0
 
+        # Runs are created only this far ahead; expected runs after that, up
+        # to the horizon, are virtual.
+        lead = cfg.get("lead")
+        lead = horizon if lead is None else parse_duration(lead)
+        if not 0 < lead <= horizon:
+            raise ValueError(
+                f"schedule.lead must be positive and not exceed horizon: {lead}")
+
         max_age = cfg.get("max_age")
         if max_age is not None:
             max_age = parse_duration(max_age)
@@ -73,14 +117,75 @@ class Scheduler:
         self.__stop = stop
         self.__schedule = schedule
         self.__horizon = horizon
+        self.__lead = lead
         self.__max_age = max_age
 
+        # Heap of (time, seq, cursor, args) for the next schedule time of each
+        # job schedule, or none if not built yet.
+        self.__heap = None
+        self.__seq = itertools.count()
+        # Current generation by job ID.  Heap entries with a cursor from an
+        # earlier generation are stale, and discarded when popped.
+        self.__generations = {}
+        self.__next_generation = itertools.count(1)
+
+
+    def __push(self, cursor):
+        """
+        Pushes the next schedule time of `cursor`, if any, onto the heap.
+        """
+        try:
+            time, args = next(cursor.times)
+        except StopIteration:
+            return
+        heapq.heappush(self.__heap, (time, next(self.__seq), cursor, args))
+
+
+    def __add_job(self, job):
+        """
+        Adds heap entries for schedules of `job`, from the scheduler time.
+        """
+        generation = next(self.__next_generation)
+        self.__generations[job.job_id] = generation
+        for schedule in job.schedules:
+            if schedule.enabled:
+                self.__push(_Cursor(job, schedule(self.__stop), generation))
+
 
-    def set_jobs(self, jobs):
+    def __build(self):
+        self.__heap = []
+        self.__generations.clear()
+        # Ad hoc jobs aren't scheduled from their schedules.
+        for job in self.__jobs.get_jobs(ad_hoc=False):
+            self.__add_job(job)
+        log.info(f"scheduler heap: {len(self.__heap)} schedules")
+
+
+    def set_jobs(self, jobs, job_ids=None):
         """
         Replaces the jobs object.
+
+        :param job_ids:
+          IDs of jobs that have been added, removed, or changed, or none if
+          any job may have changed.
         """
         self.__jobs = jobs
+        if self.__heap is None:
+            # Not built yet.
+            pass
+        elif job_ids is None:
+            self.__build()
+        else:
+            for job_id in job_ids:
+                # Invalidate existing heap entries.
+                self.__generations.pop(job_id, None)
+                try:
+                    job = jobs.get_job(job_id)
+                except LookupError:
+                    # Removed.
+                    continue
+                if not job.ad_hoc:
+                    self.__add_job(job)
 
 
     def get_scheduler_time(self):
@@ -90,6 +195,46 @@ class Scheduler:
         return self.__stop
 
 
+    @property
+    def horizon(self):
+        """
+        How far ahead expected runs are shown, in seconds.
+        """
+        return self.__horizon
+
+
+    def get_expected_insts(self, start, stop, *, job_id=None):
+        """
+        Generates virtual expected runs between `start` and `stop`.
+
+        These are the runs that the scheduler will create from job schedules,
+        but hasn't yet, so they start at the scheduler time.  They are computed
+        from schedules on demand, and not added anywhere.
+
+        :param job_id:
+          If not none, generates only runs of this job.
+        :return:
+          Iterable of (time, inst), in time order.
+        """
+        start = max(start, self.__stop)
+        if stop <= start:
+            return iter(())
+
+        if job_id is None:
+            jobs = self.__jobs.get_jobs(ad_hoc=False)
+        else:
+            jobs = [self.__jobs.get_job(job_id)]
+        return heapq.merge(
+            *(
+                _iter_insts(j, s, start, stop)
+                for j in jobs
+                for s in j.schedules
+                if s.enabled
+            ),
+            key=lambda i: i[0],
+        )
+
+
     async def schedule(self, stop):
         """
         Advances scheduler time to `stop` by scheduling runs.
@@ -99,9 +244,17 @@ class Scheduler:
             return
 
         log.debug(f"scheduling runs until {stop}")
-        for job in self.__jobs.get_jobs():
-            for time, run in get_runs_to_schedule(job, self.__stop, stop):
-                await self.__schedule(time, run)
+        if self.__heap is None:
+            self.__build()
+
+        while len(self.__heap) > 0 and self.__heap[0][0] < stop:
+            time, _, cursor, args = heapq.heappop(self.__heap)
+            if cursor.generation != self.__generations.get(cursor.job.job_id):
+                # The job has changed or been removed since.
+                continue
+            # Advance the cursor before scheduling, which may await.
+            self.__push(cursor)
+            await self.__schedule(time, _make_run(cursor.job, time, args))
 
         self.__stop = stop
 
@@ -118,12 +271,12 @@ class Scheduler:
 
                 if (
                         self.__max_age is not None
-                        and self.__max_age < time - self.stop
+                        and self.__max_age < time - self.__stop
                 ):
                     raise RuntimeError(
                         f"last scheduled more than {self.__max_age} s ago")
 
-                await self.schedule(time + self.__horizon)
+                await self.schedule(time + self.__lead)
                 await asyncio.sleep(60)
 
         except asyncio.CancelledError:
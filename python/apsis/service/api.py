@@ -1,21 +1,23 @@
 import asyncio
+import itertools
 import logging
 import ora
-import re
 import sanic
-import ujson
+import secrets
 from   urllib.parse import unquote, parse_qs
 import websockets
 
 from   . import messages
-from   apsis import procstar
 from   apsis.lib import asyn
 from   apsis.lib.api import (
     response_json, error, time_to_jso, to_bool, encode_response,
-    runs_to_jso, run_to_summary_jso, job_to_jso,
+    make_etag, check_etag,
+    response_spliced_json, runs_to_jso, run_to_summary_json, job_to_jso, dumps,
+    response_stream, iter_runs_json, RUN_FIELDS, expected_inst_to_jso,
     output_metadata_to_jso, run_log_to_jso, output_to_http_message
 )
 import apsis.lib.itr
+from   apsis.lib.rope import flatten
 from   apsis.lib.sys import to_signal
 from   apsis.states import to_state
 from   ..jobs import jso_to_job
@@ -29,6 +31,11 @@ WS_DRAIN_TIME = 0.5
 WS_CHUNK = 4096
 # Time to sleep between websocket messages.
 WS_CHUNK_SLEEP = 0.001
+# Max number of items queued for a websocket before the client must resync.
+WS_MAX_QUEUE = 65536
+# Included in ETags, since job generations and run versions start over in each
+# process.
+ETAG_TOKEN = secrets.token_hex(4)
 
 #-------------------------------------------------------------------------------
 
@@ -84,33 +91,15 @@ def ambiguous_job_error(request, exception):
     return error(exception, status=400)
 
 
-def match(choices, target):
+def _get_match(choices, target):
     """
-    Matches `target` to one of `choices`.
+    Returns the single choice matching `target`.
 
-    Splits the target and each choice into words.  Selects a choice such that
-    each word in the target appears as a word in the choice, at least as a
-    prefix.
-
-    :return:
-      The matching choice.
+    :raise JobLookupError:
+      No choices.
+    :raise AmbiguousJobError:
+      More than one choice.
     """
-    REGEX = re.compile(r"[^A-Za-z0-9]")
-
-    def words(target):
-        return set(REGEX.split(target))
-
-    target_words = words(target)
-
-    def match(choice):
-        choice_words = words(choice)
-        return all(
-            any( cw.startswith(sw) for cw in choice_words )
-            for sw in target_words
-        )
-
-    choices = { c for c in choices if match(c) }
-
     if len(choices) == 0:
         raise JobLookupError("no job id match: " + target)
     elif len(choices) == 1:
@@ -123,40 +112,44 @@ def match(choices, target):
         raise AmbiguousJobError("ambiguous job id: " + choices)
 
 
-def match_job_id(jobs, job_id):
+async def match_job_id(jobs, job_id):
     """
     Matches `job_id` as an exact or fuzzy match.
     """
-    # Try for an exact match first.a
+    # Try for an exact match first.
     try:
-        jobs.get_job(job_id)
+        await jobs.fetch_job(job_id)
     except LookupError:
         pass
     else:
         return job_id
 
-    # FIXME: Cache job ids (or word split job ids) to make this efficient.
-    job_ids = [ j.job_id for j in jobs.get_jobs(ad_hoc=False) ]
-    return match(job_ids, job_id)
+    return _get_match(jobs.match_job_ids(job_id), job_id)
  
 
 @API.route("/jobs/<job_id:path>")
 async def job(request, job_id):
     jobs = request.app.apsis.jobs
     try:
-        job_id = match_job_id(jobs, unquote(job_id))
+        job_id = await match_job_id(jobs, unquote(job_id))
     except LookupError:
         return error(f"no job_id {job_id}", status=404)
-    job = jobs.get_job(job_id)
-    return response_json(job_to_jso(job))
+    job = await jobs.fetch_job(job_id)
+
+    # Jobs change only when reloaded, which bumps the generation.  Ad hoc jobs
+    # never change.
+    etag = make_etag(ETAG_TOKEN, jobs.generation, job_id)
+    if (response := check_etag(request, etag)) is not None:
+        return response
+    return response_json(job_to_jso(job), headers={"ETag": etag})
 
 
 @API.route("/jobs/<job_id:path>/runs")
 async def job_runs(request, job_id):
-    job_id = match_job_id(request.app.apsis.jobs, unquote(job_id))
+    job_id = await match_job_id(request.app.apsis.jobs, unquote(job_id))
     when, runs = request.app.apsis.run_store.query(job_id=job_id)
     jso = runs_to_jso(request.app, when, runs)
-    return response_json(jso)
+    return response_spliced_json(jso)
 
 
 @API.route("/jobs")
@@ -164,6 +157,11 @@ async def jobs(request):
     """
     Returns (non ad-hoc) jobs.
     """
+    jobs    = request.app.apsis.jobs
+    etag    = make_etag(ETAG_TOKEN, jobs.generation)
+    if (response := check_etag(request, etag)) is not None:
+        return response
+
     args    = request.args
     try:
         label, = args["label"]
@@ -172,10 +170,10 @@ async def jobs(request):
 
     jso = [
         job_to_jso(j)
-        for j in request.app.apsis.jobs.get_jobs(ad_hoc=False)
+        for j in jobs.get_jobs(ad_hoc=False)
         if label is None or label in j.meta.get("labels")
     ]
-    return response_json(jso)
+    return response_json(jso, headers={"ETag": etag})
 
 
 #-------------------------------------------------------------------------------
@@ -188,14 +186,19 @@ async def run(request, run_id):
     except KeyError:
         return error(f"unknown run {run_id}", 404)
 
+    # The ETag doesn't cover "when", which clients shouldn't rely on.
+    etag = make_etag(ETAG_TOKEN, run._version)
+    if (response := check_etag(request, etag)) is not None:
+        return response
+
     jso = runs_to_jso(request.app, when, [run])
-    return response_json(jso)
+    return response_spliced_json(jso, headers={"ETag": etag})
 
 
 @API.route("/runs/<run_id>/log", methods={"GET"})
 async def run_log(request, run_id):
     try:
-        run_log = request.app.apsis.get_run_log(run_id)
+        run_log = await request.app.apsis.get_run_log(run_id)
     except KeyError:
         return error(f"unknown run {run_id}", 404)
 
@@ -234,30 +237,30 @@ async def websocket_run_updates(request, ws, run_id):
 
             # Initialize run log.
             try:
-                run_log = apsis.get_run_log(run_id)
+                run_log = await apsis.get_run_log(run_id)
             except KeyError:
                 run_log = []
 
             # Initialize output metadata.
             try:
-                outputs = apsis.outputs.get_metadata(run_id)
+                outputs = await apsis.outputs.get_metadata(run_id)
             except KeyError:
                 outputs = {}
-            await ws.send(ujson.dumps({
-                "run"       : run_to_summary_jso(run),
+            await ws.send(dumps({
+                "run"       : run_to_summary_json(run),
                 "meta"      : run.meta,
                 "run_log"   : run_log_to_jso(run_log),
                 "outputs"   : { n: o.to_jso() for n, o in outputs.items() },
             }))
 
         async for msg in subscription:
-            await ws.send(ujson.dumps(msg))
+            await ws.send(dumps(msg))
 
 
 @API.route("/runs/<run_id>/outputs", methods={"GET"})
 async def run_output_meta(request, run_id):
     try:
-        outputs = request.app.apsis.outputs.get_metadata(run_id)
+        outputs = await request.app.apsis.outputs.get_metadata(run_id)
     except KeyError:
         log.error(f"unknown run {run_id}", exc_info=True)
         return error(f"unknown run {run_id}", 404)
@@ -269,12 +272,12 @@ async def run_output_meta(request, run_id):
 @API.route("/runs/<run_id>/output/<output_id>", methods={"GET"})
 async def run_output(request, run_id, output_id):
     try:
-        output = request.app.apsis.outputs.get_output(run_id, output_id)
+        output = await request.app.apsis.outputs.get_output(run_id, output_id)
     except LookupError as exc:
         return error(exc, 404)
     else:
         headers, data = encode_response(
-            request.headers, output.data, output.compression)
+            request.headers, flatten(output.data), output.compression)
         headers["Content-Type"] = output.metadata.content_type
         return sanic.response.raw(data, headers=headers)
 
@@ -300,7 +303,7 @@ async def websocket_output_updates(request, ws, run_id, output_id):
         if start is not None:
             # Send existing outputs.
             try:
-                output = apsis.outputs.get_output(run_id, output_id)
+                output = await apsis.outputs.get_output(run_id, output_id)
             except LookupError:
                 log.warning(f"no output: {run_id} {output_id}")
             else:
@@ -311,7 +314,7 @@ async def websocket_output_updates(request, ws, run_id, output_id):
         # The run is not finished, so subscribe for live updates.
         with apsis.output_update_publisher.subscription(run_id) as sub:
             try:
-                output = apsis.outputs.get_output(run_id, output_id)
+                output = await apsis.outputs.get_output(run_id, output_id)
                 if start is not None:
                     # Send the output data up to now.
                     msg = output_to_http_message(output, interval=(start, None))
@@ -363,7 +366,7 @@ async def run_rerun(request, run_id):
     jso = runs_to_jso(request.app, ora.now(), [new_run])
     # Let UIs know to show the new run.
     jso["show_run_id"] = new_run.run_id
-    return response_json(jso)
+    return response_spliced_json(jso)
 
 
 # PUT is probably right, but run actions currently are POST only.
@@ -402,6 +405,28 @@ async def run_mark(request, run_id, state):
     return response_json({})
 
 
+def _parse_cursor(cursor):
+    """
+    Parses a page cursor into a run DB page key.
+
+    :raise ValueError:
+      `cursor` is invalid.
+    """
+    timestamp, rowid = cursor.split(",", 1)
+    return float(timestamp), int(rowid)
+
+
+def _format_cursor(key):
+    """
+    Formats a run DB page key as an opaque page cursor.
+    """
+    if key is None:
+        return None
+    else:
+        timestamp, rowid = key
+        return f"{timestamp!r},{rowid}"
+
+
 @API.route("/runs")
 async def runs(request):
     apsis = request.app.apsis
@@ -413,29 +438,102 @@ async def runs(request):
     run_id      = args.pop("run_id", None)
     job_id,     = args.pop("job_id", (None, ))
     if job_id is not None:
-        job_id  = match_job_id(apsis.jobs, job_id)
+        job_id  = await match_job_id(apsis.jobs, job_id)
     state,      = args.pop("state", (None, ))
+    if state is not None:
+        try:
+            state = to_state(state)
+        except ValueError as err:
+            return error(str(err), status=400)
     since,      = args.pop("since", (None, ))
+    until,      = args.pop("until", (None, ))
+    limit,      = args.pop("limit", (None, ))
+    cursor,     = args.pop("cursor", (None, ))
+    fields,     = args.pop("fields", (None, ))
+    if fields is not None:
+        fields  = [ f for f in fields.split(",") if f != "" ]
+        unknown = [ f for f in fields if f not in RUN_FIELDS ]
+        if len(unknown) > 0:
+            return error(f"unknown fields: {', '.join(unknown)}", 400)
 
     # Remainders are args to match, though strip off leading underscores, where
     # were added to avoid collision with fixed args.
     args = { n[1 :] if n.startswith("_") else n: a[-1] for n, a in args.items() }
 
+    if run_id is None and not (limit is None and until is None and cursor is None):
+        # Paged query, which includes older runs from the database.
+        try:
+            since   = None if since is None else ora.Time(since)
+            until   = None if until is None else ora.Time(until)
+            limit   = None if limit is None else int(limit)
+            after   = None if cursor is None else _parse_cursor(cursor)
+        except ValueError as exc:
+            return error(f"invalid query: {exc}", 400)
+
+        runs, key = await apsis.run_store.query_page(
+            job_id      =job_id,
+            state       =state,
+            with_args   =args,
+            since       =since,
+            until       =until,
+            after       =after,
+            **({} if limit is None else {"limit": limit}),
+        )
+        await response_stream(request, iter_runs_json(
+            request.app, ora.now(), runs, summary, fields,
+            extra={"next_cursor": _format_cursor(key)},
+        ))
+        return
+
     when, runs = apsis.run_store.query(
         run_ids     =run_id,
         job_id      =job_id,
-        state       =None if state is None else to_state(state),
+        state       =state,
         since       =since,
         with_args   =args,
     )
 
-    return response_json(runs_to_jso(request.app, when, runs, summary=summary))
+    # Stream the response, as it may include many runs.
+    await response_stream(
+        request, iter_runs_json(request.app, when, runs, summary, fields))
+
+
+@API.route("/expected-runs")
+async def expected_runs(request):
+    """
+    Returns virtual expected runs, which the scheduler hasn't created yet.
+    """
+    apsis = request.app.apsis
+    scheduler = apsis.scheduler
+
+    query = parse_query(request.query_string)
+    job_id = query.get("job_id")
+    if job_id is not None:
+        job_id = await match_job_id(apsis.jobs, job_id)
+    try:
+        now = ora.now()
+        since = query.get("since")
+        since = now if since is None else ora.Time(since)
+        until = query.get("until")
+        until = now + scheduler.horizon if until is None else ora.Time(until)
+        limit = int(query.get("limit", 10000))
+    except ValueError as exc:
+        return error(f"invalid query: {exc}", 400)
+
+    insts = scheduler.get_expected_insts(since, until, job_id=job_id)
+    return response_json({
+        "scheduler_time": time_to_jso(scheduler.get_scheduler_time()),
+        "runs": [
+            expected_inst_to_jso(t, i)
+            for t, i in itertools.islice(insts, limit)
+        ],
+    })
 
 
 async def _send_chunked(msgs, ws, prefix):
     # Break large sets into chunks, to avoid block for too long.
     for chunk in apsis.lib.itr.chunks(msgs, WS_CHUNK):
-        json = ujson.dumps(chunk, escape_forward_slashes=False)
+        json = "[" + ",".join( messages.encode(m) for m in chunk ) + "]"
         log.debug(f"{prefix} sending {len(chunk)} msgs, {len(json)} bytes")
         await ws.send(json)
         # Take a break, let others go.
@@ -454,46 +552,78 @@ SUMMARY_MSG_TYPES = {
     "run_transition",
 }
 
+def _summary_coalesce_key(msg):
+    """
+    Returns the run ID of a run message, by which queued messages coalesce.
+    """
+    match msg["type"]:
+        case "run_summary" | "run_transition" | "run_delete":
+            return msg["run_id"]
+        case _:
+            return None
+
+
+async def _send_resync(app, ws, prefix):
+    """
+    Sends a resync message and the full summary state.
+    """
+    # The shared snapshot is already encoded.
+    for json in app.summary_snapshot.get_chunks():
+        log.debug(f"{prefix} sending {len(json)} bytes")
+        await ws.send(json)
+        # Take a break, let others go.
+        await asyncio.sleep(WS_CHUNK_SLEEP)
+
+
 @API.websocket("/summary")
 async def websocket_summary(request, ws):
     # request.query_args doesn't work correctly for ws endpoints?
-    init = "init" in request.query_string.split("&")
+    query = parse_qs(request.query_string, keep_blank_values=True)
+    init = "init" in query
+    try:
+        since = int(query["since"][-1])
+    except (KeyError, ValueError):
+        since = None
 
     apsis = request.app.apsis
 
     addr, port = request.socket
     prefix = f"/summary {addr}:{port}:"
-    log.debug(f"{prefix} connected init={init}")
+    log.debug(f"{prefix} connected init={init} since={since}")
 
     predicate = lambda msg: msg["type"] in SUMMARY_MSG_TYPES
-    with apsis.summary_publisher.subscription(predicate=predicate) as sub:
+    with apsis.summary_publisher.subscription(
+            predicate   =predicate,
+            max_len     =WS_MAX_QUEUE,
+            coalesce    =_summary_coalesce_key,
+    ) as sub:
         try:
-            if init:
+            if since is not None:
+                # Send only messages the client missed, if we still have them.
+                msgs = apsis.summary_publisher.get_since(since)
+                if msgs is None:
+                    log.info(f"{prefix} can't resume since {since}")
+                    await _send_resync(request.app, ws, prefix)
+                else:
+                    msgs = [ m for m in msgs if predicate(m) ]
+                    await _send_chunked(msgs, ws, prefix)
+
+            elif init:
                 # Full initialization.
-                msgs = []
-
-                # Send all jobs.
-                jobs = apsis.jobs.get_jobs(ad_hoc=False)
-                msgs.extend( messages.make_job(j) for j in jobs )
-
-                # Send all procstar agent conns.
-                agent_server = procstar.get_agent_server()
-                msgs.extend(
-                    messages.make_agent_conn(c)
-                    for c in agent_server.connections.values()
-                )
-
-                # Send summaries of all runs.
-                _, runs = apsis.run_store.query()
-                msgs.extend( messages.make_run_summary(r) for r in runs )
-
-                await _send_chunked(msgs, ws, prefix)
+                await _send_resync(request.app, ws, prefix)
 
             while not sub.closed:
                 # Wait for the next msg, then grab all that show up in a short time.
                 # This avoids sending lots of short websocket traffic.
                 msgs = await asyn.anext_and_drain(sub, WS_DRAIN_TIME)
-                await _send_chunked(msgs, ws, prefix)
+                if any( m is asyn.Publisher.RESYNC for m in msgs ):
+                    # We fell behind and missed messages.  Tell the client to
+                    # discard its state, and send the full state instead.
+                    # Messages received with the resync are older.
+                    log.info(f"{prefix} resync")
+                    await _send_resync(request.app, ws, prefix)
+                else:
+                    await _send_chunked(msgs, ws, prefix)
 
             await ws.close()
 
@@ -514,32 +644,39 @@ async def run_post(request):
 
     # The run may either contain a job ID, or a complete job.
     jso = request.json
+    ad_hoc_job_id = None
     if "job" in jso:
         # A complete job.
         job = jso_to_job(jso["job"], None)
         job.ad_hoc = True
-        request.app.apsis.jobs.add(job)
-        job_id = job.job_id
+        await request.app.apsis.jobs.add(job)
+        job_id = ad_hoc_job_id = job.job_id
 
     elif "job_id" in jso:
         # Just a job ID.
-        job_id = match_job_id(apsis.jobs, jso["job_id"])
+        job_id = await match_job_id(apsis.jobs, jso["job_id"])
 
     else:
         return error("missing job_id or job")
 
-    time = jso.get("times", {}).get("schedule", "now")
-    time = None if time == "now" else ora.Time(time)
+    try:
+        time = jso.get("times", {}).get("schedule", "now")
+        time = None if time == "now" else ora.Time(time)
+
+        runs = [
+            Run(Instance(job_id, jso.get("args", {})))
+            for _ in range(count)
+        ]
+        for run in runs:
+            request.app.apsis._validate_run(run)
 
-    runs = [
-        Run(Instance(job_id, jso.get("args", {})))
-        for _ in range(count)
-    ]
-    for run in runs:
-        request.app.apsis._validate_run(run)
+        await asyncio.gather(*( apsis.schedule(time, r) for r in runs ))
+    finally:
+        if ad_hoc_job_id is not None:
+            # The runs are in the run store now, so archiving keeps the job.
+            apsis.jobs.release(ad_hoc_job_id)
 
-    await asyncio.gather(*( apsis.schedule(time, r) for r in runs ))
     jso = runs_to_jso(request.app, ora.now(), runs)
-    return response_json(jso)
+    return response_spliced_json(jso)
 
 
@@ -266,25 +266,113 @@ class Client:
         return self.__post("/api/v1/runs", run_id, "mark", state_name)
 
 
-    def get_runs(self, *, job_id=None, state=None, args={}):
+    def __get_runs(self, *, args={}, **query):
         return self.__get(
             "/api/v1/runs",
-            job_id  =job_id,
-            state   =state,
+            **query,
             # Include args, but prefix with underscore any that collide with
             # fixed arg names.
             # FIXME: Oh so hacky.
             **{
-                "_" + n if n in {"job_id", "run_id", "state", "since"} else n: a
+                "_" + n if n in {
+                    "job_id", "run_id", "state", "since", "until", "limit",
+                    "cursor", "summary", "fields",
+                } else n: a
                 for n, a in args.items()
             },
+        )
+
+
+    def get_runs(
+            self, *,
+            job_id  =None,
+            state   =None,
+            args    ={},
+            since   =None,
+            until   =None,
+            limit   =None,
+    ):
+        """
+        Returns runs matching the query.
+
+        If `until` or `limit` is given, queries the run database, including
+        runs older than the lookback, and returns only the newest `limit` runs,
+        up to the server's page size.  Use `iter_runs()` to return all runs.
+
+        :param since:
+          If not none, limits to runs with timestamp not before this time.
+        :param until:
+          If not none, limits to runs with timestamp before this time.
+        """
+        return self.__get_runs(
+            job_id  =job_id,
+            state   =state,
+            args    =args,
+            since   =since,
+            until   =until,
+            limit   =limit,
         )["runs"]
 
 
+    def iter_runs(
+            self, *,
+            job_id      =None,
+            state       =None,
+            args        ={},
+            since       =None,
+            until       =None,
+            page_size   =1000,
+    ):
+        """
+        Iterates over runs matching the query, newest first, from the run
+        database, including runs older than the lookback.
+
+        Requests runs one page at a time.
+
+        :return:
+          Iterable of run JSO.
+        """
+        cursor = None
+        while True:
+            jso = self.__get_runs(
+                job_id  =job_id,
+                state   =state,
+                args    =args,
+                since   =since,
+                until   =until,
+                limit   =page_size,
+                cursor  =cursor,
+            )
+            yield from jso["runs"].values()
+            cursor = jso["next_cursor"]
+            if cursor is None:
+                break
+
+
     def get_run(self, run_id):
         return self.__get("/api/v1/runs", run_id)["runs"][run_id]
 
 
+    def get_expected_runs(self, *, job_id=None, since=None, until=None):
+        """
+        Returns virtual expected runs, which the scheduler hasn't created yet.
+
+        :param since:
+          If not none, the start of the schedule time window; else now.
+        :param until:
+          If not none, the end of the schedule time window; else the scheduler
+          horizon.
+        :return:
+          List of run-like JSO without run IDs, in schedule time order.
+        """
+        return self.__get(
+            "/api/v1/expected-runs",
+            job_id  =job_id,
+            since   =since,
+            until   =until,
+        )["runs"]
+
+
     @asynccontextmanager
     async def get_run_updates(self, run_id, *, init=False):
         """
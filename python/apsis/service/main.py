@@ -13,6 +13,7 @@ import apsis.agent.client
 import apsis.lib.logging
 from   . import api, control, procstar
 from   . import DEFAULT_PORT
+from   .summary import SummarySnapshot
 from   ..apsis import Apsis
 from   ..jobs import load_jobs_dir, JobErrors
 from   ..lib.asyn import cancel_task
@@ -125,6 +126,8 @@ def serve(cfg, host="127.0.0.1", port=DEFAULT_PORT, debug=False):
     apsis = Apsis(cfg, jobs, db)
 
     app.apsis = apsis
+    # Shared snapshot of the summary state, for new websocket clients.
+    app.summary_snapshot = SummarySnapshot(apsis, chunk_size=api.WS_CHUNK)
     # Flag to indicate whether to restart after shutting down.
     app.restart = False
     app.running = True  # FIXME: ??  Remove?
@@ -168,6 +171,9 @@ def serve(cfg, host="127.0.0.1", port=DEFAULT_PORT, debug=False):
                 await cancel_task(restore_task, "restore", log)
                 # Shut down the Sanic web service.
                 await cancel_task(server_task, "Sanic", log)
+                # Unsubscribe the summary snapshot from the summary publisher.
+                log.info("closing summary snapshot")
+                app.summary_snapshot.close()
 
                 # Shut down Apsis and all its bits.
                 await apsis.shut_down()
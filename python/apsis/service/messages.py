@@ -1,7 +1,25 @@
-from   apsis.lib.api import job_to_jso, run_to_summary_jso
+import ujson
+
+from   apsis.lib.api import Json, job_to_jso, run_to_summary_json
 
 #-------------------------------------------------------------------------------
 
+def encode(msg) -> str:
+    """
+    Encodes `msg` as JSON.
+
+    Run summaries in messages are encoded once, when the message is made, and
+    spliced in as is, rather than encoded again for each subscriber.
+    """
+    return "{" + ",".join(
+        ujson.dumps(k) + ":" + (
+            v if isinstance(v, Json)
+            else ujson.dumps(v, escape_forward_slashes=False)
+        )
+        for k, v in msg.items()
+    ) + "}"
+
+
 def make_agent_conn(conn):
     return {
         "type"          : "agent_conn",
@@ -47,14 +65,27 @@ def make_run_delete(run):
 def make_run_summary(run):
     return {
         "type"          : "run_summary",
-        "run_summary"   : run_to_summary_jso(run),
+        "run_id"        : run.run_id,
+        "run_summary"   : run_to_summary_json(run),
     }
 
 
 def make_run_transition(run):
     return {
         "type"          : "run_transition",
-        "run_summary"   : run_to_summary_jso(run),
+        "run_id"        : run.run_id,
+        "run_summary"   : run_to_summary_json(run),
+    }
+
+
+def make_resync(seq):
+    """
+    Tells the client to discard its state.  The full state follows, as of
+    sequence number `seq`.
+    """
+    return {
+        "type"          : "resync",
+        "seq"           : seq,
     }
 
 
@@ -0,0 +1,162 @@
+"""
+Snapshot of the full summary state, shared by summary websocket clients.
+"""
+
+from   contextlib import ExitStack
+import logging
+
+from   . import messages
+from   apsis import procstar
+from   apsis.lib import asyn
+from   apsis.lib.timing import Timer
+
+log = logging.getLogger(__name__)
+
+#-------------------------------------------------------------------------------
+
+def get_summary_msgs(apsis):
+    """
+    Returns messages for the full summary state.
+    """
+    msgs = []
+
+    # All jobs.
+    jobs = apsis.jobs.get_jobs(ad_hoc=False)
+    msgs.extend( messages.make_job(j) for j in jobs )
+
+    # All procstar agent conns.
+    agent_server = procstar.get_agent_server()
+    msgs.extend(
+        messages.make_agent_conn(c)
+        for c in agent_server.connections.values()
+    )
+
+    # Summaries of all runs.
+    _, runs = apsis.run_store.query()
+    msgs.extend( messages.make_run_summary(r) for r in runs )
+
+    return msgs
+
+
+def _get_key(msg):
+    """
+    Returns the key of the item a summary message updates.
+    """
+    match msg["type"]:
+        case "job" | "job_add":
+            return ("job", msg["job"]["job_id"])
+        case "job_delete":
+            return ("job", msg["job_id"])
+        case "agent_conn":
+            return ("agent_conn", msg["conn"]["info"]["conn"]["conn_id"])
+        case "agent_conn_delete":
+            return ("agent_conn", msg["conn_id"])
+        case "run_summary" | "run_transition" | "run_delete":
+            return ("run", msg["run_id"])
+        case _:
+            return None
+
+
+class SummarySnapshot:
+    """
+    The full summary state, as pre-encoded JSON messages.
+
+    The snapshot holds one encoded message per job, agent conn, and run.  It is
+    built once, then kept up to date from summary publisher messages, so that
+    serving it to a new client doesn't encode the whole state again.
+    """
+
+    # Max number of queued updates before rebuilding from scratch.
+    MAX_QUEUE = 1048576
+
+    def __init__(self, apsis, *, chunk_size):
+        """
+        :param chunk_size:
+          Max number of messages per chunk.
+        """
+        self.__apsis = apsis
+        self.__chunk_size = chunk_size
+        self.__exit = ExitStack()
+        # Updates since we last looked.  Coalesced by item, so the queue is no
+        # longer than the number of items.
+        self.__sub = self.__exit.enter_context(
+            apsis.summary_publisher.subscription(
+                predicate   =lambda m: _get_key(m) is not None,
+                max_len     =self.MAX_QUEUE,
+                coalesce    =_get_key,
+            )
+        )
+        # Encoded messages by item key, or none if not built.
+        self.__items = None
+        # Encoded chunks, or none if out of date.
+        self.__chunks = None
+
+
+    def close(self):
+        self.__exit.close()
+
+
+    def __build(self):
+        # Updates so far are reflected in the state we're about to encode.
+        self.__sub.drain()
+        with Timer() as timer:
+            self.__items = {
+                _get_key(m): messages.encode(m)
+                for m in get_summary_msgs(self.__apsis)
+            }
+        log.info(
+            f"built summary snapshot of {len(self.__items)} items "
+            f"in {timer.elapsed:.3f} s"
+        )
+
+
+    def __update(self):
+        msgs = self.__sub.drain()
+        if any( m is asyn.Publisher.RESYNC for m in msgs ):
+            self.__items = None
+        if self.__items is None:
+            self.__build()
+            self.__chunks = None
+            return
+
+        for msg in msgs:
+            key = _get_key(msg)
+            match msg["type"]:
+                case "job_delete" | "agent_conn_delete" | "run_delete":
+                    self.__items.pop(key, None)
+                case "run_transition":
+                    # Store as a summary, as for the initial state.
+                    self.__items[key] = messages.encode({
+                        "type"          : "run_summary",
+                        "run_id"        : msg["run_id"],
+                        "run_summary"   : msg["run_summary"],
+                    })
+                case _:
+                    self.__items[key] = messages.encode({
+                        k: v for k, v in msg.items() if k != "seq" })
+        if len(msgs) > 0:
+            self.__chunks = None
+
+
+    def get_chunks(self):
+        """
+        Returns the snapshot as encoded JSON arrays of messages.
+
+        The first chunk contains only a resync message, with the sequence
+        number of the last summary message the snapshot reflects.
+
+        :return:
+          A list of JSON strings.
+        """
+        self.__update()
+        if self.__chunks is None:
+            items = list(self.__items.values())
+            n = self.__chunk_size
+            self.__chunks = [
+                "[" + ",".join(items[i : i + n]) + "]"
+                for i in range(0, len(items), n)
+            ]
+        resync = messages.make_resync(self.__apsis.summary_publisher.seq)
+        return ["[" + messages.encode(resync) + "]", *self.__chunks]
+
+
@@ -2,19 +2,31 @@
 Persistent state stored in a sqlite file.
 """
 
+import asyncio
+import brotli
+from   collections import Counter, OrderedDict
+from   concurrent.futures import ThreadPoolExecutor
 import contextlib
+import hashlib
 import logging
+import math
 import ora
+import os
 from   pathlib import Path
+import pickle
 import sqlalchemy as sa
+from   sqlalchemy.dialects import sqlite as sa_sqlite
+import sqlite3
+import threading
 import ujson
 
 from   .jobs import jso_to_job, job_to_jso
 from   .lib import itr
+from   .lib.blob import BlobStore
 from   .lib.timing import Timer
 from   .runs import Instance, Run
 from   .states import State
-from   .program import Program, Output, OutputMetadata
+from   .program import Output, OutputMetadata
 
 log = logging.getLogger(__name__)
 
@@ -47,6 +59,86 @@ def disposing(engine):
 
 METADATA = sa.MetaData()
 
+# Value of `PRAGMA auto_vacuum` for incremental auto-vacuum.
+AUTO_VACUUM_INCREMENTAL = 2
+
+# Version of the database schema, stored as the database's `user_version`.
+# For each schema change, increment this and add a migration to `MIGRATIONS`.
+SCHEMA_VERSION = 6
+
+#-------------------------------------------------------------------------------
+
+class DBThread:
+    """
+    Runs database calls on a single dedicated thread.
+
+    SQLite doesn't support concurrent use of a connection, so all database I/O
+    goes through this thread's request queue, which also keeps slow statements
+    off the event loop.  Requests run one at a time, in the order submitted.
+    """
+
+    def __init__(self):
+        self.__executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="apsis-db")
+
+
+    def submit(self, fn, *args, **kw_args):
+        """
+        Submits a call of `fn` on the database thread.
+
+        :return:
+          A `concurrent.futures.Future` of the result.
+        """
+        return self.__executor.submit(fn, *args, **kw_args)
+
+
+    @staticmethod
+    def log_exc(future, name):
+        """
+        Logs any exception from `future`, for a call nobody waits for.
+        """
+        def done(future):
+            try:
+                future.result()
+            except Exception:
+                log.error(f"DB call failed: {name}", exc_info=True)
+
+        future.add_done_callback(done)
+        return future
+
+
+    def post(self, fn, *args, **kw_args):
+        """
+        Submits a call of `fn` on the database thread, without waiting for the
+        result.  Logs any exception.
+        """
+        return self.log_exc(self.submit(fn, *args, **kw_args), fn.__qualname__)
+
+
+    def call(self, fn, *args, **kw_args):
+        """
+        Calls `fn` on the database thread, blocking for the result.
+
+        Use this only where blocking is acceptable, such as at startup.
+        """
+        return self.submit(fn, *args, **kw_args).result()
+
+
+    async def run(self, fn, *args, **kw_args):
+        """
+        Calls `fn` on the database thread, and awaits the result.
+        """
+        return await asyncio.wrap_future(self.submit(fn, *args, **kw_args))
+
+
+    def close(self):
+        """
+        Completes pending calls, and stops the thread.
+        """
+        self.__executor.shutdown(wait=True)
+
+
+
 #-------------------------------------------------------------------------------
 
 TBL_CLOCK = sa.Table(
@@ -63,9 +155,15 @@ class ClockDB:
     # We use a DB-API connection and SQL statements because it's faster than
     # the SQLAlchemy ORM.
 
-    def __init__(self, engine):
-        self.__connection = engine.connect().connection
+    # The time is cached in memory, so only setting it requires I/O.
+
+    def __init__(self, engine, thread):
+        self.__thread = thread
+        self.__connection = thread.call(lambda: engine.connect().connection)
+        self.__time = thread.call(self.__load)
 
+
+    def __load(self):
         (length, ), = self.__connection.execute("SELECT COUNT(*) FROM clock")
         if length == 0:
             time = ora.now() - ora.UNIX_EPOCH
@@ -73,19 +171,25 @@ class ClockDB:
             self.__connection.commit()
         else:
             assert length == 1
-
-
-    def get_time(self):
-        (time, ), = self.__connection.execute("SELECT time FROM clock")
+            (time, ), = self.__connection.execute("SELECT time FROM clock")
         return time + ora.UNIX_EPOCH
 
 
-    def set_time(self, time):
+    def __store(self, time):
         time -= ora.UNIX_EPOCH
         self.__connection.execute("UPDATE clock SET time = ?", (time, ))
         self.__connection.commit()
 
 
+    def get_time(self):
+        return self.__time
+
+
+    def set_time(self, time):
+        self.__time = time
+        self.__thread.post(self.__store, time)
+
+
 
 #-------------------------------------------------------------------------------
 
@@ -138,8 +242,17 @@ class RunIDDB:
             conn.connection.commit()
 
 
-    def __init__(self, engine):
+    def __init__(self, engine, thread):
         self.__engine = engine
+        self.__thread = thread
+        thread.call(self.__load)
+
+        # Start generating run IDs from the next available.
+        self.__next = self.__db_next
+
+
+    def __load(self):
+        engine = self.__engine
         self.TABLE.create(engine, checkfirst=True)
 
         with self.__engine.connect() as conn:
@@ -162,8 +275,13 @@ class RunIDDB:
             (self.__db_next, ), = rows
             log.info(f"next run ID: r{self.__db_next}")
 
-        # Start generating run IDs from the next available.
-        self.__next = self.__db_next
+
+    def __store(self, number):
+        with self.__engine.connect() as conn:
+            res = conn.connection.execute(
+                "UPDATE next_run_id SET number = ?", (number, ))
+            assert res.rowcount == 1
+            conn.connection.commit()
 
 
     def get_next_run_id(self):
@@ -174,11 +292,7 @@ class RunIDDB:
             # restart now, we'll skip over some run IDs, but that's OK; we're
             # not going to run out of them.
             self.__db_next += self.INTERVAL
-            with self.__engine.connect() as conn:
-                res = conn.connection.execute(
-                    "UPDATE next_run_id SET number = ?", (self.__db_next, ))
-                assert res.rowcount == 1
-                conn.connection.commit()
+            self.__thread.post(self.__store, self.__db_next)
 
         return run_id
 
@@ -190,48 +304,272 @@ TBL_JOBS = sa.Table(
     "jobs", METADATA,
     sa.Column("job_id"        , sa.String()       , nullable=False),
     sa.Column("job"           , sa.String()       , nullable=False),
+    sa.Column("ad_hoc"        , sa.Boolean()      , nullable=False, server_default="0"),
+    # Hash of the job, excluding its ID, for finding identical jobs.
+    sa.Column("job_hash"      , sa.String()       , nullable=True),
+    # For looking up jobs by ID.
+    sa.Index("idx_jobs_job_id", "job_id"),
+    # For querying non ad hoc jobs.
+    sa.Index("idx_jobs_ad_hoc", "ad_hoc"),
+    # For finding identical jobs.
+    sa.Index("idx_jobs_job_hash", "job_hash"),
 )
 
+def get_job_hash(jso):
+    """
+    Returns a hash of job `jso` that doesn't depend on its job ID.
+    """
+    jso = { k: v for k, v in jso.items() if k != "job_id" }
+    json = ujson.dumps(jso, sort_keys=True, escape_forward_slashes=False)
+    return hashlib.sha256(json.encode()).hexdigest()
+
+
 class JobDB:
+    """
+    Stores jobs not in the jobs dir, i.e. ad hoc jobs.
 
-    def __init__(self, engine):
+    Jobs don't change once inserted, so recently used jobs are cached in
+    memory, parsed.  Jobs that runs in memory refer to are held in memory
+    instead, regardless of the cache size, so looking them up never blocks:
+    those preloaded, inserted, or fetched with `hold`.  Archiving evicts them.
+
+    A job ID returned by `find()`, or inserted with `pin`, is pinned: archiving
+    keeps the job, even if no run refers to it, until the ID is unpinned.
+    """
+
+    # Max number of parsed jobs to cache.
+    CACHE_SIZE = 4096
+
+    def __init__(self, engine, thread):
         self.__engine = engine
+        self.__thread = thread
+        # LRU cache of parsed jobs, by job ID.
+        self.__cache = OrderedDict()
+        # Held jobs, by job ID.  These aren't in `__cache`.
+        self.__held = {}
+        # Guards `__cache` and `__held`, from which archiving evicts on the DB
+        # thread.
+        self.__lock = threading.Lock()
+        # Pin counts by job ID.  Accessed only on the DB thread, so that pins
+        # are ordered with archive batches.
+        self.__pinned = Counter()
+        self.__stats = {
+            "cache_hits"        : 0,
+            "cache_misses"      : 0,
+        }
 
 
-    def insert(self, job):
-        # FIXME: Check that the job ID doesn't exist already
+    def __cache_job(self, job, *, hold=False):
+        job_id = job.job_id
+        with self.__lock:
+            if hold or job_id in self.__held:
+                self.__held[job_id] = job
+                self.__cache.pop(job_id, None)
+            else:
+                self.__cache[job_id] = job
+                self.__cache.move_to_end(job_id)
+                while len(self.__cache) > self.CACHE_SIZE:
+                    self.__cache.popitem(last=False)
+
+
+    def evict(self, job_ids):
+        """
+        Removes `job_ids` from the cache, for instance once archived.
+        """
+        with self.__lock:
+            for job_id in job_ids:
+                self.__cache.pop(job_id, None)
+                self.__held.pop(job_id, None)
+
+
+    def get_stats(self):
+        return {
+            "len_cache"         : len(self.__cache),
+            "len_held"          : len(self.__held),
+            **self.__stats,
+        }
+
+
+    def __insert(self, job_id, job, ad_hoc, job_hash, pin):
         with self.__engine.begin() as conn:
             conn.execute(TBL_JOBS.insert().values(
-                job_id  =job.job_id,
-                job     =ujson.dumps(job_to_jso(job)),
-            ))
+                job_id=job_id, job=job, ad_hoc=ad_hoc, job_hash=job_hash))
+        if pin:
+            self.__pinned[job_id] += 1
+
+
+    def insert(self, job, *, pin=False):
+        """
+        Inserts `job`.
+
+        :param pin:
+          If true, pins the job ID; call `unpin()` to release it.
+        """
+        # FIXME: Check that the job ID doesn't exist already
+        # Runs will refer to the new job, so hold it.
+        self.__cache_job(job, hold=True)
+        jso = job_to_jso(job)
+        self.__thread.post(
+            self.__insert,
+            job.job_id, ujson.dumps(jso), job.ad_hoc, get_job_hash(jso), pin
+        )
+
+
+    def __find(self, job_hash):
+        with self.__engine.begin() as conn:
+            query = (
+                sa.select([TBL_JOBS.c.job_id])
+                .where(TBL_JOBS.c.job_hash == job_hash)
+                .limit(1)
+            )
+            rows = list(conn.execute(query))
+        if len(rows) == 0:
+            return None
+        (job_id, ), = rows
+        # Pin the job in the same DB call, so that no archive batch can remove
+        # it in between.
+        self.__pinned[job_id] += 1
+        return job_id
+
+
+    async def find(self, job):
+        """
+        Finds a stored job identical to `job` except for its job ID.
+
+        Doesn't use the cache, so that it doesn't return a job that has since
+        been archived.  Pins the job ID, if any; call `unpin()` to release it.
+
+        :return:
+          The ID of the identical job, or none.
+        """
+        return await self.__thread.run(
+            self.__find, get_job_hash(job_to_jso(job)))
+
+
+    def __unpin(self, job_id):
+        self.__pinned[job_id] -= 1
+        if self.__pinned[job_id] <= 0:
+            del self.__pinned[job_id]
+
+
+    def unpin(self, job_id):
+        """
+        Releases a pin on `job_id`.
+
+        The pin is released on the DB thread, after any archive batch already
+        submitted, which may have been submitted without the job's runs.
+        """
+        self.__thread.post(self.__unpin, job_id)
+
+
+    def get_pinned(self):
+        """
+        Returns pinned job IDs.  Call only on the DB thread.
+        """
+        return set(self.__pinned)
+
+
+    def __get_cached(self, job_id):
+        """
+        Returns the job with `job_id` if cached, else none.
+        """
+        with self.__lock:
+            job = self.__held.get(job_id) or self.__cache.get(job_id)
+        self.__stats["cache_hits" if job is not None else "cache_misses"] += 1
+        return job
 
 
     def get(self, job_id):
+        """
+        Returns the job with `job_id`, blocking on the database unless cached.
+
+        Avoid this on the event loop, except for held jobs; use `fetch()`
+        instead.
+        """
+        job = self.__get_cached(job_id)
+        if job is None:
+            job = self.__thread.call(self.__get, job_id)
+        self.__cache_job(job)
+        return job
+
+
+    async def fetch(self, job_id, *, hold=False):
+        """
+        Returns the job with `job_id`, awaiting the database unless cached.
+
+        :param hold:
+          If true, holds the job in memory.
+        """
+        job = self.__get_cached(job_id)
+        if job is None:
+            job = await self.__thread.run(self.__get, job_id)
+        self.__cache_job(job, hold=hold)
+        return job
+
+
+    def __get_many(self, job_ids):
+        jobs = []
+        with self.__engine.begin() as conn:
+            for chunk in itr.chunks(sorted(job_ids), 512):
+                query = (
+                    sa.select([TBL_JOBS.c.job_id, TBL_JOBS.c.job])
+                    .where(TBL_JOBS.c.job_id.in_(chunk))
+                )
+                jobs.extend(
+                    jso_to_job(ujson.loads(job), job_id)
+                    for job_id, job in conn.execute(query)
+                )
+        return jobs
+
+
+    def preload(self, job_ids):
+        """
+        Loads and holds jobs with `job_ids`, blocking on the database.
+
+        Job IDs not in the database are ignored.  Use this at startup, so that
+        later lookups of these jobs don't block.
+        """
+        jobs = self.__thread.call(self.__get_many, job_ids)
+        for job in jobs:
+            self.__cache_job(job, hold=True)
+        log.info(f"preloaded {len(jobs)} jobs")
+
+
+    def __get(self, job_id):
         with self.__engine.begin() as conn:
-            query = sa.select([TBL_JOBS]).where(TBL_JOBS.c.job_id == job_id)
+            query = (
+                sa.select([TBL_JOBS.c.job])
+                .where(TBL_JOBS.c.job_id == job_id)
+            )
             rows = list(conn.execute(query))
             assert len(rows) <= 1
 
             if len(rows) == 0:
                 raise LookupError(job_id)
             else:
-                (_, job), = rows
+                (job, ), = rows
                 return jso_to_job(ujson.loads(job), job_id)
 
 
     def query(self, *, ad_hoc=None):
-        query = sa.select([TBL_JOBS])
+        """
+        Returns jobs, blocking on the database.
+        """
+        return self.__thread.call(lambda: list(self.__query(ad_hoc)))
+
+
+    def __query(self, ad_hoc):
+        query = sa.select([TBL_JOBS.c.job_id, TBL_JOBS.c.job])
+        if ad_hoc is not None:
+            query = query.where(TBL_JOBS.c.ad_hoc == bool(ad_hoc))
         with self.__engine.begin() as conn:
             for job_id, job in conn.execute(query):
-                # FIXME: Filter ad hoc jobs in the query.
                 try:
                     job = jso_to_job(ujson.loads(job), job_id)
                 except Exception as exc:
                     logging.error(f"failed to load job from DB: {exc}")
                     continue
-                if ad_hoc is None or job.ad_hoc == ad_hoc:
-                    yield job
+                yield job
 
 
 
@@ -243,7 +581,9 @@ class JobDB:
 # FIXME: Split out args into a separate table?
 # FIXME: Split out instances into a separate table?
 
-# FIXME: Store int enumerals for state?
+# We store state as the integer `State` value, so the order of `State` must
+# not change.
+
 # FIMXE: Use a TIME column for 'time'?
 
 TBL_RUNS = sa.Table(
@@ -253,7 +593,7 @@ TBL_RUNS = sa.Table(
     sa.Column("timestamp"   , sa.Float()        , nullable=False),
     sa.Column("job_id"      , sa.String()       , nullable=False),
     sa.Column("args"        , sa.String()       , nullable=False),
-    sa.Column("state"       , sa.String()       , nullable=False),
+    sa.Column("state"       , sa.Integer()      , nullable=False),
     sa.Column("program"     , sa.String()       , nullable=True),
     sa.Column("times"       , sa.String()       , nullable=False),
     sa.Column("meta"        , sa.String()       , nullable=False),
@@ -261,136 +601,308 @@ TBL_RUNS = sa.Table(
     sa.Column("run_state"   , sa.String()       , nullable=True),
     sa.Column("rerun"       , sa.String()       , nullable=True),  # FIXME: Unused.
     sa.Column("expected"    , sa.Boolean()      , nullable=True),
+    # Sequence number of the flush that last wrote the run.
+    sa.Column("seq"         , sa.Integer()      , nullable=False, server_default="0"),
+    # For queries by job, such as loading runs for a job.
+    sa.Index("idx_runs_job_id_timestamp", "job_id", "timestamp"),
+    # For loading runs at startup.
+    sa.Index("idx_runs_timestamp", "timestamp"),
+    # For finding finished runs to archive.
+    sa.Index("idx_runs_state_timestamp", "state", "timestamp"),
+    # For finding runs changed since a checkpoint.
+    sa.Index("idx_runs_seq", "seq"),
 )
 
+# A single row counting runs ever deleted from the runs table, maintained by a
+# trigger, so that deletions invalidate run store checkpoints.
+TBL_RUN_DELETIONS = sa.Table(
+    "run_deletions", METADATA,
+    sa.Column("count"       , sa.Integer()      , nullable=False),
+)
+
+RUNS_DELETE_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS trg_runs_delete AFTER DELETE ON runs
+    BEGIN
+        UPDATE run_deletions SET count = count + 1;
+    END
+"""
+
+
+def _get_run_deletions(conn):
+    (count, ), = conn.execute(
+        sa.select([sa.func.coalesce(sa.func.sum(TBL_RUN_DELETIONS.c.count), 0)]))
+    return count
+
 
 class RunDB:
 
     # For runs in the database (either inserted into or loaded from), we stash
     # the sqlite rowid in the Run._rowid attribute.
 
-    def __init__(self, engine):
+    # Upserts are write-behind: `upsert()` only queues the run, and `flush()`
+    # writes all queued runs in a single transaction.  Since a run is serialized
+    # only when flushed, multiple changes to a run between flushes coalesce into
+    # a single write.
+
+    # Flush immediately once this many runs are pending.
+    MAX_PENDING = 1024
+
+    # Maximum number of runs in a page returned by `query_page()`.
+    MAX_PAGE = 1000
+
+    def __init__(self, engine, thread):
         self.__engine = engine
-        self.__connection = engine.raw_connection()
+        self.__thread = thread
+        self.__connection = thread.call(engine.raw_connection)
         # FIXME: Do we need to clean this up?
 
+        # Runs with changes not yet written, by run ID.
+        self.__pending = {}
+        # Guards `__pending`, which the DB thread requeues to if a write fails.
+        self.__lock = threading.Lock()
+        # Sequence number of the last flush.
+        self.__seq = thread.call(self.__load_seq)
+
+        self.__stats = {
+            "flush_count"       : 0,
+            "flush_rows"        : 0,
+            "flush_max_rows"    : 0,
+            "flush_latency"     : 0,
+            "flush_max_latency" : 0,
+        }
+
+
+    def __load_seq(self):
+        with self.__engine.begin() as conn:
+            (seq, ), = conn.execute(sa.select([sa.func.max(TBL_RUNS.c.seq)]))
+        return seq or 0
+
+
+    # Columns to load runs: the runs table, and labels extracted from meta,
+    # so that loading doesn't decode meta.
+    LOAD_COLUMNS = [
+        TBL_RUNS,
+        sa.func.json_extract(TBL_RUNS.c.meta, "$.labels").label("labels"),
+    ]
 
     @staticmethod
     def __query_runs(conn, expr):
-        query = sa.select([TBL_RUNS]).where(expr)
-        cursor = conn.execute(query)
-        for (
-                rowid, run_id, timestamp, job_id, args, state, program, times,
-                meta, message, run_state, _, _
-        ) in cursor:
-            if program is not None:
-                program     = Program.from_jso(ujson.loads(program))
-
-            times           = ujson.loads(times)
-            times           = { n: ora.Time(t) for n, t in times.items() }
-
-            args            = ujson.loads(args)
-            inst            = Instance(job_id, args)
-            run             = Run(inst)
-
-            run.run_id      = run_id
-            run.timestamp   = load_time(timestamp)
-            run.state       = State[state]
-            run.program     = program
-            run.times       = times
-            run.meta        = ujson.loads(meta)
-            run.message     = message
-            run.run_state   = ujson.loads(run_state)
-            run._rowid      = rowid
-            yield run
+        query = sa.select(RunDB.LOAD_COLUMNS).where(expr)
+        for row in conn.execute(query):
+            yield RunDB.__load_run(row)
 
 
-    def upsert(self, run):
-        assert run.run_id.startswith("r")
-        assert not run.expected
-        rowid = int(run.run_id[1 :])
-
-        program = (
-            None if run.program is None
-            else ujson.dumps(run.program.to_jso())
+    @staticmethod
+    def __load_run(row):
+        """
+        Loads a run from a row of `LOAD_COLUMNS`.
+        """
+        (
+            rowid, run_id, timestamp, job_id, args, state, program, times,
+            meta, message, run_state, _, _, _, labels
+        ) = row
+
+        times = ujson.loads(times)
+        return RunDB.__make_run(
+            rowid, run_id, timestamp, job_id, ujson.loads(args), state,
+            program, { n: ora.Time(t) for n, t in times.items() }, meta,
+            message, run_state,
+            [] if labels is None else ujson.loads(labels),
         )
+
+
+    @staticmethod
+    def __make_run(
+            rowid, run_id, timestamp, job_id, args, state, program, times,
+            meta, message, run_state, labels
+    ):
+        """
+        Makes a run from column values.
+
+        `program`, `meta`, and `run_state` are JSON, which the run decodes
+        lazily on first access.  `labels` are the labels in `meta`.
+        """
+        inst            = Instance(job_id, args)
+        run             = Run(inst)
+
+        run.run_id      = run_id
+        run.timestamp   = load_time(timestamp)
+        run.state       = State(state)
+        run.program     = program
+        run.times       = times
+        run.meta        = meta
+        run._labels     = labels
+        run.message     = message
+        run.run_state   = run_state
+        run._rowid      = rowid
+        return run
+
+
+    @staticmethod
+    def __to_values(run):
+        """
+        Serializes `run` to column values for the upsert statement.
+        """
+        # Reuse JSON the run hasn't decoded yet.
+        program = run._program
+        if not (program is None or isinstance(program, str)):
+            program = ujson.dumps(program.to_jso())
+        meta = run._meta
+        if not isinstance(meta, str):
+            meta = ujson.dumps(meta)
+        run_state = run._run_state
+        if not isinstance(run_state, str):
+            run_state = ujson.dumps(run_state)
         # FIXME: Precos, same as program.
 
         times = { n: str(t) for n, t in run.times.items() }
 
-        # We use SQL instead of SQLAlchemy for performance.
-        con = self.__connection.connection
-        values = (
+        return (
             run.run_id,
             dump_time(run.timestamp),
             run.inst.job_id,
             ujson.dumps(run.inst.args),
-            run.state.name,
+            run.state.value,
             program,
             ujson.dumps(times),
-            ujson.dumps(run.meta),
+            meta,
             run.message,
-            ujson.dumps(run.run_state),
-            rowid,
+            run_state,
+            int(run.run_id[1 :]),
         )
 
-        # Get the rowid; if it's missing, this run isn't in the table.
-        try:
-            run._rowid
-
-        except AttributeError:
-            # This run isn't in the database yet.
-            con.execute("""
-                INSERT INTO runs (
-                    run_id,
-                    timestamp,
-                    job_id,
-                    args,
-                    state,
-                    program,
-                    times,
-                    meta,
-                    message,
-                    run_state,
-                    rowid,
-                    expected
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
-            """, values)
-            con.commit()
-            run._rowid = values[-1]
 
-        else:
-            assert run._rowid == rowid
-            # Update the existing row.
-            changes = con.total_changes
-            con.execute("""
-                UPDATE runs SET
-                    run_id      = ?,
-                    timestamp   = ?,
-                    job_id      = ?,
-                    args        = ?,
-                    state       = ?,
-                    program     = ?,
-                    times       = ?,
-                    meta        = ?,
-                    message     = ?,
-                    run_state   = ?
-                WHERE rowid = ?
-            """, values)
-            # We should have updated one row.
-            assert con.total_changes == changes + 1
-            con.commit()
+    def upsert(self, run):
+        """
+        Queues `run` to be inserted or updated on the next flush.
+        """
+        assert run.run_id.startswith("r")
+        assert not run.expected
+        assert getattr(run, "_rowid", None) in (None, int(run.run_id[1 :]))
 
+        with self.__lock:
+            self.__pending[run.run_id] = run
+            full = len(self.__pending) >= self.MAX_PENDING
+        if full:
+            # Nobody waits for this flush, so log if it fails.  The runs are
+            # requeued, and written by a later flush.
+            self.__thread.log_exc(self.flush(), "RunDB.flush")
 
-    def get(self, run_id):
+
+    def flush(self):
+        """
+        Writes all pending runs to the database, in a single transaction.
+
+        Runs are serialized immediately, and written on the DB thread.  The
+        returned future is also a durability barrier: once it completes, all
+        runs passed to `upsert()` so far are committed.
+
+        :return:
+          A `concurrent.futures.Future` that completes when the runs have been
+          written.
+        """
+        with self.__lock:
+            runs = list(self.__pending.values())
+            self.__pending.clear()
+        if len(runs) > 0:
+            self.__seq += 1
+        values = [ (*self.__to_values(r), self.__seq) for r in runs ]
+        return self.__thread.submit(self.__write, runs, values)
+
+
+    def __write(self, runs, values):
+        if len(values) == 0:
+            # Nothing to write, but we've waited for any previous writes.
+            return
+
+        # We use SQL instead of SQLAlchemy for performance.
+        con = self.__connection.connection
+        try:
+            with Timer() as timer:
+                con.executemany("""
+                    INSERT INTO runs (
+                        run_id,
+                        timestamp,
+                        job_id,
+                        args,
+                        state,
+                        program,
+                        times,
+                        meta,
+                        message,
+                        run_state,
+                        rowid,
+                        seq,
+                        expected
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+                    ON CONFLICT (rowid) DO UPDATE SET
+                        run_id      = excluded.run_id,
+                        timestamp   = excluded.timestamp,
+                        job_id      = excluded.job_id,
+                        args        = excluded.args,
+                        state       = excluded.state,
+                        program     = excluded.program,
+                        times       = excluded.times,
+                        meta        = excluded.meta,
+                        message     = excluded.message,
+                        run_state   = excluded.run_state,
+                        seq         = excluded.seq
+                """, values)
+                con.commit()
+
+        except Exception:
+            con.rollback()
+            # Requeue the runs, unless they've been queued again since.
+            with self.__lock:
+                for run in runs:
+                    self.__pending.setdefault(run.run_id, run)
+            raise
+
+        for run in runs:
+            run._rowid = int(run.run_id[1 :])
+
+        stats = self.__stats
+        stats["flush_count"] += 1
+        stats["flush_rows"] = len(runs)
+        stats["flush_max_rows"] = max(stats["flush_max_rows"], len(runs))
+        stats["flush_latency"] = timer.elapsed
+        stats["flush_max_latency"] = max(
+            stats["flush_max_latency"], timer.elapsed)
+
+
+    def get_stats(self):
+        return {
+            "queue_depth"   : len(self.__pending),
+            **self.__stats,
+        }
+
+
+    def __get(self, run_id):
         with self.__engine.begin() as conn:
             run, = self.__query_runs(conn, TBL_RUNS.c.run_id == run_id)
         return run
 
 
+    def get(self, run_id):
+        """
+        Returns run `run_id`, blocking on the database.
+        """
+        # Write pending runs first, so the query sees them.
+        self.flush()
+        return self.__thread.call(self.__get, run_id)
+
+
+    def __query(self, where):
+        with self.__engine.begin() as conn:
+            # FIMXE: Return only the last record for each run_id?
+            return list(self.__query_runs(conn, sa.and_(*where)))
+
+
     def query(self, *, job_id=None, since=None, min_timestamp=None):
         """
+        Queries runs, blocking on the database.
+
         :param min_timestamp:
           If not none, limits to runs with timestamp not less than this.
         """
@@ -402,9 +914,9 @@ class RunDB:
         if min_timestamp is not None:
             where.append(TBL_RUNS.c.timestamp >= dump_time(min_timestamp))
 
-        with self.__engine.begin() as conn:
-            # FIMXE: Return only the last record for each run_id?
-            runs = list(self.__query_runs(conn, sa.and_(*where)))
+        # Write pending runs first, so the query sees them.
+        self.flush()
+        runs = self.__thread.call(self.__query, where)
 
         log.debug(
             f"query job_id={job_id} since={since} min_timestamp={min_timestamp}"
@@ -413,6 +925,251 @@ class RunDB:
         return runs
 
 
+    def __query_page(self, where, limit):
+        cols = TBL_RUNS.c
+        query = (
+            sa.select(self.LOAD_COLUMNS)
+            .where(sa.and_(sa.true(), *where))
+            .order_by(cols.timestamp.desc(), cols.rowid.desc())
+            # One more, to determine whether there is another page.
+            .limit(limit + 1)
+        )
+        with self.__engine.begin() as conn:
+            rows = list(conn.execute(query))
+
+        if len(rows) > limit:
+            rows = rows[: limit]
+            rowid, _, timestamp, *_ = rows[-1]
+            key = (timestamp, rowid)
+        else:
+            key = None
+        return [ self.__load_run(r) for r in rows ], key
+
+
+    async def query_page(
+            self, *,
+            job_id      =None,
+            state       =None,
+            with_args   ={},
+            since       =None,
+            until       =None,
+            after       =None,
+            limit       =MAX_PAGE,
+    ):
+        """
+        Queries a page of runs, newest first.
+
+        Pages are keyed by `(timestamp, rowid)`, so pagination is stable as
+        runs are added.  Only persisted runs are returned; expected runs are
+        not.
+
+        :param state:
+          If not none, limits to runs in this state.
+        :param with_args:
+          Limits to runs with these args.  Runs may include other args.
+        :param since:
+          If not none, limits to runs with timestamp not less than this.
+        :param until:
+          If not none, limits to runs with timestamp less than this.
+        :param after:
+          If not none, the key from the previous page, to return the next.
+        :param limit:
+          The maximum number of runs to return; capped at `MAX_PAGE`.
+        :return:
+          The runs, and the key of the next page, or none if this is the last.
+        """
+        cols = TBL_RUNS.c
+        where = []
+        if job_id is not None:
+            where.append(cols.job_id == job_id)
+        if state is not None:
+            where.append(cols.state == state.value)
+        for name, value in with_args.items():
+            arg = sa.func.json_extract(cols.args, f'$."{name}"')
+            where.append(sa.cast(arg, sa.Text) == str(value))
+        if since is not None:
+            where.append(cols.timestamp >= dump_time(since))
+        if until is not None:
+            where.append(cols.timestamp < dump_time(until))
+        if after is not None:
+            timestamp, rowid = after
+            where.append(
+                (cols.timestamp < timestamp)
+                | ((cols.timestamp == timestamp) & (cols.rowid < rowid))
+            )
+        limit = max(1, min(limit, self.MAX_PAGE))
+
+        # Write pending runs first.  The query is queued behind the writes.
+        self.flush()
+        return await self.__thread.run(self.__query_page, where, limit)
+
+
+    # Checkpoints of runs are written to a file, to load quickly on restart.
+    # A checkpoint is built from the runs in memory, over several event loop
+    # iterations, between two flushes.  It records the sequence numbers of both
+    # flushes and the count of deleted runs.  It is valid if the second flush
+    # was written and no runs have since been deleted.  Runs written after the
+    # first flush may have changed during the checkpoint, so are read from the
+    # database when loading.
+
+    # Version of the checkpoint file format.
+    CHECKPOINT_VERSION = 4
+
+    # Number of runs to serialize per event loop iteration.
+    CHECKPOINT_CHUNK = 1024
+
+    def __get_deletions(self):
+        with self.__engine.begin() as conn:
+            return _get_run_deletions(conn)
+
+
+    @staticmethod
+    def __write_checkpoint(path, checkpoint, values):
+        checkpoint["runs"] = [
+            (
+                rowid, run_id, timestamp, job_id, ujson.loads(args), state,
+                program, ujson.loads(times), meta, message, run_state, labels,
+            )
+            for (
+                run_id, timestamp, job_id, args, state, program, times, meta,
+                message, run_state, rowid, labels
+            ) in values
+        ]
+        # Write to a temporary file and rename, so the checkpoint is complete.
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}")
+        with open(tmp_path, "wb") as file:
+            pickle.dump(checkpoint, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+    async def checkpoint(self, path, get_runs, *, min_timestamp):
+        """
+        Writes a checkpoint of runs in memory to `path`.
+
+        :param get_runs:
+          Function that returns the runs in memory.  These must include all
+          runs in the database with timestamp not less than `min_timestamp`.
+        :param min_timestamp:
+          If none, includes all runs.
+        :return:
+          The number of runs in the checkpoint.
+        """
+        path = Path(path)
+        min_timestamp = (
+            -math.inf if min_timestamp is None else dump_time(min_timestamp))
+
+        # Runs written after this flush are read from the database on load.
+        self.flush()
+        start_seq = self.__seq
+        # Read the deletion count before getting the runs, so that a run
+        # deleted after we get the runs invalidates the checkpoint.
+        deletions = await self.__thread.run(self.__get_deletions)
+
+        # Serialize runs a chunk at a time, to keep the event loop responsive.
+        values = []
+        runs = [
+            r for r in get_runs()
+            if not r.expected and dump_time(r.timestamp) >= min_timestamp
+        ]
+        for chunk in itr.chunks(runs, self.CHECKPOINT_CHUNK):
+            values.extend(
+                (*self.__to_values(r), list(r.labels)) for r in chunk )
+            await asyncio.sleep(0)
+
+        # Changes made while serializing are written by this flush.
+        await asyncio.wrap_future(self.flush())
+        checkpoint = {
+            "version"       : self.CHECKPOINT_VERSION,
+            "start_seq"     : start_seq,
+            "seq"           : self.__seq,
+            "deletions"     : deletions,
+            "min_timestamp" : min_timestamp,
+        }
+
+        # Decode and write the runs on another thread.
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(1) as executor:
+            await loop.run_in_executor(
+                executor, self.__write_checkpoint, path, checkpoint, values)
+        log.info(
+            f"wrote checkpoint of {len(values)} runs at seq {self.__seq}: {path}")
+        return len(values)
+
+
+    def __load_checkpoint(self, checkpoint, min_timestamp):
+        cols = TBL_RUNS.c
+        with self.__engine.begin() as conn:
+            (seq, ), = conn.execute(sa.select([sa.func.max(cols.seq)]))
+            if not (
+                    (seq or 0) >= checkpoint["seq"]
+                    and _get_run_deletions(conn) == checkpoint["deletions"]
+            ):
+                log.warning("checkpoint doesn't match database")
+                return None
+            # Rows written since the checkpoint started.
+            rows = list(conn.execute(
+                sa.select(self.LOAD_COLUMNS)
+                .where(cols.seq > checkpoint["start_seq"])
+                .where(cols.timestamp >= min_timestamp)
+            ))
+
+        runs = {}
+        for values in checkpoint["runs"]:
+            (
+                rowid, run_id, timestamp, job_id, args, state, program, times,
+                meta, message, run_state, labels
+            ) = values
+            if timestamp >= min_timestamp:
+                runs[run_id] = self.__make_run(
+                    rowid, run_id, timestamp, job_id, args, state, program,
+                    { n: ora.Time(t) for n, t in times.items() },
+                    meta, message, run_state, labels,
+                )
+        for row in rows:
+            run = self.__load_run(row)
+            runs[run.run_id] = run
+        log.info(
+            f"loaded checkpoint of {len(checkpoint['runs'])} runs "
+            f"and {len(rows)} changed runs"
+        )
+        return list(runs.values())
+
+
+    def load_checkpoint(self, path, *, min_timestamp):
+        """
+        Loads runs with timestamp not less than `min_timestamp` from the
+        checkpoint at `path`, and runs changed in the database since.
+
+        :param min_timestamp:
+          If none, loads all runs.
+        :return:
+          The runs, or none if there is no checkpoint or it is not valid.
+        """
+        min_timestamp = (
+            -math.inf if min_timestamp is None else dump_time(min_timestamp))
+        try:
+            with open(path, "rb") as file:
+                checkpoint = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as exc:
+            log.warning(f"can't read checkpoint: {path}: {exc}")
+            return None
+
+        if checkpoint.get("version") != self.CHECKPOINT_VERSION:
+            log.warning(f"wrong checkpoint version: {path}")
+            return None
+        if checkpoint["min_timestamp"] > min_timestamp:
+            # The checkpoint doesn't include all the runs we need.
+            log.info(f"checkpoint starts after {min_timestamp}: {path}")
+            return None
+
+        # Write pending runs first, so the validation sees them.
+        self.flush()
+        return self.__thread.call(
+            self.__load_checkpoint, checkpoint, min_timestamp)
+
+
 
 #-------------------------------------------------------------------------------
 
@@ -426,9 +1183,28 @@ class RunLogDB:
         sa.Index("idx_run_id", "run_id"),
     )
 
-    def __init__(self, engine):
+    # Records for expected runs are cached in memory until the run is no longer
+    # expected.  Other records are buffered, and `flush()` writes all buffered
+    # records in a single transaction.
+
+    # Flush immediately once this many records are buffered.
+    MAX_PENDING = 4096
+
+    def __init__(self, engine, thread):
         self.__engine = engine
+        self.__thread = thread
+        self.__connection = thread.call(lambda: engine.connect().connection)
         self.__cache = {}
+        # Buffered (run_id, timestamp, message) rows, not yet written.
+        self.__buffer = []
+        # Guards `__buffer`, which the DB thread requeues to if a write fails.
+        self.__lock = threading.Lock()
+
+        self.__stats = {
+            "flush_count"       : 0,
+            "flush_rows"        : 0,
+            "flush_max_rows"    : 0,
+        }
 
 
     def cache(self, run_id: str, timestamp: ora.Time, message: str):
@@ -440,44 +1216,104 @@ class RunLogDB:
         self.__cache.setdefault(run_id, []).append(values)
 
 
+    def __append(self, rows):
+        with self.__lock:
+            self.__buffer.extend(rows)
+            full = len(self.__buffer) >= self.MAX_PENDING
+        if full:
+            # Nobody waits for this flush, so log if it fails.  The records
+            # are requeued, and written by a later flush.
+            self.__thread.log_exc(self.flush(), "RunLogDB.flush")
+
+
     def insert(self, run_id: str, timestamp: ora.Time, message: str):
-        values = {
-            "run_id"    : run_id,
-            "timestamp" : dump_time(timestamp),
-            "message"   : str(message),
-        }
-        with self.__engine.begin() as conn:
-            conn.execute(self.TABLE.insert().values(**values))
+        """
+        Buffers a record to be written on the next flush.
+        """
+        self.__append([(run_id, dump_time(timestamp), str(message))])
 
 
-    def flush(self, run_id):
+    def persist(self, run_id):
         """
-        Flushes cached run log to the database.
+        Buffers records cached for `run_id`, which is no longer expected.
         """
         cache = self.__cache.pop(run_id, ())
-        if len(cache) > 0:
-            for item in cache:
-                item["timestamp"] = dump_time(item["timestamp"])
-            with self.__engine.begin() as conn:
-                conn.execute(self.TABLE.insert().values(cache))
+        self.__append(
+            (item["run_id"], dump_time(item["timestamp"]), item["message"])
+            for item in cache
+        )
 
 
-    def query(self, *, run_id: str):
-        where = self.TABLE.c.run_id == run_id
+    def flush(self):
+        """
+        Writes all buffered records to the database, in a single transaction.
+
+        :return:
+          A `concurrent.futures.Future` that completes when the records have
+          been written.
+        """
+        with self.__lock:
+            rows, self.__buffer = self.__buffer, []
+        return self.__thread.submit(self.__write, rows)
+
+
+    def __write(self, rows):
+        if len(rows) == 0:
+            return
+
+        # We use SQL instead of SQLAlchemy for performance.
+        con = self.__connection.connection
+        try:
+            con.executemany(
+                "INSERT INTO run_history (run_id, timestamp, message) "
+                "VALUES (?, ?, ?)",
+                rows
+            )
+            con.commit()
+        except Exception:
+            con.rollback()
+            # Requeue the rows, ahead of any buffered since.
+            with self.__lock:
+                self.__buffer[: 0] = rows
+            raise
+
+        stats = self.__stats
+        stats["flush_count"] += 1
+        stats["flush_rows"] = len(rows)
+        stats["flush_max_rows"] = max(stats["flush_max_rows"], len(rows))
+
+
+    def get_stats(self):
+        return {
+            "queue_depth"   : len(self.__buffer),
+            **self.__stats,
+        }
 
-        # Respond with cached values.
-        yield from self.__cache.get(run_id, ())
 
-        # Now query the database.
+    def __query(self, run_id):
+        where = self.TABLE.c.run_id == run_id
         with self.__engine.begin() as conn:
-            rows = list(conn.execute(sa.select([self.TABLE]).where(where)))
+            return list(conn.execute(sa.select([self.TABLE]).where(where)))
+
 
-        for run_id, timestamp, message in rows:
-            yield {
+    async def query(self, *, run_id: str):
+        # Cached and buffered values, as of now.
+        records = list(self.__cache.get(run_id, ()))
+        with self.__lock:
+            buffered = [ r for r in self.__buffer if r[0] == run_id ]
+
+        # Now query the database.  Since the DB thread processes requests in
+        # order, this sees all records flushed before.
+        rows = await self.__thread.run(self.__query, run_id)
+        records.extend(
+            {
                 "run_id"    : run_id,
                 "timestamp" : load_time(timestamp),
                 "message"   : message,
             }
+            for run_id, timestamp, message in (*rows, *buffered)
+        )
+        return records
 
 
 
@@ -485,10 +1321,17 @@ class RunLogDB:
 
 class OutputDB:
     """
-    We store even large outputs in the SQLite database, which should generally
-    be efficient.  See https://www.sqlite.org/intern-v-extern-blob.html.
+    We store smaller outputs in the SQLite database, which should generally be
+    efficient.  See https://www.sqlite.org/intern-v-extern-blob.html.
+
+    Outputs of at least `BLOB_MIN_SIZE` bytes (as stored) are compressed and
+    stored in a content-addressed blob store, if there is one.  The output table
+    then holds the blob hash in place of the data.
     """
 
+    # Minimum stored size of an output to store as a blob.
+    BLOB_MIN_SIZE = 65536
+
     TABLE = sa.Table(
         "output", METADATA,
         sa.Column("run_id"      , sa.String()   , nullable=False),
@@ -498,15 +1341,44 @@ class OutputDB:
         sa.Column("length"      , sa.Integer()  , nullable=False),
         sa.Column("compression" , sa.String()   , nullable=True),
         sa.Column("data"        , sa.BINARY()   , nullable=False),
+        # If not null, the data is in the blob store with this hash.
+        sa.Column("hash"        , sa.String()   , nullable=True),
         sa.PrimaryKeyConstraint("run_id", "output_id")
     )
 
-    def __init__(self, engine):
+    def __init__(self, engine, thread, blob_store=None):
+        """
+        :param blob_store:
+          Blob store for large outputs, or none to store all outputs inline.
+        """
         self.__engine = engine
-        self.__connection = engine.connect().connection
+        self.__thread = thread
+        self.__blob_store = blob_store
+        self.__connection = thread.call(lambda: engine.connect().connection)
 
 
     def upsert(self, run_id: str, output_id: str, output: Output):
+        """
+        Inserts or updates an output, on the DB thread.
+
+        :return:
+          A `concurrent.futures.Future` that completes when the output has been
+          written.
+        """
+        return self.__thread.post(self.__upsert, run_id, output_id, output)
+
+
+    def __upsert(self, run_id, output_id, output):
+        data = output.data
+        compression = output.compression
+        hash = None
+        if self.__blob_store is not None and len(data) >= self.BLOB_MIN_SIZE:
+            if compression is None:
+                data = brotli.compress(data, quality=3)
+                compression = "br"
+            hash = self.__blob_store.put(data)
+            data = b""
+
         self.__connection.connection.execute(
             """
             INSERT INTO output (
@@ -516,16 +1388,18 @@ class OutputDB:
                 content_type,
                 length,
                 compression,
-                data
+                data,
+                hash
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             ON CONFLICT(run_id, output_id)
             DO UPDATE SET
                 name            = excluded.name,
                 content_type    = excluded.content_type,
                 length          = excluded.length,
                 compression     = excluded.compression,
-                data            = excluded.data
+                data            = excluded.data,
+                hash            = excluded.hash
             """,
             (
                 run_id,
@@ -533,14 +1407,15 @@ class OutputDB:
                 output.metadata.name,
                 output.metadata.content_type,
                 output.metadata.length,
-                output.compression,
-                output.data,
+                compression,
+                data,
+                hash,
             )
         )
         self.__connection.connection.commit()
 
 
-    def get_metadata(self, run_id):
+    async def get_metadata(self, run_id):
         """
         Returns all output metadata for run `run_id`.
 
@@ -548,6 +1423,10 @@ class OutputDB:
           A mapping from output ID to `OutputMetadata` instances.  If no output
           is stored for `run_id`, returns an empty dict.
         """
+        return await self.__thread.run(self.__get_metadata, run_id)
+
+
+    def __get_metadata(self, run_id):
         cols    = self.TABLE.c
         columns = [cols.output_id, cols.name, cols.content_type, cols.length]
         query   = sa.select(*columns).where(cols.run_id == run_id)
@@ -558,13 +1437,17 @@ class OutputDB:
             }
 
 
-    def get_output(self, run_id, output_id) -> Output:
+    async def get_output(self, run_id, output_id) -> Output:
         """
         Returns an output.
 
         :raise LookupError:
           No output for `run_id, output_id`.
         """
+        return await self.__thread.run(self.__get_output, run_id, output_id)
+
+
+    def __get_output(self, run_id, output_id):
         cols = self.TABLE.c
         query = (
             sa.select(
@@ -573,6 +1456,7 @@ class OutputDB:
                 cols.content_type,
                 cols.data,
                 cols.compression,
+                cols.hash,
             )
             .where((cols.run_id == run_id) & ((cols.output_id == output_id)))
         )
@@ -582,9 +1466,15 @@ class OutputDB:
             raise LookupError(f"no output {output_id} for {run_id}")
         else:
             r, = rows
+            if r[5] is None:
+                data = r[3]
+            elif self.__blob_store is None:
+                raise LookupError(f"no blob store for output {output_id}")
+            else:
+                data = self.__blob_store.get(r[5])
             return Output(
                 OutputMetadata(r[0], r[1], content_type=r[2]),
-                data=r[3],
+                data=data,
                 compression=r[4],
             )
 
@@ -596,35 +1486,244 @@ class OutputDB:
 RUN_TABLES = (RunLogDB.TABLE, OutputDB.TABLE)
 ARCHIVE_TABLES = (*RUN_TABLES, TBL_RUNS)
 
+#-------------------------------------------------------------------------------
+# Migrations
+
+def _get_schema_version(con):
+    (version, ), = con.execute("PRAGMA user_version")
+    return version
+
+
+def _ddl(element):
+    """
+    Returns the SQL for DDL `element`.
+    """
+    return str(element.compile(dialect=sa_sqlite.dialect()))
+
+
+def _create_run_deletions(con):
+    """
+    Creates the run deletions count, and the trigger that maintains it.
+    """
+    con.execute(_ddl(
+        sa.schema.CreateTable(TBL_RUN_DELETIONS, if_not_exists=True)))
+    (count, ), = con.execute("SELECT COUNT(*) FROM run_deletions")
+    if count == 0:
+        con.execute("INSERT INTO run_deletions VALUES (0)")
+    con.execute(RUNS_DELETE_TRIGGER)
+
+
+def _get_columns(con, table):
+    return { r[1] for r in con.execute(f"PRAGMA table_info({table})") }
+
+
+def _migrate_1(con, progress):
+    """
+    Stores run state as an integer, and adds indexes to the runs table.
+
+    Rebuilds the runs table, copying runs in batches.
+    """
+    BATCH = 65536
+
+    con.execute("ALTER TABLE runs RENAME TO runs_old")
+    con.execute(_ddl(sa.schema.CreateTable(TBL_RUNS)))
+
+    # Copy the columns of the old table; the new table may have more.
+    old_names = _get_columns(con, "runs_old")
+    names = [ c.name for c in TBL_RUNS.columns if c.name in old_names ]
+    cols = ", ".join(names)
+    state = (
+        "CASE state "
+        + " ".join( f"WHEN '{s.name}' THEN {s.value}" for s in State )
+        + " END"
+    )
+    sel = ", ".join( state if n == "state" else n for n in names )
+
+    (count, lo, hi), = con.execute(
+        "SELECT COUNT(*), MIN(rowid), MAX(rowid) FROM runs_old")
+    done = 0
+    if count > 0:
+        for start in range(lo, hi + 1, BATCH):
+            res = con.execute(
+                f"INSERT INTO runs ({cols}) SELECT {sel} FROM runs_old "
+                "WHERE rowid >= ? AND rowid < ?",
+                (start, start + BATCH)
+            )
+            done += res.rowcount
+            progress("copying runs", done, count)
+
+    # Make sure we recognized all the states.
+    (bad, ), = con.execute("SELECT COUNT(*) FROM runs WHERE state IS NULL")
+    if bad > 0:
+        raise RuntimeError(f"{bad} runs with unknown state")
+
+    con.execute("DROP TABLE runs_old")
+
+    # Build indexes after copying, which is faster.
+    for i, index in enumerate(TBL_RUNS.indexes):
+        con.execute(_ddl(sa.schema.CreateIndex(index)))
+        progress("creating indexes", i + 1, len(TBL_RUNS.indexes))
+
+
+def _migrate_2(con, progress):
+    """
+    Adds the output hash column, for outputs stored in the blob store.
+    """
+    # The output table may have been created with the column already.
+    if "hash" not in _get_columns(con, "output"):
+        con.execute("ALTER TABLE output ADD COLUMN hash VARCHAR")
+
+
+def _migrate_3(con, progress):
+    """
+    Adds the run sequence number column, for run store checkpoints.
+    """
+    # Migration 1 creates the current runs table, which may have it already.
+    if "seq" not in _get_columns(con, "runs"):
+        con.execute("ALTER TABLE runs ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_runs_seq ON runs (seq)")
+
+
+def _migrate_4(con, progress):
+    """
+    Adds the ad hoc column to the jobs table, and indexes the table.
+    """
+    columns = _get_columns(con, "jobs")
+    if len(columns) == 0:
+        # An archive file, which has no jobs table.
+        return
+    if "ad_hoc" not in columns:
+        con.execute(
+            "ALTER TABLE jobs ADD COLUMN ad_hoc BOOLEAN NOT NULL DEFAULT 0")
+
+    # Set the column from the job JSON.
+    rows = list(con.execute("SELECT rowid, job FROM jobs"))
+    ad_hoc = []
+    for i, (rowid, job) in enumerate(rows):
+        try:
+            if ujson.loads(job).get("ad_hoc", False):
+                ad_hoc.append((rowid, ))
+        except ValueError as exc:
+            log.warning(f"invalid job JSON in rowid {rowid}: {exc}")
+        if (i + 1) % 65536 == 0:
+            progress("reading jobs", i + 1, len(rows))
+    con.executemany("UPDATE jobs SET ad_hoc = 1 WHERE rowid = ?", ad_hoc)
+
+    progress("creating indexes", 0, 2)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_jobs_job_id ON jobs (job_id)")
+    progress("creating indexes", 1, 2)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ad_hoc ON jobs (ad_hoc)")
+    progress("creating indexes", 2, 2)
+
+
+def _migrate_5(con, progress):
+    """
+    Adds the job hash column to the jobs table, for finding identical jobs.
+    """
+    columns = _get_columns(con, "jobs")
+    if len(columns) == 0:
+        # An archive file, which has no jobs table.
+        return
+    if "job_hash" not in columns:
+        con.execute("ALTER TABLE jobs ADD COLUMN job_hash VARCHAR")
+
+    # Compute hashes of ad hoc jobs only, which are the only ones we look up.
+    rows = list(con.execute("SELECT rowid, job FROM jobs WHERE ad_hoc"))
+    hashes = []
+    for i, (rowid, job) in enumerate(rows):
+        try:
+            hashes.append((get_job_hash(ujson.loads(job)), rowid))
+        except ValueError as exc:
+            log.warning(f"invalid job JSON in rowid {rowid}: {exc}")
+        if (i + 1) % 65536 == 0:
+            progress("hashing jobs", i + 1, len(rows))
+    con.executemany("UPDATE jobs SET job_hash = ? WHERE rowid = ?", hashes)
+
+    progress("creating indexes", 0, 1)
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_job_hash ON jobs (job_hash)")
+    progress("creating indexes", 1, 1)
+
+
+def _migrate_6(con, progress):
+    """
+    Adds the run deletions count, for validating run store checkpoints.
+    """
+    _create_run_deletions(con)
+
+
+# Migration functions, by the schema version they migrate to.
+MIGRATIONS = {
+    1: _migrate_1,
+    2: _migrate_2,
+    3: _migrate_3,
+    4: _migrate_4,
+    5: _migrate_5,
+    6: _migrate_6,
+}
+
+assert set(MIGRATIONS) == set(range(1, SCHEMA_VERSION + 1))
+
+#-------------------------------------------------------------------------------
+
+def get_blob_path(path):
+    """
+    Returns the path to the blob store directory for the database at `path`.
+    """
+    path = Path(path)
+    return path.with_name(path.name + ".blobs")
+
+
+def get_checkpoint_path(path):
+    """
+    Returns the path to the run checkpoint file for the database at `path`.
+    """
+    path = Path(path)
+    return path.with_name(path.name + ".checkpoint")
+
+
 class SqliteDB:
     """
     A SQLite3 file containing persistent state.
     """
 
-    def __init__(self, engine):
+    def __init__(self, engine, blob_store=None, checkpoint_path=None):
         """
-        :param path:
-          Path to SQLite file.  If `None`, use a memory DB (for testing).
+        :param blob_store:
+          Blob store for large outputs, or none to store them in the database.
+        :param checkpoint_path:
+          Path to the run checkpoint file, or none for no checkpoints.
         """
         self.__engine       = engine
-        self.clock_db       = ClockDB(engine)
-        self.next_run_id_db = RunIDDB(engine)
-        self.job_db         = JobDB(engine)
-        self.run_db         = RunDB(engine)
-        self.run_log_db     = RunLogDB(engine)
-        self.output_db      = OutputDB(engine)
+        self.checkpoint_path = checkpoint_path
+        # All database I/O runs on this thread.
+        self.thread         = DBThread()
+        self.clock_db       = ClockDB(engine, self.thread)
+        self.next_run_id_db = RunIDDB(engine, self.thread)
+        self.job_db         = JobDB(engine, self.thread)
+        self.run_db         = RunDB(engine, self.thread)
+        self.run_log_db     = RunLogDB(engine, self.thread)
+        self.output_db      = OutputDB(engine, self.thread, blob_store)
 
 
     @classmethod
     def __get_engine(cls, path):
         url = "sqlite://" if path is None else f"sqlite:///{path}"
-        # Use a static pool-- exactly one persistent connection-- since we are a
-        # single-threaded async application, and sqlite doesn't support
-        # concurrent access.
-        return sa.create_engine(url, poolclass=sa.pool.StaticPool)
+        # Use a static pool-- exactly one persistent connection-- since sqlite
+        # doesn't support concurrent access.  The connection is created on the
+        # main thread but used only on the DB thread.
+        return sa.create_engine(
+            url,
+            poolclass=sa.pool.StaticPool,
+            connect_args={"check_same_thread": False},
+        )
 
 
     def close(self):
+        # Finish pending writes before disposing the connection.
+        self.run_db.flush()
+        self.run_log_db.flush()
+        self.thread.close()
         self.__engine.dispose()
         del self.__engine
 
@@ -644,8 +1743,12 @@ class SqliteDB:
 
         log.info(f"creating database: {path}")
         engine  = cls.__get_engine(path)
+        # Auto-vacuum mode must be set before creating tables.
+        engine.execute("PRAGMA auto_vacuum = INCREMENTAL")
         log.info("creating tables")
         METADATA.create_all(engine)
+        _create_run_deletions(engine)
+        engine.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         log.info("initializing next run ID")
         RunIDDB.initialize(engine)
 
@@ -659,7 +1762,88 @@ class SqliteDB:
 
         engine  = cls.__get_engine(path)
         # FIXME: Check that tables exist.
-        return cls(engine)
+
+        version = _get_schema_version(engine)
+        if version < SCHEMA_VERSION:
+            engine.dispose()
+            raise RuntimeError(
+                f"database schema version {version} is out of date; "
+                f"migrate with: apsisctl migrate-db {path}"
+            )
+        elif version > SCHEMA_VERSION:
+            engine.dispose()
+            raise RuntimeError(
+                f"database schema version {version} is newer than "
+                f"this Apsis version's {SCHEMA_VERSION}"
+            )
+
+        if path is None:
+            return cls(engine)
+        else:
+            return cls(
+                engine,
+                blob_store      =BlobStore(get_blob_path(path)),
+                checkpoint_path =get_checkpoint_path(path),
+            )
+
+
+    @staticmethod
+    def migrate(path, *, progress=lambda step, done, total: None):
+        """
+        Migrates a database or archive file to the current schema version, in
+        place.
+
+        Each migration runs in a single transaction, so a failed migration
+        leaves the database unchanged.  Also switches the database to
+        incremental auto-vacuum, if necessary, with a full vacuum.
+
+        :param progress:
+          Called with step description, done count, and total count, to report
+          progress.
+        :return:
+          The previous schema version.
+        """
+        path = Path(path).absolute()
+        if not path.exists():
+            raise FileNotFoundError(path)
+
+        # Use the sqlite3 module directly, with explicit transactions.
+        with contextlib.closing(sqlite3.connect(path, isolation_level=None)) as con:
+            old_version = version = _get_schema_version(con)
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(
+                    f"database schema version {version} is newer than "
+                    f"this Apsis version's {SCHEMA_VERSION}"
+                )
+
+            while version < SCHEMA_VERSION:
+                version += 1
+                log.info(f"migrating {path} to schema version {version}")
+                with Timer() as timer:
+                    con.execute("BEGIN")
+                    try:
+                        MIGRATIONS[version](con, progress)
+                        con.execute(f"PRAGMA user_version = {version}")
+                    except BaseException:
+                        con.execute("ROLLBACK")
+                        raise
+                    else:
+                        con.execute("COMMIT")
+                log.info(f"migrated in {timer.elapsed:.3f} s")
+
+            # Switch to incremental auto-vacuum, so that we never need a full
+            # vacuum again.  This requires a full vacuum, outside a transaction.
+            (auto_vacuum, ), = con.execute("PRAGMA auto_vacuum")
+            if auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+                log.info(f"switching {path} to incremental auto-vacuum")
+                progress("vacuuming", 0, 1)
+                with Timer() as timer:
+                    con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                    con.execute("VACUUM")
+                progress("vacuuming", 1, 1)
+                log.info(f"vacuumed in {timer.elapsed:.3f} s")
+
+        return old_version
 
 
     def check(self):
@@ -704,7 +1888,7 @@ class SqliteDB:
           A sequence of run IDs.
         """
         # Only finished runs are eligible for archiving.
-        FINISHED_STATES = [ s.name for s in State if s.finished ]
+        FINISHED_STATES = [ s.value for s in State if s.finished ]
 
         with (
                 Timer() as timer,
@@ -725,7 +1909,7 @@ class SqliteDB:
         return run_ids
 
 
-    def archive(self, path, run_ids):
+    def archive(self, path, run_ids, *, keep_job_ids=frozenset()):
         """
         Archives data for `run_ids` to sqlite archive file `path`.
 
@@ -735,13 +1919,34 @@ class SqliteDB:
           already is present for any of `run_ids`.
         :param run_ids:
           Sequence of run IDs to archive.
+        :param keep_job_ids:
+          IDs of jobs not to archive, even if no remaining run refers to them.
+          Pinned jobs in the job DB are kept as well.
+
+        Outputs in the blob store are archived by reference: the archive holds
+        their hashes, and the blobs stay in the blob store.
+
+        Ad hoc jobs of the archived runs are archived as well, once no run
+        remaining in the database refers to them.
         """
         # Open the archive file, creating if necessary.
+        create = not Path(path).exists()
         archive_engine = self.__get_engine(path)
-        # Create tables if necessary.
-        METADATA.create_all(archive_engine, tables=ARCHIVE_TABLES)
+        if create:
+            METADATA.create_all(
+                archive_engine, tables=(*ARCHIVE_TABLES, TBL_JOBS))
+            archive_engine.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        else:
+            version = _get_schema_version(archive_engine)
+            if version != SCHEMA_VERSION:
+                archive_engine.dispose()
+                raise RuntimeError(
+                    f"archive schema version {version} doesn't match "
+                    f"{SCHEMA_VERSION}; migrate with: apsisctl migrate-db {path}"
+                )
 
         row_counts = {}
+        job_ids = []
 
         with (
                 disposing(archive_engine),
@@ -799,15 +2004,98 @@ class SqliteDB:
                     # Keep count of how many rows we archived from each table.
                     row_counts[table.name] = len(rows)
 
+                job_ids = self.__archive_jobs(
+                    src_tx, archive_tx, run_ids,
+                    set(keep_job_ids) | self.job_db.get_pinned(),
+                )
+                row_counts[TBL_JOBS.name] = len(job_ids)
+
+        # Don't serve archived jobs from the cache.
+        self.job_db.evict(job_ids)
+
         log.info(f"archived in {timer.elapsed:.3f} s")
         return row_counts
 
 
-    def vacuum(self):
-        log.info("vacuuming database")
-        with Timer() as timer:
-            self.__engine.execute("VACUUM")
-        log.info(f"vacuumed in {timer.elapsed:.3f} s")
+    @staticmethod
+    def __archive_jobs(src_tx, archive_tx, run_ids, keep_job_ids):
+        """
+        Archives ad hoc jobs of archived `run_ids` that no run refers to.
+
+        Call after archiving runs, in the same transactions.
+
+        :return:
+          The IDs of archived jobs.
+        """
+        # The runs are already deleted, so find their job IDs in the archive.
+        job_ids = {
+            j for j, in archive_tx.execute(
+                sa.select([TBL_RUNS.c.job_id]).distinct()
+                .where(TBL_RUNS.c.run_id.in_(run_ids))
+            )
+        }
+        job_ids -= keep_job_ids
+        if len(job_ids) == 0:
+            return []
+        # Skip jobs that runs in the database still refer to.
+        job_ids -= {
+            j for j, in src_tx.execute(
+                sa.select([TBL_RUNS.c.job_id]).distinct()
+                .where(TBL_RUNS.c.job_id.in_(sorted(job_ids)))
+            )
+        }
+        job_ids = sorted(job_ids)
+
+        sel = (
+            sa.select(TBL_JOBS)
+            .where(TBL_JOBS.c.ad_hoc)
+            .where(TBL_JOBS.c.job_id.in_(job_ids))
+        )
+        rows = tuple(src_tx.execute(sel).mappings())
+        if len(rows) > 0:
+            # Archives created before jobs were archived have no jobs table.
+            TBL_JOBS.create(archive_tx, checkfirst=True)
+            archive_tx.execute(sa.insert(TBL_JOBS), rows)
+            res = src_tx.execute(
+                sa.delete(TBL_JOBS)
+                .where(TBL_JOBS.c.ad_hoc)
+                .where(TBL_JOBS.c.job_id.in_(job_ids))
+            )
+            assert res.rowcount == len(rows)
+        return [ r["job_id"] for r in rows ]
+
+
+    def vacuum(self, *, pages=None):
+        """
+        Frees unused database pages.
+
+        If the database uses incremental auto-vacuum, frees up to `pages` free
+        pages, or all if none.  Otherwise, runs a full vacuum; use `apsisctl
+        migrate-db` to switch to incremental auto-vacuum.
+
+        :return:
+          The number of free pages remaining.
+        """
+        with contextlib.closing(self.__engine.raw_connection()) as con:
+            con = con.connection
+            (auto_vacuum, ), = con.execute("PRAGMA auto_vacuum")
+            with Timer() as timer:
+                if auto_vacuum == AUTO_VACUUM_INCREMENTAL:
+                    (free, ), = con.execute("PRAGMA freelist_count")
+                    count = free if pages is None else min(free, int(pages))
+                    # The sqlite3 module steps the statement only once, which
+                    # frees a single page, so free pages one at a time, in a
+                    # single transaction.
+                    con.execute("BEGIN")
+                    for _ in range(count):
+                        con.execute("PRAGMA incremental_vacuum(1)")
+                    con.commit()
+                else:
+                    log.info("vacuuming database")
+                    con.execute("VACUUM")
+            (free, ), = con.execute("PRAGMA freelist_count")
+        log.info(f"vacuumed in {timer.elapsed:.3f} s; {free} pages free")
+        return free
 
 
 
@@ -56,7 +56,7 @@ class EmailAction:
         subject = f"Apsis {run.run_id}: {run.inst}: {run.state.name}"
 
         program = str(run.program)
-        output_meta = apsis.outputs.get_metadata(run.run_id)
+        output_meta = await apsis.outputs.get_metadata(run.run_id)
         if "output" in output_meta:
             output = apsis.outputs.get_data(run.run_id, "output").decode()
         else:
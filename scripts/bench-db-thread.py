@@ -0,0 +1,86 @@
+"""
+Benchmarks event loop latency while writing large outputs to the database.
+
+Compares writing outputs while blocking the event loop, as Apsis used to, with
+writing them on the database thread.  A monitor task, like Apsis's async check,
+measures how late the event loop wakes it up.
+"""
+
+import argparse
+import asyncio
+import os
+from   pathlib import Path
+import tempfile
+import time
+
+from   apsis.program import Output, OutputMetadata
+from   apsis.sqlite import SqliteDB
+
+#-------------------------------------------------------------------------------
+
+INTERVAL = 0.01
+
+async def monitor(latencies):
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(INTERVAL)
+        latencies.append(time.monotonic() - start - INTERVAL)
+
+
+async def write_outputs(db, *, count, size, blocking):
+    for i in range(count):
+        data = os.urandom(size)
+        output = Output(OutputMetadata("output", len(data)), data)
+        future = db.output_db.upsert(f"r{i}", "output", output)
+        if blocking:
+            # Wait for the write on the event loop thread.
+            future.result()
+        else:
+            await asyncio.wrap_future(future)
+        # Give other tasks a chance to run.
+        await asyncio.sleep(0)
+
+
+async def bench(path, *, count, size, blocking):
+    SqliteDB.create(path)
+    db = SqliteDB.open(path)
+
+    latencies = []
+    monitor_task = asyncio.create_task(monitor(latencies))
+    start = time.monotonic()
+    await write_outputs(db, count=count, size=size, blocking=blocking)
+    elapsed = time.monotonic() - start
+    monitor_task.cancel()
+    db.close()
+
+    latencies.sort()
+    mode = "blocking" if blocking else "thread"
+    print(
+        f"{mode:10s}: {count} × {size} B in {elapsed:.3f} s; loop latency"
+        f" mean {sum(latencies) / max(len(latencies), 1) * 1e3:.2f} ms"
+        f" max {max(latencies, default=0) * 1e3:.2f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--count", metavar="NUM", type=int, default=32,
+        help="write NUM outputs [def: 32]")
+    parser.add_argument(
+        "--size", metavar="BYTES", type=int, default=8 * 1024 * 1024,
+        help="write outputs of BYTES each [def: 8 MiB]")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dir:
+        dir = Path(dir)
+        for blocking in (True, False):
+            asyncio.run(bench(
+                dir / f"apsis-{blocking}.db",
+                count=args.count, size=args.size, blocking=blocking
+            ))
+
+
+if __name__ == "__main__":
+    main()
+
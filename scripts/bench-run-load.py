@@ -0,0 +1,93 @@
+"""
+Benchmarks loading runs from the database, as on Apsis startup.
+
+Generates a database of finished runs, then loads them in a fresh process and
+reports load time and peak RSS, both with runs' program, meta, and run state
+decoded lazily, and with them all decoded on load, as Apsis used to.
+"""
+
+import argparse
+import ora
+from   pathlib import Path
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from   apsis.program import ShellCommandProgram
+from   apsis.runs import Instance, Run
+from   apsis.sqlite import SqliteDB
+from   apsis.states import State
+
+#-------------------------------------------------------------------------------
+
+def generate(path, count):
+    SqliteDB.create(path)
+    db = SqliteDB.open(path)
+    start = ora.now()
+    for i in range(1, count + 1):
+        run = Run(Instance(f"job{i % 100}", {"date": "2024-01-01", "i": str(i)}))
+        run.run_id = f"r{i}"
+        run.timestamp = start
+        run.program = ShellCommandProgram(f"echo run {i}; sleep 1")
+        for state in (State.scheduled, State.waiting, State.starting):
+            run._transition(start, state, force=True)
+        run._transition(
+            start, State.running, force=True,
+            meta={"pid": 1234, "hostname": "localhost", "cmd": ["echo", str(i)]},
+            run_state={"pid": 1234, "start": str(start)},
+        )
+        run._transition(start + 1, State.success, force=True)
+        db.run_db.upsert(run)
+    db.close()
+
+
+def load(path, eager):
+    db = SqliteDB.open(path)
+    start = time.monotonic()
+    runs = db.run_db.query()
+    if eager:
+        for run in runs:
+            run.program, run.meta, run.run_state
+    elapsed = time.monotonic() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    mode = "eager" if eager else "lazy"
+    print(
+        f"{mode:6s}: loaded {len(runs)} runs in {elapsed:.3f} s;"
+        f" max RSS {rss / 1024:.1f} MiB"
+    )
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--count", metavar="NUM", type=int, default=100000,
+        help="generate NUM runs [def: 100000]")
+    parser.add_argument(
+        "--load", metavar="PATH", default=None,
+        help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--eager", action="store_true", default=False,
+        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load is not None:
+        load(args.load, args.eager)
+        return
+
+    with tempfile.TemporaryDirectory() as dir:
+        path = Path(dir) / "apsis.db"
+        generate(path, args.count)
+        # Load in fresh processes, to measure RSS separately.
+        for eager in (True, False):
+            subprocess.run(
+                [sys.executable, __file__, "--load", str(path)]
+                + (["--eager"] if eager else []),
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
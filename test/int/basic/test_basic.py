@@ -3,6 +3,7 @@ from   pathlib import Path
 import pytest
 import sqlite3
 
+from   apsis.service.client import APIError
 from   instance import ApsisService, run_apsisctl
 
 #-------------------------------------------------------------------------------
@@ -48,6 +49,14 @@ def test_jobs_exact_match(inst):
     assert ret == 0
 
 
+def test_runs_invalid_state(inst):
+    client = inst.client
+    for limit in (None, 10):
+        with pytest.raises(APIError) as exc_info:
+            client.get_runs(state="bogus", limit=limit)
+        assert exc_info.value.status == 400
+
+
 def test_stop_serve(inst):
     ret = inst.stop_serve()
     assert ret == 0
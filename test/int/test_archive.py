@@ -4,6 +4,7 @@ import sqlite3
 import time
 
 from   apsis.service.client import APIError
+from   apsis.states import State
 from   instance import ApsisService
 
 #-------------------------------------------------------------------------------
@@ -83,8 +84,8 @@ def test_archive(tmp_path):
         with closing(sqlite3.connect(path)) as db:
             rows = list(db.execute("SELECT run_id, state FROM runs"))
             assert rows == [
-                (run_id0, "success"),
-                (run_id1, "success"),
+                (run_id0, State.success.value),
+                (run_id1, State.success.value),
             ]
 
             rows = list(db.execute(
@@ -0,0 +1,139 @@
+import ora
+from   types import SimpleNamespace
+import ujson
+
+from   apsis.lib.api import (
+    Json, dumps, run_to_summary_json, runs_to_jso, iter_runs_json,
+    select_encoding, make_etag, check_etag,
+)
+from   apsis.runs import Instance, Run
+from   apsis.service import messages
+from   apsis.states import State
+
+#-------------------------------------------------------------------------------
+
+def test_dumps_splice():
+    jso = {
+        "a": Json('{"x":[1,2]}'),
+        "b": [Json("42"), "/path", None],
+        "c": {"d": 3.5},
+    }
+    json = dumps(jso)
+    assert ujson.loads(json) == {
+        "a": {"x": [1, 2]},
+        "b": [42, "/path", None],
+        "c": {"d": 3.5},
+    }
+    # Spliced as is.
+    assert '"a":{"x":[1,2]}' in json
+
+
+def test_run_summary_json_cache():
+    run = Run(Instance("job", {"fruit": "mango"}))
+    run.run_id = "r1"
+    run.timestamp = ora.now()
+    run._transition(ora.now(), State.scheduled)
+
+    json = run_to_summary_json(run)
+    assert ujson.loads(json)["state"] == "scheduled"
+    # Cached.
+    assert run_to_summary_json(run) is json
+
+    # A transition invalidates the cache.
+    run._transition(ora.now(), State.waiting)
+    assert ujson.loads(run_to_summary_json(run))["state"] == "waiting"
+
+
+def test_encode_run_message():
+    run = Run(Instance("job", {"fruit": "mango"}))
+    run.run_id = "r1"
+    run.timestamp = ora.now()
+    run._transition(ora.now(), State.scheduled)
+
+    msg = messages.make_run_transition(run)
+    # The summary is encoded once, and shared.
+    assert msg["run_summary"] is run_to_summary_json(run)
+    msg["seq"] = 42
+    jso = ujson.loads(messages.encode(msg))
+    assert jso["type"] == "run_transition"
+    assert jso["run_id"] == "r1"
+    assert jso["run_summary"]["state"] == "scheduled"
+    assert jso["run_summary"]["args"] == {"fruit": "mango"}
+    assert jso["seq"] == 42
+
+
+def test_select_encoding():
+    def select(accept):
+        headers = {} if accept is None else {"Accept-Encoding": accept}
+        return select_encoding(headers, ("br", "gzip"))
+
+    assert select(None) is None
+    assert select("") is None
+    assert select("gzip, deflate") == "gzip"
+    assert select("gzip, deflate, br") == "br"
+    assert select("br;q=0, gzip;q=0.5") == "gzip"
+    assert select("*") == "br"
+    assert select("br;q=0, *") == "gzip"
+    assert select("*, br;q=0, gzip;q=0") is None
+    assert select("deflate") is None
+
+
+def test_iter_runs_json():
+    time = ora.now()
+    runs = []
+    for i in range(1, 8):
+        run = Run(Instance("job", {"i": str(i)}))
+        run.run_id = f"r{i}"
+        run.timestamp = time
+        run._transition(time, State.scheduled, meta={"fruit": "mango"})
+        runs.append(run)
+
+    parts = list(iter_runs_json(
+        None, time, runs, extra={"next_cursor": None}, chunk_size=3))
+    jso = ujson.loads("".join(parts))
+    assert jso == ujson.loads(dumps({
+        **runs_to_jso(None, time, runs),
+        "next_cursor": None,
+    }))
+    assert list(jso["runs"]) == [ r.run_id for r in runs ]
+    assert jso["runs"]["r3"]["meta"] == {"fruit": "mango"}
+
+    # Select fields.
+    jso = ujson.loads("".join(iter_runs_json(
+        None, time, runs, fields=["run_id", "state", "meta"])))
+    assert jso["runs"]["r4"] == {
+        "run_id": "r4", "state": "scheduled", "meta": {"fruit": "mango"}}
+
+    # No runs.
+    jso = ujson.loads("".join(iter_runs_json(None, time, [])))
+    assert jso["runs"] == {}
+
+
+def test_check_etag():
+    etag = make_etag("abc", 42)
+    assert etag == '"abc-42"'
+
+    def check(match):
+        headers = {} if match is None else {"If-None-Match": match}
+        response = check_etag(SimpleNamespace(headers=headers), etag)
+        return None if response is None else response.status
+
+    assert check(None) is None
+    assert check('"abc-41"') is None
+    assert check('"abc-42"') == 304
+    assert check('"xyz-1", "abc-42"') == 304
+    assert check('W/"abc-42"') == 304
+    assert check("*") == 304
+
+
+def test_run_version():
+    run = Run(Instance("job", {}))
+    run.run_id = "r1"
+    version = run._version
+    run._transition(ora.now(), State.scheduled)
+    assert run._version > version
+    version = run._version
+    run._update(meta={"fruit": "mango"})
+    assert run._version > version
+
+
@@ -0,0 +1,141 @@
+import asyncio
+import ora
+import pytest
+
+import apsis.config
+from   apsis.apsis import Apsis
+from   apsis.cond.dependency import Dependency
+from   apsis.jobs import Job, InMemoryJobs
+from   apsis.program import NoOpProgram
+from   apsis.runs import Instance, Run
+from   apsis.sqlite import SqliteDB
+from   apsis.states import State
+
+#-------------------------------------------------------------------------------
+
+JOBS = InMemoryJobs([
+    Job("dep", ["x"]),
+    # Waits for a run of dep, so its runs stay waiting.
+    Job(
+        "job", ["x"],
+        program =NoOpProgram(duration="{{ x }}"),
+        conds   =[Dependency("dep", {"x": "{{ x }}"})],
+    ),
+    # The condition's job doesn't exist, so binding fails.
+    Job("bad", [], conds=[Dependency("missing")]),
+])
+
+def make_apsis(tmp_path, bind_lead=0):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    cfg = apsis.config.check({"schedule": {"bind_lead": bind_lead}}, tmp_path)
+    return Apsis(cfg, JOBS, SqliteDB.open(path))
+
+
+def is_bound(run):
+    return run.program is not None and run.conds is not None
+
+
+@pytest.mark.asyncio
+async def test_bind_on_wait(tmp_path):
+    apsis = make_apsis(tmp_path)
+    try:
+        # A run scheduled for later isn't bound.
+        run = Run(Instance("job", {"x": "5"}))
+        await apsis.schedule(ora.now() + 3600, run)
+        assert run.state == State.scheduled
+        assert not is_bound(run)
+
+        # It's bound when it leaves the scheduled state.
+        await apsis.start(run)
+        assert run.state == State.waiting
+        assert str(run.program) == "no-op for 5 s"
+        cond, = run.conds
+        assert cond.args == {"x": "5"}
+
+        # A run scheduled now is bound right away.
+        run = Run(Instance("job", {"x": "7"}))
+        await apsis.schedule(None, run)
+        assert run.state == State.waiting
+        assert str(run.program) == "no-op for 7 s"
+
+    finally:
+        await apsis.shut_down()
+
+
+@pytest.mark.asyncio
+async def test_bind_lead(tmp_path):
+    apsis = make_apsis(tmp_path, bind_lead=3600)
+    try:
+        # Due within the bind lead, so bound when scheduled.
+        run0 = Run(Instance("job", {"x": "1"}))
+        await apsis.schedule(ora.now() + 1800, run0)
+        assert run0.state == State.scheduled
+        assert is_bound(run0)
+
+        # Due after the bind lead, so not bound yet.
+        run1 = Run(Instance("job", {"x": "2"}))
+        await apsis.schedule(ora.now() + 7200, run1)
+        assert run1.state == State.scheduled
+        assert not is_bound(run1)
+
+        # Bound ahead of time once it's within the bind lead.
+        apsis._bind_due_runs(ora.now() + 3600)
+        assert not is_bound(run1)
+        apsis._bind_due_runs(ora.now() + 10800)
+        assert run1.state == State.scheduled
+        assert str(run1.program) == "no-op for 2 s"
+
+    finally:
+        await apsis.shut_down()
+
+
+@pytest.mark.asyncio
+async def test_bind_error(tmp_path):
+    apsis = make_apsis(tmp_path, bind_lead=3600)
+    try:
+        # Binding fails when the run leaves the scheduled state.
+        run = Run(Instance("bad", {}))
+        await apsis.schedule(ora.now() + 7200, run)
+        assert run.state == State.scheduled
+        await apsis.start(run)
+        assert run.state == State.error
+        assert run.message.startswith("invalid condition")
+
+        # Binding within the bind lead fails when scheduled.
+        run = Run(Instance("bad", {}))
+        await apsis.schedule(ora.now() + 1800, run)
+        assert run.state == State.error
+
+        # Or when bound ahead of time.
+        run = Run(Instance("bad", {}))
+        await apsis.schedule(ora.now() + 7200, run)
+        assert run.state == State.scheduled
+        apsis._bind_due_runs(ora.now() + 10800)
+        assert run.state == State.error
+
+    finally:
+        await apsis.shut_down()
+
+
+@pytest.mark.asyncio
+async def test_bind_error_unscheduled(tmp_path):
+    apsis = make_apsis(tmp_path)
+    try:
+        # A run that fails to bind ahead of time is errored.
+        run = Run(Instance("bad", {}))
+        await apsis.schedule(ora.now() + 0.5, run)
+        assert run.state == State.scheduled
+        apsis._bind_due_runs(ora.now() + 3600)
+        assert run.state == State.error
+
+        # The scheduled loop passes its schedule time without starting it.
+        loop = asyncio.create_task(apsis.scheduled.loop())
+        await asyncio.sleep(1.5)
+        assert not loop.done()
+        assert run.state == State.error
+        loop.cancel()
+
+    finally:
+        await apsis.shut_down()
+
@@ -98,6 +98,104 @@ async def test_publisher():
             await anext(sub_late)
 
 
+@pytest.mark.asyncio
+async def test_publisher_topics():
+    pub = apsis.lib.asyn.Publisher()
+
+    with (
+            pub.subscription() as sub_all,
+            pub.subscription(topic="a") as sub_a0,
+            pub.subscription(topic="a", predicate=lambda n: n > 1) as sub_a1,
+            pub.subscription(topic="b") as sub_b,
+    ):
+        assert pub.num_subs == 4
+        assert pub.get_stats()["num_topics"] == 2
+
+        pub.publish(0)
+        pub.publish(1, topic="a")
+        pub.publish(2, topic="a")
+        pub.publish(3, topic="b")
+        pub.publish(4, topic="c")
+
+        assert sub_all.drain() == [0, 1, 2, 3, 4]
+        assert sub_a0.drain() == [1, 2]
+        assert sub_a1.drain() == [2]
+        assert sub_b.drain() == [3]
+
+        pub.close()
+        with pytest.raises(StopAsyncIteration):
+            await anext(sub_b)
+
+    assert pub.num_subs == 0
+    assert pub.get_stats()["num_topics"] == 0
+
+
+@pytest.mark.asyncio
+async def test_publisher_coalesce():
+    pub = apsis.lib.asyn.Publisher()
+    RESYNC = apsis.lib.asyn.Publisher.RESYNC
+
+    with pub.subscription(
+            max_len=4,
+            coalesce=lambda m: m[0],
+    ) as sub:
+        pub.publish(("a", 0))
+        pub.publish(("b", 0))
+        pub.publish(("a", 1))
+        pub.publish((None, 0))
+        pub.publish((None, 1))
+        # The later message replaces the earlier, in publication order.
+        assert sub.len_queue == 4
+        assert await anext(sub) == ("b", 0)
+        assert sub.drain() == [("a", 1), (None, 0), (None, 1)]
+        assert sub.len_queue == 0
+
+        # Only the latest message for a key is queued.
+        for i in range(100):
+            pub.publish(("c", i))
+        assert sub.drain() == [("c", 99)]
+
+        # Fill the queue and overflow.
+        for i in range(5):
+            pub.publish((None, i))
+        # Discarded until the subscriber sees the resync.
+        pub.publish(("d", 0))
+        assert await anext(sub) is RESYNC
+        pub.publish(("d", 1))
+        assert sub.drain() == [("d", 1)]
+
+    stats = pub.get_stats()
+    assert stats["high_water"] == 4
+    assert stats["num_resyncs"] == 1
+
+
+@pytest.mark.asyncio
+async def test_sequenced_publisher():
+    pub = apsis.lib.asyn.SequencedPublisher(ring_len=4)
+    seq0 = pub.seq
+    assert pub.get_since(seq0) == []
+
+    with pub.subscription() as sub:
+        for i in range(3):
+            pub.publish({"i": i})
+        msgs = sub.drain()
+        assert [ m["i"] for m in msgs ] == [0, 1, 2]
+        assert [ m["seq"] for m in msgs ] == [seq0 + 1, seq0 + 2, seq0 + 3]
+    assert pub.seq == seq0 + 3
+
+    assert [ m["i"] for m in pub.get_since(seq0) ] == [0, 1, 2]
+    assert [ m["i"] for m in pub.get_since(seq0 + 2) ] == [2]
+    assert pub.get_since(seq0 + 3) == []
+    # Not a sequence number yet.
+    assert pub.get_since(seq0 + 4) is None
+
+    # The oldest messages are no longer kept.
+    pub.publish({"i": 3})
+    pub.publish({"i": 4})
+    assert pub.get_since(seq0) is None
+    assert [ m["i"] for m in pub.get_since(seq0 + 1) ] == [1, 2, 3, 4]
+
+
 @pytest.mark.asyncio
 async def test_task_group():
     val = 0
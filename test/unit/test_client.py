@@ -0,0 +1,30 @@
+from   types import SimpleNamespace
+from   urllib.parse import parse_qs, urlparse
+
+from   apsis.service.client import Client
+
+#-------------------------------------------------------------------------------
+
+def test_get_runs_reserved_args(monkeypatch):
+    urls = []
+
+    def request(method, url, **kw_args):
+        urls.append(url)
+        return SimpleNamespace(status_code=200, json=lambda: {"runs": {}})
+
+    monkeypatch.setattr("requests.request", request)
+    client = Client(("localhost", 5000))
+    client.get_runs(
+        job_id="job", args={"fields": "a", "state": "b", "label": "c"})
+
+    url, = urls
+    query = parse_qs(urlparse(url).query)
+    # Args that collide with query names are prefixed with underscore.
+    assert query == {
+        "job_id"    : ["job"],
+        "_fields"   : ["a"],
+        "_state"    : ["b"],
+        "label"     : ["c"],
+    }
+
+
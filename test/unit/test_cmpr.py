@@ -1,8 +1,9 @@
 import asyncio
 import brotli
+import gzip
 import pytest
 
-from   apsis.lib.cmpr import compress_async
+from   apsis.lib.cmpr import compress_async, StreamCompressor
 
 #-------------------------------------------------------------------------------
 
@@ -44,3 +45,23 @@ async def test_compress_async_timing():
     assert await task == 499500
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", [None, "br", "gzip"])
+async def test_stream_compressor(compression):
+    chunks = [ f"chunk {i} ".encode() * 1000 for i in range(100) ]
+
+    with StreamCompressor(compression) as compressor:
+        parts = [ await compressor.compress(c) for c in chunks ]
+        parts.append(await compressor.finish())
+    compressed = b"".join(parts)
+
+    data = b"".join(chunks)
+    match compression:
+        case None:
+            assert compressed == data
+        case "br":
+            assert brotli.decompress(compressed) == data
+        case "gzip":
+            assert gzip.decompress(compressed) == data
+
+
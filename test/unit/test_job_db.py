@@ -0,0 +1,197 @@
+from   contextlib import closing
+import ora
+import pytest
+import sqlite3
+
+from   apsis.jobs import Job
+from   apsis.program import NoOpProgram
+from   apsis.runs import Instance, Run
+from   apsis.sqlite import JobDB, SqliteDB, SCHEMA_VERSION
+
+#-------------------------------------------------------------------------------
+
+def make_job(job_id, ad_hoc=True):
+    return Job(job_id, [], [], NoOpProgram(duration="1"), ad_hoc=ad_hoc)
+
+
+def make_run(number, job_id):
+    run = Run(Instance(job_id, {}))
+    run.run_id = f"r{number}"
+    run.timestamp = ora.now()
+    return run
+
+
+def test_job_db(tmp_path):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path)
+    job_db = db.job_db
+
+    job_db.insert(make_job("adhoc-1"))
+    job_db.insert(make_job("adhoc-2"))
+    job_db.insert(make_job("regular", ad_hoc=False))
+
+    # Recently inserted jobs are cached.
+    assert job_db.get("adhoc-1").job_id == "adhoc-1"
+    assert job_db.get_stats()["cache_hits"] == 1
+
+    assert { j.job_id for j in job_db.query(ad_hoc=True) } == {"adhoc-1", "adhoc-2"}
+    assert { j.job_id for j in job_db.query(ad_hoc=False) } == {"regular"}
+    assert len(job_db.query()) == 3
+    db.close()
+
+    # Reopen, with an empty cache.
+    job_db = SqliteDB.open(path).job_db
+    job = job_db.get("adhoc-2")
+    assert job.ad_hoc
+    assert job_db.get_stats()["cache_misses"] == 1
+    assert job_db.get("adhoc-2") is job
+    assert job_db.get_stats()["cache_hits"] == 1
+
+
+def test_migrate_ad_hoc(tmp_path):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path)
+    db.job_db.insert(make_job("adhoc-1"))
+    db.job_db.insert(make_job("regular", ad_hoc=False))
+    db.close()
+
+    # Downgrade to schema version 3, without the ad hoc column.
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute("DROP INDEX idx_jobs_job_id")
+        conn.execute("DROP INDEX idx_jobs_ad_hoc")
+        conn.execute("ALTER TABLE jobs DROP COLUMN ad_hoc")
+        conn.execute("PRAGMA user_version = 3")
+        conn.commit()
+
+    assert SqliteDB.migrate(path) == 3
+    assert SqliteDB.migrate(path) == SCHEMA_VERSION
+    job_db = SqliteDB.open(path).job_db
+    assert [ j.job_id for j in job_db.query(ad_hoc=True) ] == ["adhoc-1"]
+    assert [ j.job_id for j in job_db.query(ad_hoc=False) ] == ["regular"]
+
+
+@pytest.mark.asyncio
+async def test_find(tmp_path):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    job_db = SqliteDB.open(path).job_db
+
+    job_db.insert(make_job("adhoc-1"))
+    assert await job_db.find(make_job(None)) == "adhoc-1"
+    job = Job(None, [], [], NoOpProgram(duration="2"), ad_hoc=True)
+    assert await job_db.find(job) is None
+
+
+def test_archive_jobs(tmp_path):
+    path = tmp_path / "apsis.db"
+    archive_path = tmp_path / "archive.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path)
+
+    for job_id in ("adhoc-1", "adhoc-2", "adhoc-3"):
+        db.job_db.insert(make_job(job_id))
+    runs = [
+        make_run(1, "adhoc-1"),
+        make_run(2, "adhoc-2"),
+        make_run(3, "adhoc-2"),
+        make_run(4, "adhoc-3"),
+    ]
+    for run in runs:
+        db.run_db.upsert(run)
+    db.run_db.flush().result()
+
+    # adhoc-2 has a remaining run, and adhoc-3 is kept.
+    counts = db.archive(archive_path, ["r1", "r2", "r4"], keep_job_ids={"adhoc-3"})
+    assert counts["jobs"] == 1
+    assert { j.job_id for j in db.job_db.query() } == {"adhoc-2", "adhoc-3"}
+    with closing(sqlite3.connect(archive_path)) as conn:
+        assert list(conn.execute("SELECT job_id FROM jobs")) == [("adhoc-1", )]
+
+    counts = db.archive(archive_path, ["r3"])
+    assert counts["jobs"] == 1
+    assert { j.job_id for j in db.job_db.query() } == {"adhoc-3"}
+
+
+
+
+@pytest.mark.asyncio
+async def test_archive_pinned_job(tmp_path):
+    path = tmp_path / "apsis.db"
+    archive_path = tmp_path / "archive.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path)
+
+    db.job_db.insert(make_job("adhoc-1"))
+    run = make_run(1, "adhoc-1")
+    db.run_db.upsert(run)
+    db.run_db.flush().result()
+
+    # A found job is pinned, so archiving its last run keeps it.
+    assert await db.job_db.find(make_job(None)) == "adhoc-1"
+    counts = db.archive(archive_path, ["r1"])
+    assert counts["jobs"] == 0
+    assert db.job_db.get("adhoc-1").job_id == "adhoc-1"
+
+    # Once unpinned, it's archived and evicted from the cache.
+    db.job_db.unpin("adhoc-1")
+    db.thread.call(lambda: None)
+    db.run_db.upsert(make_run(2, "adhoc-1"))
+    db.run_db.flush().result()
+    counts = db.archive(archive_path, ["r2"])
+    assert counts["jobs"] == 1
+    with pytest.raises(LookupError):
+        db.job_db.get("adhoc-1")
+
+
+@pytest.mark.asyncio
+async def test_fetch_and_preload(tmp_path):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path)
+    for job_id in ("adhoc-1", "adhoc-2", "adhoc-3"):
+        db.job_db.insert(make_job(job_id))
+    db.close()
+
+    # Reopen, with an empty cache.
+    job_db = SqliteDB.open(path).job_db
+    assert (await job_db.fetch("adhoc-1")).job_id == "adhoc-1"
+    assert job_db.get_stats()["cache_misses"] == 1
+    with pytest.raises(LookupError):
+        await job_db.fetch("adhoc-9")
+
+    job_db.preload(["adhoc-2", "adhoc-3", "adhoc-9"])
+    assert job_db.get_stats()["len_cache"] == 1
+    assert job_db.get_stats()["len_held"] == 2
+    assert job_db.get("adhoc-2").job_id == "adhoc-2"
+    assert (await job_db.fetch("adhoc-3")).job_id == "adhoc-3"
+    assert job_db.get_stats()["cache_misses"] == 2
+
+
+def test_preload_beyond_cache_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(JobDB, "CACHE_SIZE", 16)
+    job_ids = [ f"adhoc-{i}" for i in range(40) ]
+
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path)
+    for job_id in job_ids:
+        db.job_db.insert(make_job(job_id))
+    db.close()
+
+    db = SqliteDB.open(path)
+    job_db = db.job_db
+    job_db.preload(job_ids)
+    # Fill the LRU cache with other jobs.
+    for i in range(2 * JobDB.CACHE_SIZE):
+        job_db.insert(make_job(f"other-{i}"))
+
+    # Preloaded jobs are held, so getting them doesn't use the DB thread.
+    def call(*args, **kw_args):
+        raise AssertionError("blocked on DB thread")
+    monkeypatch.setattr(db.thread, "call", call)
+    for job_id in job_ids:
+        assert job_db.get(job_id).job_id == job_id
+    assert job_db.get_stats()["cache_misses"] == 0
+    db.close()
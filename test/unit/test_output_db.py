@@ -1,34 +1,40 @@
 import brotli
+from   contextlib import closing
+import os
 import pytest
+import sqlite3
 
-from   apsis.sqlite import SqliteDB
+from   apsis.sqlite import SqliteDB, get_blob_path
 from   apsis.program import OutputMetadata, Output
 
 #-------------------------------------------------------------------------------
 
-def test_basic(tmp_path):
+@pytest.mark.asyncio
+async def test_basic(tmp_path):
     path = tmp_path / "apsis.db"
 
     SqliteDB.create(path=path)
     db = SqliteDB.open(path).output_db
 
-    len(db.get_metadata("r42")) == 0
+    assert len(await db.get_metadata("r42")) == 0
 
     with pytest.raises(LookupError):
-        db.get_output("r42", "output")
+        await db.get_output("r42", "output")
 
     data = b"The quick brown fox jumped over the lazy dogs.\x01\x02\x03"
     output = Output(OutputMetadata("combined output", len(data)), data)
     db.upsert("r42", "output", output)
 
-    meta = db.get_metadata("r42")
+    # Reads are queued behind the write.
+    meta = await db.get_metadata("r42")
     assert list(meta.keys()) == ["output"]
     assert meta["output"].name == "combined output"
 
-    assert db.get_output("r42", "output").data == data
+    assert (await db.get_output("r42", "output")).data == data
 
 
-def test_br(tmp_path):
+@pytest.mark.asyncio
+async def test_br(tmp_path):
     DATA = bytes(range(256)) * 40960  # 10 MB; definitely not UTF-8.
     path = tmp_path / "apsis.db"
 
@@ -37,10 +43,10 @@ def test_br(tmp_path):
     db.upsert("r99", "test", Output(
         OutputMetadata("program output", len(DATA)),
         brotli.compress(DATA), "br",
-    ))
+    )).result()
 
     db = SqliteDB.open(path).output_db
-    output = db.get_output("r99", "test")
+    output = await db.get_output("r99", "test")
     assert output.metadata.name == "program output"
     assert output.metadata.length == 10485760
     assert output.metadata.content_type == "application/octet-stream"
@@ -50,3 +56,39 @@ def test_br(tmp_path):
     assert data == DATA
 
 
+@pytest.mark.asyncio
+async def test_blob(tmp_path):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path).output_db
+
+    # Large, incompressible outputs go to the blob store.
+    data = os.urandom(2 * db.BLOB_MIN_SIZE)
+    output = Output(OutputMetadata("output", len(data)), data)
+    db.upsert("r1", "output", output)
+    # Identical data in another run.
+    db.upsert("r2", "output", output).result()
+
+    with closing(sqlite3.connect(path)) as conn:
+        rows = list(conn.execute(
+            "SELECT run_id, length(data), hash FROM output ORDER BY run_id"))
+    (_, len1, hash1), (_, len2, hash2) = rows
+    assert len1 == len2 == 0
+    assert hash1 is not None
+    assert hash1 == hash2
+    # One blob file, stored once.
+    blobs = [ p for p in get_blob_path(path).rglob("*") if p.is_file() ]
+    assert len(blobs) == 1
+
+    output = await db.get_output("r2", "output")
+    assert output.metadata.length == len(data)
+    assert output.compression == "br"
+    assert output.get_uncompressed_data() == data
+
+    # Small outputs stay in the DB.
+    db.upsert("r3", "output", Output(OutputMetadata("output", 5), b"hello"))
+    output = await db.get_output("r3", "output")
+    assert output.data == b"hello"
+    assert output.compression is None
+
+
@@ -0,0 +1,46 @@
+import random
+
+from   apsis.lib.rope import Rope, flatten
+
+#-------------------------------------------------------------------------------
+
+def test_append():
+    rope = Rope(b"Hello, ")
+    a = rope + b"world" + b"!"
+    # Extending the same rope again doesn't disturb the first extension.
+    b = rope + b"there."
+    assert bytes(rope) == b"Hello, "
+    assert bytes(a) == b"Hello, world!"
+    assert bytes(b) == b"Hello, there."
+    assert len(a) == 13
+    assert len(Rope()) == 0
+    assert flatten(a) == b"Hello, world!"
+    assert flatten(b"bytes") == b"bytes"
+
+
+def test_slice():
+    rope = Rope(b"abc") + b"defg" + b"hij"
+    # Slices within a chunk are views.
+    assert isinstance(rope[3 : 6], memoryview)
+    assert bytes(rope[3 : 6]) == b"def"
+    assert rope[2 : 8] == b"cdefgh"
+    assert rope[-2 :] == b"ij"
+    assert rope[5 : 2] == b""
+    assert rope[4] == ord("e")
+    assert rope[-1] == ord("j")
+
+
+def test_random():
+    data = b""
+    rope = Rope()
+    for _ in range(100):
+        chunk = random.randbytes(random.randrange(16))
+        data += chunk
+        rope += chunk
+    assert bytes(rope) == data
+    for _ in range(1000):
+        start = random.randrange(-4, len(data) + 4)
+        stop = random.randrange(-4, len(data) + 4)
+        assert bytes(rope[start : stop]) == data[start : stop]
+
+
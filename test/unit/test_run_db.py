@@ -0,0 +1,322 @@
+from   contextlib import closing
+import ora
+import pytest
+import sqlite3
+
+from   apsis.program import NoOpProgram
+from   apsis.runs import Instance, Run
+from   apsis.sqlite import SqliteDB, SCHEMA_VERSION, AUTO_VACUUM_INCREMENTAL
+from   apsis.states import State
+
+#-------------------------------------------------------------------------------
+
+def make_run(number, job_id="job", **args):
+    run = Run(Instance(job_id, args))
+    run.run_id = f"r{number}"
+    run.timestamp = ora.now()
+    return run
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path / "apsis.db"
+
+
+@pytest.fixture
+def db(path):
+    SqliteDB.create(path=path)
+    with closing(SqliteDB.open(path)) as db:
+        yield db
+
+
+def count_rows(path):
+    with closing(sqlite3.connect(path)) as conn:
+        (count, ), = conn.execute("SELECT COUNT(*) FROM runs")
+    return count
+
+
+def test_write_behind(path, db):
+    db = db.run_db
+
+    runs = [ make_run(i, fruit="mango") for i in range(1, 11) ]
+    for run in runs:
+        db.upsert(run)
+    # Nothing written yet.
+    assert db.get_stats()["queue_depth"] == 10
+    assert count_rows(path) == 0
+
+    db.flush().result()
+    assert db.get_stats()["queue_depth"] == 0
+    assert db.get_stats()["flush_rows"] == 10
+    assert count_rows(path) == 10
+
+    # Multiple changes to the same run coalesce.
+    run = runs[3]
+    run._transition(ora.now(), State.scheduled)
+    db.upsert(run)
+    run._transition(ora.now(), State.waiting)
+    db.upsert(run)
+    assert db.get_stats()["queue_depth"] == 1
+    db.flush().result()
+    assert db.get_stats()["flush_rows"] == 1
+    assert count_rows(path) == 10
+
+    run = db.get("r4")
+    assert run.state == State.waiting
+    assert run.inst.args == {"fruit": "mango"}
+
+
+def test_flush_max_pending(path, db):
+    db = db.run_db
+
+    n = db.MAX_PENDING
+    for i in range(1, n):
+        db.upsert(make_run(i))
+    assert count_rows(path) == 0
+    # One more fills the queue, and triggers a flush.
+    db.upsert(make_run(n))
+    assert db.get_stats()["queue_depth"] == 0
+    # Wait for the write.
+    db.flush().result()
+    assert count_rows(path) == n
+    assert db.get_stats()["flush_count"] == 1
+
+
+def test_flush_max_pending_failure(path, db, caplog):
+    # Break the database, so writes fail.
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute("DROP TABLE runs")
+        conn.commit()
+
+    for i in range(1, db.run_db.MAX_PENDING + 1):
+        db.run_db.upsert(make_run(i))
+    # Wait for the write.
+    db.thread.call(lambda: None)
+    # The failed flush triggered by the full queue is logged, and the runs are
+    # requeued.
+    assert db.run_db.get_stats()["queue_depth"] == db.run_db.MAX_PENDING
+    assert "DB call failed: RunDB.flush" in caplog.text
+
+
+def test_migrate(tmp_path):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path)
+    db.run_db.upsert(make_run(1, fruit="mango"))
+    run = make_run(2)
+    run._transition(ora.now(), State.scheduled)
+    db.run_db.upsert(run)
+    db.close()
+
+    # Downgrade to schema version 0, with state names.
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute("DROP INDEX idx_runs_job_id_timestamp")
+        conn.execute("DROP INDEX idx_runs_timestamp")
+        conn.execute("DROP INDEX idx_runs_state_timestamp")
+        for state in State:
+            conn.execute(
+                "UPDATE runs SET state = ? WHERE state = ?",
+                (state.name, state.value)
+            )
+        conn.execute("PRAGMA user_version = 0")
+        conn.commit()
+
+    with pytest.raises(RuntimeError):
+        SqliteDB.open(path)
+
+    assert SqliteDB.migrate(path) == 0
+    assert SqliteDB.migrate(path) == SCHEMA_VERSION
+
+    with closing(sqlite3.connect(path)) as conn:
+        rows = list(conn.execute("SELECT run_id, state FROM runs ORDER BY rowid"))
+        assert rows == [("r1", State.new.value), ("r2", State.scheduled.value)]
+        indexes = { n for n, in conn.execute(
+            "SELECT name FROM sqlite_master WHERE tbl_name = 'runs' "
+            "AND type = 'index'"
+        ) }
+        assert "idx_runs_state_timestamp" in indexes
+
+    with closing(SqliteDB.open(path)) as db:
+        runs = { r.run_id: r for r in db.run_db.query(job_id="job") }
+    assert runs["r1"].state == State.new
+    assert runs["r1"].inst.args == {"fruit": "mango"}
+    assert runs["r2"].state == State.scheduled
+
+
+@pytest.mark.asyncio
+async def test_query_page(db):
+    db = db.run_db
+
+    time = ora.now()
+    for i in range(1, 26):
+        run = make_run(
+            i, job_id="job" if i % 2 == 0 else "other", fruit=f"f{i % 3}")
+        if i % 5 == 0:
+            run._transition(ora.now(), State.scheduled)
+        # Some runs share a timestamp.  Set it after the transition, which
+        # also sets the timestamp.
+        run.timestamp = time + i // 2
+        db.upsert(run)
+
+    # Page through all runs.
+    run_ids = []
+    key = None
+    while True:
+        runs, key = await db.query_page(limit=10, after=key)
+        assert len(runs) <= 10
+        run_ids.extend( r.run_id for r in runs )
+        if key is None:
+            break
+    # Newest first.
+    assert run_ids == [ f"r{i}" for i in range(25, 0, -1) ]
+
+    runs, key = await db.query_page(job_id="job", with_args={"fruit": "f1"})
+    assert [ r.run_id for r in runs ] == ["r22", "r16", "r10", "r4"]
+    assert key is None
+
+    runs, _ = await db.query_page(state=State.scheduled, until=time + 10)
+    assert [ r.run_id for r in runs ] == ["r15", "r10", "r5"]
+
+    runs, _ = await db.query_page(since=time + 11)
+    assert [ r.run_id for r in runs ] == ["r25", "r24", "r23", "r22"]
+
+
+@pytest.mark.asyncio
+async def test_run_log_buffer(path, db):
+    db = db.run_log_db
+
+    def count_records():
+        with closing(sqlite3.connect(path)) as conn:
+            (count, ), = conn.execute("SELECT COUNT(*) FROM run_history")
+        return count
+
+    time = ora.now()
+    db.insert("r1", time, "scheduled")
+    db.insert("r2", time, "scheduled")
+    db.insert("r1", time + 1, "running")
+    assert db.get_stats()["queue_depth"] == 3
+    assert count_records() == 0
+
+    # Queries include buffered records.
+    recs = await db.query(run_id="r1")
+    assert [ r["message"] for r in recs ] == ["scheduled", "running"]
+
+    db.flush().result()
+    assert db.get_stats()["queue_depth"] == 0
+    assert db.get_stats()["flush_rows"] == 3
+    assert count_records() == 3
+
+    db.insert("r1", time + 2, "success")
+    recs = await db.query(run_id="r1")
+    assert [ r["message"] for r in recs ] == ["scheduled", "running", "success"]
+
+    # A full buffer is flushed.
+    for i in range(db.MAX_PENDING - 1):
+        db.insert("r3", time, f"message {i}")
+    assert db.get_stats()["queue_depth"] == 0
+    db.flush().result()
+    assert count_records() == 3 + db.MAX_PENDING
+
+
+def test_incremental_vacuum(path, db):
+    for i in range(1, 1001):
+        db.run_db.upsert(make_run(i, message="x" * 1000))
+    db.run_db.flush().result()
+
+    with closing(sqlite3.connect(path)) as conn:
+        (auto_vacuum, ), = conn.execute("PRAGMA auto_vacuum")
+        assert auto_vacuum == AUTO_VACUUM_INCREMENTAL
+        conn.execute("DELETE FROM runs")
+        conn.commit()
+
+    # Free pages in steps.
+    free = db.vacuum(pages=4)
+    assert free > 0
+    assert db.vacuum() == 0
+
+
+@pytest.mark.asyncio
+async def test_checkpoint(tmp_path):
+    path = tmp_path / "apsis.db"
+    ckpt_path = tmp_path / "apsis.db.checkpoint"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path)
+    runs = [ make_run(i, fruit="mango") for i in range(1, 11) ]
+    for run in runs:
+        db.run_db.upsert(run)
+    assert await db.run_db.checkpoint(
+        ckpt_path, lambda: runs, min_timestamp=None) == 10
+
+    # Change runs after the checkpoint.
+    runs[2]._transition(ora.now(), State.scheduled)
+    db.run_db.upsert(runs[2])
+    db.run_db.upsert(make_run(11))
+    db.close()
+
+    db = SqliteDB.open(path)
+    loaded = db.run_db.load_checkpoint(ckpt_path, min_timestamp=None)
+    loaded = { r.run_id: r for r in loaded }
+    assert len(loaded) == 11
+    assert loaded["r3"].state == State.scheduled
+    assert loaded["r4"].inst.args == {"fruit": "mango"}
+
+    # The checkpoint doesn't include runs before its min timestamp.
+    assert db.run_db.load_checkpoint(ckpt_path, min_timestamp=None) is not None
+    await db.run_db.checkpoint(
+        ckpt_path, lambda: runs, min_timestamp=runs[5].timestamp)
+    assert db.run_db.load_checkpoint(ckpt_path, min_timestamp=None) is None
+    db.close()
+
+    # Inserting a run with an earlier run ID, as for an expected run that
+    # leaves the scheduled state, doesn't invalidate the checkpoint.
+    db = SqliteDB.open(path)
+    db.run_db.upsert(make_run(0))
+    db.run_db.flush().result()
+    loaded = db.run_db.load_checkpoint(
+        ckpt_path, min_timestamp=runs[5].timestamp)
+    assert "r0" in { r.run_id for r in loaded }
+    db.close()
+
+    # Deleting runs invalidates the checkpoint.
+    with closing(sqlite3.connect(path)) as conn:
+        conn.execute("DELETE FROM runs WHERE run_id = 'r8'")
+        conn.commit()
+    with closing(SqliteDB.open(path)) as db:
+        assert db.run_db.load_checkpoint(
+            ckpt_path, min_timestamp=runs[5].timestamp) is None
+
+
+def test_lazy_decode(db):
+    db = db.run_db
+
+    run = make_run(1)
+    run.program = NoOpProgram(duration="1")
+    run._transition(
+        ora.now(), State.scheduled,
+        meta={"fruit": "mango", "labels": ["ripe"]},
+    )
+    db.upsert(run)
+    run = make_run(2)
+    run._transition(ora.now(), State.scheduled, meta={"fruit": "kiwi"})
+    db.upsert(run)
+
+    run = db.get("r1")
+    # Not decoded yet.
+    assert isinstance(run._meta, str)
+    assert isinstance(run._program, str)
+    # Labels are available without decoding meta.
+    assert run.labels == ["ripe"]
+    assert isinstance(run._meta, str)
+    assert run.meta == {"fruit": "mango", "labels": ["ripe"]}
+    assert run.labels == ["ripe"]
+    assert isinstance(run.program, NoOpProgram)
+    assert run.run_state is None
+
+    # Rewriting a run doesn't require decoding it.
+    run = db.get("r2")
+    run.message = "hello"
+    db.upsert(run)
+    run = db.get("r2")
+    assert run.labels == []
+    assert run.meta == {"fruit": "kiwi"}
+    assert run.message == "hello"
@@ -1,20 +1,35 @@
+import asyncio
 import ora
+import pytest
 import random
 
-from   apsis.runs import Instance, Run, RunStore
+from   apsis.runs import Instance, Run, RunStore, _RunPredicate
+from   apsis.states import State
 
 #-------------------------------------------------------------------------------
 
 class MockRunDb:
 
-    def __init__(self, runs=()):
+    def __init__(self, runs=(), checkpoint_runs=None):
         self.__runs = runs
+        self.__checkpoint_runs = checkpoint_runs
 
 
     def query(self, min_timestamp=None):
         return iter(self.__runs)
 
 
+    def load_checkpoint(self, path, *, min_timestamp):
+        return (
+            None if self.__checkpoint_runs is None
+            else iter(self.__checkpoint_runs)
+        )
+
+
+    async def checkpoint(self, path, get_runs, *, min_timestamp):
+        pass
+
+
     def upsert(self, run):
         pass
 
@@ -34,9 +49,10 @@ class MockRunIdDb:
 
 class MockDb:
 
-    def __init__(self, runs=()):
-        self.run_db = MockRunDb(runs)
+    def __init__(self, runs=(), *, checkpoint_runs=None, checkpoint_path=None):
+        self.run_db = MockRunDb(runs, checkpoint_runs)
         self.next_run_id_db = MockRunIdDb()
+        self.checkpoint_path = checkpoint_path
 
 
 
@@ -166,3 +182,229 @@ def test_run_store_populate():
         assert len(run_store.query(job_id=job_id)[1]) == 0
 
 
+def test_run_store_populate_checkpoint():
+    """
+    Tests a RunStore populated from a checkpoint, or from the run DB if the
+    checkpoint is not valid.
+    """
+    run_ids = MockRunIdDb()
+    def make_run(job_id):
+        run = Run(Instance(job_id, {}), expected=True)
+        run.run_id = run_ids.get_next_run_id()
+        return run
+
+    db_runs = [ make_run("db") for _ in range(10) ]
+    ckpt_runs = [ make_run("checkpoint") for _ in range(5) ]
+
+    # No checkpoint path; the checkpoint isn't consulted.
+    db = MockDb(db_runs, checkpoint_runs=ckpt_runs)
+    _, runs = RunStore(db, min_timestamp=ora.now()).query()
+    assert set(runs) == set(db_runs)
+
+    # A valid checkpoint.
+    db = MockDb(db_runs, checkpoint_runs=ckpt_runs, checkpoint_path="ckpt")
+    _, runs = RunStore(db, min_timestamp=ora.now()).query()
+    assert set(runs) == set(ckpt_runs)
+
+    # An invalid checkpoint; falls back to the run DB.
+    db = MockDb(db_runs, checkpoint_path="ckpt")
+    _, runs = RunStore(db, min_timestamp=ora.now()).query()
+    assert set(runs) == set(db_runs)
+
+
+def test_run_store_populate_lazy():
+    """
+    Tests that populating and querying a RunStore doesn't decode the JSON
+    fields of runs loaded from the run DB.
+    """
+    run_ids = MockRunIdDb()
+    def make_run(i):
+        run = Run(Instance(f"job{i % 3}", {}))
+        run.run_id = run_ids.get_next_run_id()
+        run.timestamp = ora.now()
+        # As loaded from the run DB.
+        run.program = '{"type": "apsis.program.NoOpProgram"}'
+        run.meta = f'{{"i": {i}}}'
+        run.run_state = '{"pid": 42}'
+        return run
+
+    runs = [ make_run(i) for i in range(10) ]
+    run_store = RunStore(MockDb(runs), min_timestamp=ora.now())
+    assert len(run_store.query(job_id="job1")[1]) == 3
+    assert len(run_store.query(state=State.new)[1]) == 10
+    for run in runs:
+        assert isinstance(run._program, str)
+        assert isinstance(run._meta, str)
+        assert isinstance(run._run_state, str)
+
+    _, run = run_store.get(runs[4].run_id)
+    assert run.meta == {"i": 4}
+    assert run.run_state == {"pid": 42}
+    assert not isinstance(run._meta, str)
+
+
+def test_run_store_indexes():
+    """
+    Tests queries by state, instance, and timestamp against a scan.
+    """
+    rnd = random.Random(0)
+    n = 2000
+
+    run_store = RunStore(MockDb(), min_timestamp=ora.now())
+    runs = []
+    for _ in range(n):
+        inst = Instance(f"job{rnd.randrange(10)}", {"x": rnd.randrange(5)})
+        run = Run(inst)
+        run_store.add(run)
+        runs.append(run)
+
+    time = ora.now()
+    states = [State.scheduled, State.waiting, State.starting, State.running]
+    for i, run in enumerate(runs):
+        for state in states[: rnd.randrange(len(states) + 1)]:
+            timestamp = time + i
+            run._transition(timestamp, state)
+            run_store.update(run, timestamp)
+
+    # Remove some runs.
+    for run in rnd.sample(runs, n // 10):
+        run_store.remove(run.run_id, expected=False)
+        runs.remove(run)
+
+    def check(**kw_args):
+        _, result = run_store.query(**kw_args)
+        assert len(result) == len(set(result))
+        assert set(result) == set(filter(_RunPredicate(**kw_args), runs))
+
+    for state in State:
+        check(state=state)
+    check(state=states[1 :])
+    for j in range(10):
+        for x in range(5):
+            check(job_id=f"job{j}", args={"x": x})
+            check(job_id=f"job{j}", args={"x": x}, state=State.running)
+    for i in range(0, n, 97):
+        check(since=time + i)
+        check(since=time + i, state=State.waiting)
+
+    # Retire runs before a time.
+    for run in runs:
+        if run.state != State.new:
+            run._transition(run.timestamp, State.success, force=True)
+            run_store.update(run, run.timestamp)
+    run_store.retire_old(time + n // 2)
+    _, result = run_store.query()
+    assert all(
+        r.timestamp >= time + n // 2 or not r.state.finished
+        for r in result
+    )
+
+
+@pytest.mark.asyncio
+async def test_wait_slot():
+    run_store = RunStore(MockDb(), min_timestamp=ora.now())
+    inst = Instance("job", {"fruit": "mango"})
+    states = (State.starting, State.running)
+
+    def transition(run, state):
+        run._transition(ora.now(), state, force=True)
+        run_store.update(run, run.timestamp)
+
+    # Two runs running, with a limit of two.
+    running = [ Run(inst) for _ in range(2) ]
+    for run in running:
+        run_store.add(run)
+        transition(run, State.running)
+    assert run_store.count(inst, states) == 2
+    assert run_store.count(Instance("job", {}), states) == 0
+
+    released = []
+    async def wait(i):
+        await run_store.wait_slot(inst, states, 2)
+        released.append(i)
+    tasks = [ asyncio.create_task(wait(i)) for i in range(5) ]
+    await asyncio.sleep(0)
+    assert released == []
+
+    # Cancel one waiter.
+    tasks[1].cancel()
+
+    # One run finishes, which releases exactly one waiter.
+    transition(running[0], State.success)
+    assert run_store.count(inst, states) == 1
+    await asyncio.sleep(0)
+    assert released == [0]
+
+    # The other finishes, which releases two more.
+    transition(running[1], State.success)
+    await asyncio.sleep(0)
+    assert released == [0, 2, 3]
+    assert run_store.count(inst, states) == 0
+
+    # A new run starts, taking one slot; the last waiter gets the other.
+    run = Run(inst)
+    run_store.add(run)
+    transition(run, State.running)
+    await asyncio.sleep(0)
+    assert released == [0, 2, 3, 4]
+    assert all( t.done() for t in tasks )
+
+
+@pytest.mark.asyncio
+async def test_wait_slot_retry():
+    run_store = RunStore(MockDb(), min_timestamp=ora.now())
+    inst = Instance("job", {})
+    states = (State.starting, State.running)
+
+    def transition(run, state):
+        run._transition(ora.now(), state, force=True)
+        run_store.update(run, run.timestamp)
+
+    def start():
+        run = Run(inst)
+        run_store.add(run)
+        transition(run, State.running)
+        return run
+
+    # One run running, with a limit of one.
+    run = start()
+
+    released = []
+    async def wait(i):
+        retry = False
+        while True:
+            await run_store.wait_slot(inst, states, 1, retry=retry)
+            if run_store.count(inst, states) < 1:
+                break
+            retry = True
+        released.append(i)
+    tasks = [ asyncio.create_task(wait(i)) for i in range(3) ]
+    await asyncio.sleep(0)
+
+    # The run finishes, but another takes the slot before the released waiter
+    # resumes.  The waiter waits again, keeping its place at the front.
+    transition(run, State.success)
+    run = start()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert released == []
+
+    transition(run, State.success)
+    await asyncio.sleep(0)
+    assert released == [0]
+
+    # Waiter 0 doesn't take the slot, so the next waiter is released.
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert released == [0, 1]
+
+    # Waiter 1 takes the slot.
+    run = start()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert released == [0, 1]
+
+    transition(run, State.success)
+    await asyncio.sleep(0)
+    assert released == [0, 1, 2]
+    assert all( t.done() for t in tasks )
@@ -1,4 +1,4 @@
-from   apsis.runs import Instance
+from   apsis.runs import Instance, Run
 
 #-------------------------------------------------------------------------------
 
@@ -8,3 +8,15 @@ def test_instance_args_sort():
     assert tuple(i.args.values()) == ("17", "0", "42")
 
 
+def test_run_update_program_conds():
+    run = Run(Instance("test_job_id", {}))
+    assert run.program is None
+    assert run.conds is None
+    version = run._version
+
+    program = object()
+    run._update(program=program, conds=[])
+    assert run.program is program
+    assert run.conds == []
+    assert run._version > version
+
@@ -0,0 +1,137 @@
+import ora
+from   pathlib import Path
+import pytest
+
+import apsis.config
+from   apsis.jobs import Job
+from   apsis.schedule import IntervalSchedule
+from   apsis.scheduler import Scheduler, get_runs_to_schedule
+
+#-------------------------------------------------------------------------------
+
+class MockJobs:
+
+    def __init__(self, jobs):
+        self.__jobs = { j.job_id: j for j in jobs }
+
+
+    def get_job(self, job_id):
+        try:
+            return self.__jobs[job_id]
+        except KeyError:
+            raise LookupError(job_id)
+
+
+    def get_jobs(self, *, ad_hoc=None):
+        return (
+            j for j in self.__jobs.values()
+            if ad_hoc is None or j.ad_hoc == ad_hoc
+        )
+
+
+
+def make_job(job_id, interval, *, enabled=True):
+    return Job(
+        job_id, ["time"],
+        [IntervalSchedule(interval, {}, enabled=enabled)],
+    )
+
+
+def make_scheduler(jobs, start):
+    scheduled = []
+
+    async def schedule(time, run):
+        scheduled.append((time, run.inst.job_id, run.inst.args["time"]))
+
+    return Scheduler({}, MockJobs(jobs), schedule, start), scheduled
+
+
+@pytest.mark.asyncio
+async def test_scheduler():
+    start = ora.Time("2024-01-01T00:00:00Z")
+    jobs = [
+        make_job("fast", 60),
+        make_job("slow", 3600),
+        make_job("disabled", 60, enabled=False),
+    ]
+    scheduler, scheduled = make_scheduler(jobs, start)
+
+    # Schedule in steps.
+    for i in range(1, 10):
+        await scheduler.schedule(start + 1000 * i)
+    assert scheduler.get_scheduler_time() == start + 9000
+
+    # Same runs as scheduling all at once, in time order.
+    expected = sorted(
+        (t, r.inst.job_id, r.inst.args["time"])
+        for j in jobs
+        for t, r in get_runs_to_schedule(j, start, start + 9000)
+    )
+    assert sorted(scheduled) == expected
+    assert [ t for t, _, _ in scheduled ] == sorted( t for t, _, _ in expected )
+    assert len([ s for s in scheduled if s[1] == "slow" ]) == 3
+
+
+@pytest.mark.asyncio
+async def test_scheduler_set_jobs():
+    start = ora.Time("2024-01-01T00:00:00Z")
+    jobs = [make_job("a", 600), make_job("b", 600)]
+    scheduler, scheduled = make_scheduler(jobs, start)
+    await scheduler.schedule(start + 3000)
+    assert len(scheduled) == 10
+
+    # Change "a", remove "b", add "c".
+    jobs = [make_job("a", 1200), make_job("c", 1800)]
+    scheduler.set_jobs(MockJobs(jobs), {"a", "b", "c"})
+    scheduled.clear()
+    await scheduler.schedule(start + 6000)
+    assert sorted( (t - start, j) for t, j, _ in scheduled ) == [
+        (3600, "a"), (3600, "c"), (4800, "a"), (5400, "c"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_expected_insts():
+    start = ora.Time("2024-01-01T00:00:00Z")
+    jobs = [make_job("a", 600), make_job("b", 900)]
+    scheduler, scheduled = make_scheduler(jobs, start)
+    await scheduler.schedule(start + 1800)
+
+    # Expected runs start at the scheduler time.
+    insts = list(scheduler.get_expected_insts(start, start + 3600))
+    assert [ (t - start, i.job_id) for t, i in insts ] == [
+        (1800, "a"), (1800, "b"), (2400, "a"), (2700, "b"), (3000, "a"),
+    ]
+    assert insts[0][1].args == {"time": str(start + 1800)}
+
+    insts = list(scheduler.get_expected_insts(
+        start + 2000, start + 3600, job_id="b"))
+    assert [ t - start for t, _ in insts ] == [2700]
+
+    # Scheduling creates exactly the expected runs.
+    await scheduler.schedule(start + 3600)
+    assert sorted( (t - start, j) for t, j, _ in scheduled[-5 :] ) == [
+        (1800, "a"), (1800, "b"), (2400, "a"), (2700, "b"), (3000, "a"),
+    ]
+    assert list(scheduler.get_expected_insts(start, start + 3600)) == []
+
+
+
+
+def test_scheduler_lead():
+    start = ora.Time("2024-01-01T00:00:00Z")
+    jobs = MockJobs([make_job("job", 3600)])
+    cfg = {"schedule": {"horizon": 7200, "lead": 3600}}
+    assert Scheduler(cfg, jobs, None, start).horizon == 7200
+
+    for lead in (0, -60, 10800):
+        cfg = {"schedule": {"horizon": 7200, "lead": lead}}
+        with pytest.raises(ValueError):
+            Scheduler(cfg, jobs, None, start)
+
+        # Config checking falls back to the horizon.
+        cfg = apsis.config.check(cfg, Path.cwd())
+        assert cfg["schedule"]["lead"] is None
+        Scheduler(cfg, jobs, None, start)
+
+
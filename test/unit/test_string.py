@@ -0,0 +1,52 @@
+import itertools
+
+from   apsis.lib.string import WordPrefixIndex, split_words
+
+#-------------------------------------------------------------------------------
+
+JOB_IDS = [
+    "daily/report",
+    "daily/report-summary",
+    "hourly/sync",
+    "hourly/sync_prices",
+    "weekly/cleanup",
+    "reports/daily/export",
+]
+
+def brute_force_match(strings, target):
+    target_words = split_words(target)
+    return {
+        s for s in strings
+        if all(
+            any( w.startswith(t) for w in split_words(s) )
+            for t in target_words
+        )
+    }
+
+
+def test_word_prefix_index():
+    index = WordPrefixIndex(JOB_IDS)
+    assert len(index) == len(JOB_IDS)
+    assert "hourly/sync" in index
+    assert "hourly" not in index
+
+    assert index.match("weekly/cleanup") == {"weekly/cleanup"}
+    assert index.match("week") == {"weekly/cleanup"}
+    assert index.match("sync") == {"hourly/sync", "hourly/sync_prices"}
+    assert index.match("sync pri") == {"hourly/sync_prices"}
+    assert index.match("daily/rep") == {
+        "daily/report", "daily/report-summary", "reports/daily/export"}
+    assert index.match("daily report summ") == {"daily/report-summary"}
+    assert index.match("monthly") == set()
+    assert index.match("") == set(JOB_IDS)
+
+
+def test_word_prefix_index_brute_force():
+    index = WordPrefixIndex(JOB_IDS)
+    words = { w for j in JOB_IDS for w in split_words(j) } | {"", "x"}
+    prefixes = { w[: n] for w in words for n in range(len(w) + 1) }
+    for p0, p1 in itertools.product(prefixes, repeat=2):
+        target = p0 + "/" + p1
+        assert index.match(target) == brute_force_match(JOB_IDS, target)
+
+
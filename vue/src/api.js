@@ -44,10 +44,17 @@ export function getRunUrl(run_id) {
   return getUrl('runs', run_id)
 }
 
-export function getSummaryUrl(init) {
+/**
+ * @param init - if true, request the full summary state
+ * @param since - if not null, request messages after this sequence number;
+ *   the server sends the full state if it can't
+ */
+export function getSummaryUrl(init, since = null) {
   const url = getUrl('summary')
   url.protocol = 'ws'
-  if (init)
+  if (since !== null)
+    url.search = '?since=' + since
+  else if (init)
     url.search = '?init'
   return url
 }
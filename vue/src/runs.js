@@ -44,6 +44,7 @@ export function clearRunState(state) {
   state.runs = new Map()
   state.jobs = new Map()
   state.agentConns = new Map()
+  state.summarySeq = null
 }
 
 /**
@@ -58,11 +59,27 @@ export function processMsgs(msgs, state) {
 
   let stats = {job: 0, agentConn: 0, run: 0}
 
-  // Pre-sort by time, to keep future sorts quick.
-  msgs = sortBy(msgs, m => m.run_summary && timeKey(m.run_summary))
+  // Pre-sort by time, to keep future sorts quick.  A resync comes first, as
+  // the full state follows it.
+  msgs = sortBy(
+    msgs,
+    m => m.type === 'resync' ? '' : m.run_summary && timeKey(m.run_summary))
+
+  for (const msg of msgs) {
+    // Track the sequence number, so we can resume from it on reconnect.
+    if (msg.seq !== undefined
+        && (state.summarySeq === null || msg.seq > state.summarySeq))
+      state.summarySeq = msg.seq
 
-  for (const msg of msgs)
     switch (msg.type) {
+      // The server will send all runs and jobs again.
+      case 'resync':
+        agentConns = new Map()
+        jobs = new Map()
+        runs = new Map()
+        state.summarySeq = msg.seq
+        break
+
       case 'agent_conn':
         if (agentConns === null)
           agentConns = new Map(state.agentConns)
@@ -115,6 +132,7 @@ export function processMsgs(msgs, state) {
         stats.run++
         break
     }
+  }
 
   // Set new maps to trigger reactivity updates.
   if (agentConns !== null)
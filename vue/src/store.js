@@ -52,6 +52,9 @@ class Store {
 
     // Array of Procstar agent connections.
     agentConns: new Map(),
+
+    // Sequence number of the last summary message received, or null.
+    summarySeq: null,
   }
 
   setTime(time) {
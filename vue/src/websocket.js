@@ -2,6 +2,9 @@
  * WebSocket connection that receives JSON messages.
  */
 export class Socket {
+  /**
+   * @param url - the URL, or a function that returns it on each connect
+   */
   constructor(url, onMessage, onConnect, onErr) {
     this.url        = url
     this.websocket  = null
@@ -19,8 +22,9 @@ export class Socket {
       // Already have a websocket.
       return
 
-    console.log('websocket connecting:', this.url.toString())
-    this.websocket = new WebSocket(this.url)
+    const url = typeof this.url === 'function' ? this.url() : this.url
+    console.log('websocket connecting:', url.toString())
+    this.websocket = new WebSocket(url)
 
     this.websocket.onopen = () => {
       this.onConnect()